@@ -1,11 +1,14 @@
 from flask import Flask, render_template, request, redirect, jsonify,make_response
 from cryptography.fernet import Fernet
-import redis,os, jwt
+import redis,os, jwt, json, ipaddress
+import tiktoken
 
 
 
-# redisCliUserSetting : user_idで設定を管理する。構造{user_id : {"user_name" : user_name(str), "model" : model_name(str), "custom_instruction" : custom_instruction(str), "use_custom_instruction_flag" : use_custom_instruction_flag(bool)}
+# redisCliUserSetting : user_idで設定を管理する。構造{user_id : {"user_name" : user_name(str), "model" : model_name(str), "custom_instruction" : custom_instruction(str), "use_custom_instruction_flag" : use_custom_instruction_flag(bool), "custom_instruction_tokens" : cl100k_baseで数えたcustom_instructionのトークン数(int), "settings_version" : 保存する度に増える版数(int)}
 redisCliUserSetting = redis.Redis(host="redis", port=6379, db=1)
+# redisCliAccessTime : streamlitが書き込むやり取り毎の処理時間のメトリクス(streamlit/turn_metrics.py)を読む。
+redisCliAccessTime = redis.Redis(host="redis", port=6379, db=3)
 
 # JWTでの鍵
 JWT_SECRET_KEY = os.environ['JWT_SECRET_KEY']
@@ -13,10 +16,103 @@ JWT_SECRET_KEY = os.environ['JWT_SECRET_KEY']
 ENCRYPT_KEY = os.environ["ENCRYPT_KEY"].encode()
 cipher_suite = Fernet(ENCRYPT_KEY)
 
+# CustomInstructionの最大トークン数。0であれば制限しない。
+CUSTOM_INSTRUCTION_MAX_TOKENS = int(os.environ.get('CUSTOM_INSTRUCTION_MAX_TOKENS', 0))
+# CustomInstructionのトークン数を数えるエンコーディング。保存したトークン数は上限の検証と表示だけに使う。
+# モデル毎にトークナイザーが違うため、streamlitはチャットの度にモデルのトークナイザーで数え直す。
+CUSTOM_INSTRUCTION_ENCODING = 'cl100k_base'
+# 設定画面とJSONのAPIが読み書きする項目
+SETTINGS_FIELDS = ('user_name', 'custom_instruction', 'use_custom_instruction_flag', 'custom_instruction_tokens', 'settings_version')
 
 DOMAIN_NAME = os.environ['DOMAIN_NAME']
+# /metricsを読めるネットワーク(カンマ区切りのCIDR)。空白であればループバックとdockerのネットワーク(172.16.0.0/12)。
+# flaskはdocker-compose.ymlでホストの5000番にも公開しているため、それ以外からの読み出しは断る。
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network.strip())
+    for network in (os.environ.get('METRICS_ALLOWED_NETWORKS') or '127.0.0.0/8,::1/128,172.16.0.0/12').split(',')
+    if network.strip()
+]
 app = Flask(__name__)
 
+_encoding = None
+
+class SettingsError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def count_tokens(text):
+    # エンコーディングは最初に使う時に1回だけ読み込む
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(CUSTOM_INSTRUCTION_ENCODING)
+    return len(_encoding.encode(text))
+
+def settings_etag(version):
+    return f'"{version}"'
+
+def read_settings(user_id):
+    # 全ての項目を1回のHMGETで読む。復号はしない。
+    return dict(zip(SETTINGS_FIELDS, redisCliUserSetting.hmget(user_id, SETTINGS_FIELDS)))
+
+def settings_version(values):
+    return int(values['settings_version'] or 0)
+
+def decrypt_settings(values):
+    return {
+        'user_name': cipher_suite.decrypt(values['user_name']).decode('utf-8') if values['user_name'] else '',
+        'custom_instruction': cipher_suite.decrypt(values['custom_instruction']).decode('utf-8') if values['custom_instruction'] else '',
+        'use_custom_instruction': bool(values['use_custom_instruction_flag'] and values['use_custom_instruction_flag'].decode()),
+        'custom_instruction_tokens': int(values['custom_instruction_tokens']) if values['custom_instruction_tokens'] is not None else None,
+        'custom_instruction_max_tokens': CUSTOM_INSTRUCTION_MAX_TOKENS,
+        'version': settings_version(values),
+    }
+
+def save_settings(user_id, user_name, custom_instruction, use_custom_instruction, expected_version=None):
+    """
+    設定を検証し、全ての項目と版数の加算を1つのMULTIで書き込む。
+    expected_versionを渡すと、保存されている版数が異なる場合はSettingsError(412)にする。
+    custom_instructionのトークン数も一緒に保存し、(新しい版数, トークン数)を返す。
+    """
+    custom_instruction_tokens = count_tokens(custom_instruction) if custom_instruction else 0
+    if CUSTOM_INSTRUCTION_MAX_TOKENS and custom_instruction_tokens > CUSTOM_INSTRUCTION_MAX_TOKENS:
+        raise SettingsError(
+            f'Custom instructionが長すぎます。{CUSTOM_INSTRUCTION_MAX_TOKENS}tokens以下にしてください。({custom_instruction_tokens}tokens)',
+            422,
+        )
+    mapping = {
+        'user_name': cipher_suite.encrypt(user_name.encode()),
+        'custom_instruction': cipher_suite.encrypt(custom_instruction.encode()),
+        'use_custom_instruction_flag': 'True' if use_custom_instruction else '',
+        'custom_instruction_tokens': custom_instruction_tokens,
+    }
+    with redisCliUserSetting.pipeline(transaction=True) as pipe:
+        try:
+            if expected_version is not None:
+                # 読んでから書くまでに他で保存されていればexecuteがWatchErrorになる
+                pipe.watch(user_id)
+                if int(pipe.hget(user_id, 'settings_version') or 0) != expected_version:
+                    raise SettingsError('設定が他で更新されています。読み直してください。', 412)
+                pipe.multi()
+            pipe.hset(user_id, mapping=mapping)
+            pipe.hincrby(user_id, 'settings_version', 1)
+            return pipe.execute()[-1], custom_instruction_tokens
+        except redis.WatchError:
+            raise SettingsError('設定が他で更新されています。読み直してください。', 412)
+
+def get_api_user_id():
+    # JWTはAuthorizationヘッダー(Bearer)かクエリのtokenで受け取る
+    authorization = request.headers.get('Authorization', '')
+    token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else request.args.get('token')
+    if not token:
+        raise SettingsError('Token not found', 401)
+    try:
+        return jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])["user_id"]
+    except jwt.ExpiredSignatureError:
+        raise SettingsError('Token expired', 401)
+    except jwt.InvalidTokenError:
+        raise SettingsError('Invalid token', 401)
+
 @app.route('/f_settings')
 def settings():
     token = request.args.get('token')
@@ -25,14 +121,9 @@ def settings():
             # JWTの検証
             decoded_token = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
             user_id = decoded_token["user_id"]
-                  
-            user_name_encrypted = redisCliUserSetting.hget(user_id, 'user_name')
-            user_name = cipher_suite.decrypt(user_name_encrypted).decode('utf-8')
-            custom_instruction_encrypted = redisCliUserSetting.hget(user_id, 'custom_instruction')
-            custom_instruction = cipher_suite.decrypt(custom_instruction_encrypted).decode('utf-8')
-            
-            use_custom_instruction_flag = redisCliUserSetting.hget(user_id, 'use_custom_instruction_flag').decode()
-            return render_template('settings.html', custom_instruction=custom_instruction, user_name=user_name, user_id=user_id, use_custom_instruction_flag=use_custom_instruction_flag)
+
+            user_settings = decrypt_settings(read_settings(user_id))
+            return render_template('settings.html', custom_instruction=user_settings['custom_instruction'], user_name=user_settings['user_name'], user_id=user_id, use_custom_instruction_flag=user_settings['use_custom_instruction'], custom_instruction_max_tokens=CUSTOM_INSTRUCTION_MAX_TOKENS)
         except jwt.ExpiredSignatureError:
             # JWTの有効期限が切れている場合
             return jsonify({"message": "Token expired"}), 401
@@ -49,17 +140,62 @@ def save_instruction():
     user_name = request.form['user_name']
     custom_instruction = request.form['custom_instruction']
     use_custom_instruction_flag = 'use_custom_instruction' in request.form
-    if use_custom_instruction_flag:
-        use_custom_instruction_flag = "True"
-    else:
-        use_custom_instruction_flag = ""
-    user_name_encrypted = cipher_suite.encrypt(user_name.encode())
-    custom_instruction_encrypted = cipher_suite.encrypt(custom_instruction.encode())
-    redisCliUserSetting.hset(user_id, 'user_name', user_name_encrypted)
-    redisCliUserSetting.hset(user_id, 'custom_instruction', custom_instruction_encrypted)
-    redisCliUserSetting.hset(user_id, 'use_custom_instruction_flag', use_custom_instruction_flag)
+    try:
+        save_settings(user_id, user_name, custom_instruction, use_custom_instruction_flag)
+    except SettingsError as e:
+        # 入力した内容のまま設定画面に戻す
+        return render_template('settings.html', custom_instruction=custom_instruction, user_name=user_name, user_id=user_id, use_custom_instruction_flag=use_custom_instruction_flag, custom_instruction_max_tokens=CUSTOM_INSTRUCTION_MAX_TOKENS, error=str(e)), e.status
     return redirect(f'https://{DOMAIN_NAME}')
 
+@app.route('/f_api/settings', methods=['GET'])
+def get_settings_api():
+    # If-None-Matchの版数が変わっていなければ復号せずに304を返す
+    try:
+        user_id = get_api_user_id()
+    except SettingsError as e:
+        return jsonify({"message": str(e)}), e.status
+    values = read_settings(user_id)
+    etag = settings_etag(settings_version(values))
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304, {'ETag': etag}
+    response = jsonify(decrypt_settings(values))
+    response.headers['ETag'] = etag
+    return response
+
+@app.route('/f_api/settings', methods=['PUT'])
+def put_settings_api():
+    # If-Matchを付けると、その版数から変わっていない場合だけ保存する
+    try:
+        user_id = get_api_user_id()
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise SettingsError('JSONのオブジェクトを送ってください。', 400)
+        user_name = body.get('user_name', '')
+        custom_instruction = body.get('custom_instruction', '')
+        use_custom_instruction = body.get('use_custom_instruction', False)
+        if not isinstance(user_name, str) or not isinstance(custom_instruction, str) or not isinstance(use_custom_instruction, bool):
+            raise SettingsError('user_nameとcustom_instructionは文字列、use_custom_instructionは真偽値にしてください。', 400)
+        if_match = request.headers.get('If-Match')
+        expected_version = None
+        if if_match is not None:
+            try:
+                expected_version = int(if_match.strip('"'))
+            except ValueError:
+                raise SettingsError('If-Matchが不正です。', 400)
+        version, custom_instruction_tokens = save_settings(user_id, user_name, custom_instruction, use_custom_instruction, expected_version)
+    except SettingsError as e:
+        return jsonify({"message": str(e)}), e.status
+    response = jsonify({
+        'user_name': user_name,
+        'custom_instruction': custom_instruction,
+        'use_custom_instruction': use_custom_instruction,
+        'custom_instruction_tokens': custom_instruction_tokens,
+        'custom_instruction_max_tokens': CUSTOM_INSTRUCTION_MAX_TOKENS,
+        'version': version,
+    })
+    response.headers['ETag'] = settings_etag(version)
+    return response
+
 @app.route('/f_back', methods=['POST'])
 def back():
     return redirect(f'https://{DOMAIN_NAME}')
@@ -88,6 +224,64 @@ def logout_success():
     response.set_cookie('mod_auth_openidc_session', '', expires=0)
     return response
 
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_allowed(remote_addr):
+    # 接続元のアドレスで判定する。X-Forwarded-Forは見ないので、ヘッダーでは偽れない。
+    try:
+        address = ipaddress.ip_address(remote_addr)
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+@app.route('/metrics')
+def metrics():
+    # Prometheusのテキスト形式で返す。apacheは/f_*しか転送しないが、flaskはホストの5000番にも
+    # 公開されているので、METRICS_ALLOWED_NETWORKSの接続元以外には403を返す。
+    if not metrics_allowed(request.remote_addr):
+        return jsonify({"message": "Forbidden"}), 403
+    lines = []
+    # やり取りの数とエラーになったやり取りの数
+    for name, key, description in (
+        ('chat_turns_total', 'metrics:turns', 'やり取りの数'),
+        ('chat_turn_errors_total', 'metrics:errors', 'エラーになったやり取りの数'),
+    ):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} counter')
+        for model, value in sorted(redisCliAccessTime.hgetall(key).items()):
+            lines.append(f'{name}{{model="{escape_label(model.decode())}"}} {int(value)}')
+
+    # metrics:indexに登録された(メトリクス名, モデル名)毎のヒストグラム
+    index = sorted(
+        (tuple(json.loads(field)), json.loads(info))
+        for field, info in redisCliAccessTime.hgetall('metrics:index').items()
+    )
+    pipe = redisCliAccessTime.pipeline(transaction=False)
+    for (name, model), _ in index:
+        pipe.hgetall(f'metrics:hist:{name}:{model}')
+    last_name = None
+    for ((name, model), info), histogram in zip(index, pipe.execute()):
+        metric_name = f'chat_{name}'
+        if name != last_name:
+            lines.append(f'# HELP {metric_name} {info["help"]}')
+            lines.append(f'# TYPE {metric_name} histogram')
+            last_name = name
+        histogram = {field.decode(): value for field, value in histogram.items()}
+        label = f'model="{escape_label(model)}"'
+        # Redisのバケットは累積ではないので、上限の小さい順に足し合わせる
+        cumulative = 0
+        for bound in info['buckets']:
+            cumulative += int(histogram.get(repr(bound), 0))
+            lines.append(f'{metric_name}_bucket{{{label},le="{float(bound)}"}} {cumulative}')
+        cumulative += int(histogram.get('+Inf', 0))
+        lines.append(f'{metric_name}_bucket{{{label},le="+Inf"}} {cumulative}')
+        lines.append(f'{metric_name}_sum{{{label}}} {float(histogram.get("sum", 0))}')
+        lines.append(f'{metric_name}_count{{{label}}} {int(histogram.get("count", 0))}')
+    response = make_response('\n'.join(lines) + '\n')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
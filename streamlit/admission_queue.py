@@ -0,0 +1,170 @@
+"""
+レート制限を超えたリクエストの、Redis上の順番待ちの列。
+
+レート制限を超えたリクエストを断らずに列に並べ、空きができたら列の順に通す。
+列の順番はユーザー毎の重み付きの公平なスケジューリング(仮想終了時刻の順)で決める。
+    - 並べるとき、ユーザーの前回の終了時刻と列の基準の時刻(最後に通した順番)の遅い方を開始時刻とし、
+      開始時刻 + 1 / 重み を終了時刻として、終了時刻の順に並べる
+    - 同じユーザーが続けて並べても、他のユーザーの順番は後ろにならない
+    - 重みが2のユーザーは、重みが1のユーザーの2倍の頻度で順番が来る
+列を進めるプロセスは無く、待っている再実行がそれぞれRateLimiter.acquire_queuedで確認し直す。
+全体で共有する制限は前の待ちの分の空きを残して確認するため、列の順に通る(通ったら同じ往復で
+列から取り除かれる)。自身のユーザーやモデルの制限で止まった待ちは、後ろの待ちを止めない。しばらく確認に来ていない待ちは、
+画面を閉じたなどとして次の確認で列から除く。
+
+Redis(redisCliAccessTime)の構造 :
+    f"{key_prefix}:queue" : {チケット : 終了時刻(as score)}
+    f"{key_prefix}:seen"  : {チケット : 最後に確認した時刻(as score)}
+    f"{key_prefix}:state" : {"clock" : 列の基準の時刻, f"user:{USER_ID}" : そのユーザーの前回の終了時刻}
+チケットはf"{time_ns:0>20}_{USER_ID}"とし、終了時刻が同じなら先に並べた方が前になる。
+"""
+
+import argparse, json, time
+from typing import List, Optional, Tuple
+
+import redis
+
+# KEYS : 列、最後に確認した時刻、状態のキー
+# ARGV : now, ticket, user_id, 1 / 重み, max_queue_size, stale_after, expire_time
+# 戻り値 : 並べた場合は{1, 順位(0始まり), 列の長さ}、列が一杯なら{0, -1, 列の長さ}
+ENQUEUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ticket = ARGV[2]
+local user_field = 'user:' .. ARGV[3]
+local cost = tonumber(ARGV[4])
+local max_queue_size = tonumber(ARGV[5])
+local stale_after = tonumber(ARGV[6])
+local expire_time = tonumber(ARGV[7])
+
+for _, stale in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - stale_after)) do
+    redis.call('ZREM', KEYS[1], stale)
+    redis.call('ZREM', KEYS[2], stale)
+end
+local queue_length = redis.call('ZCARD', KEYS[1])
+if queue_length >= max_queue_size then
+    return {0, -1, queue_length}
+end
+local state = redis.call('HMGET', KEYS[3], 'clock', user_field)
+local start = math.max(tonumber(state[1]) or 0, tonumber(state[2]) or 0)
+local finish = start + cost
+redis.call('HSET', KEYS[3], user_field, tostring(finish))
+redis.call('ZADD', KEYS[1], finish, ticket)
+redis.call('ZADD', KEYS[2], now, ticket)
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], expire_time)
+end
+return {1, redis.call('ZRANK', KEYS[1], ticket), queue_length + 1}
+"""
+
+
+class AdmissionQueue:
+    """
+    ユーザー毎の重み付きの公平な順番待ちの列。RateLimiter.acquire_queued(admission=...)と組み合わせて使う。
+
+    引数:
+        redis_client (redis.Redis): 列のキーを保存するRedisクライアント。
+        key_prefix (str): 列のキーの接頭辞。
+        max_queue_size (int): 並べられる待ちの数の上限。溢れたリクエストは断る。
+        stale_after (float): この秒数確認に来ていない待ちは列から除く。
+        expire_time (int): 列のキーの寿命(秒)。誰も並べなくなったら状態ごと消える。
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        key_prefix: str = "admission",
+        max_queue_size: int = 100,
+        stale_after: float = 10.0,
+        expire_time: int = 3600,
+    ):
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.max_queue_size = max_queue_size
+        self.stale_after = stale_after
+        self.expire_time = expire_time
+        self._enqueue_script = redis_client.register_script(ENQUEUE_SCRIPT)
+
+    def keys(self) -> List[str]:
+        """列、最後に確認した時刻、状態のキー。RATE_LIMIT_SCRIPTのKEYSの最後に付ける。"""
+        return [
+            f"{self.key_prefix}:queue",
+            f"{self.key_prefix}:seen",
+            f"{self.key_prefix}:state",
+        ]
+
+    @staticmethod
+    def make_ticket(user_id: str) -> str:
+        """並べた順に並ぶ一意なチケットを作る。レート制限のmemberにも使う。"""
+        return f"{time.time_ns():0>20}_{user_id}"
+
+    def enqueue(
+        self,
+        ticket: str,
+        user_id: str,
+        weight: float = 1.0,
+        now: Optional[float] = None,
+    ) -> Optional[Tuple[int, int]]:
+        """
+        チケットを公平な順番で列に並べる。
+
+        引数:
+            ticket (str): make_ticketで作ったチケット。
+            user_id (str): USER_ID。
+            weight (float): ユーザーの重み。大きいほど順番が早く来る。
+            now (float, optional): 現在時刻(unixtime)。省略すると時計から取る。
+
+        戻り値:
+            Optional[Tuple[int, int]]: (順位(0始まり), 列の長さ)。列が一杯で並べなかった場合はNone。
+        """
+        now = time.time() if now is None else now
+        added, position, length = self._enqueue_script(
+            keys=self.keys(),
+            args=[
+                repr(now),
+                ticket,
+                user_id,
+                1 / weight,
+                self.max_queue_size,
+                self.stale_after,
+                self.expire_time,
+            ],
+        )
+        if not int(added):
+            return None
+        return int(position), int(length)
+
+    def cancel(self, ticket: str) -> None:
+        """待つのをやめたチケットを列から除く。"""
+        queue_key, seen_key, _ = self.keys()
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zrem(queue_key, ticket)
+        pipe.zrem(seen_key, ticket)
+        pipe.execute()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="順番待ちの列の様子を表示する。")
+    parser.add_argument("--redis-host", default="redis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=3)
+    parser.add_argument("--key-prefix", default="admission")
+    args = parser.parse_args()
+    client = redis.Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    now = time.time()
+    seen = dict(client.zrange(f"{args.key_prefix}:seen", 0, -1, withscores=True))
+    print(
+        json.dumps(
+            [
+                {
+                    "ticket": ticket.decode(),
+                    "finish": finish,
+                    "last_seen_seconds_ago": now - seen[ticket] if ticket in seen else None,
+                }
+                for ticket, finish in client.zrange(
+                    f"{args.key_prefix}:queue", 0, -1, withscores=True
+                )
+            ],
+            ensure_ascii=False,
+            indent=2,
+        )
+    )
@@ -0,0 +1,193 @@
+"""
+プロセスで共有するバックグラウンドジョブのキュー。
+
+タイトル生成のように応答の後で行えばよい処理を、決まった数のワーカースレッドで実行する。
+再実行の度にThreadPoolExecutorを作るとスレッドがセッションをまたいで増え続けるため、
+キューはst.cache_resourceでプロセスに一つだけ作る。
+
+    - キューの長さに上限があり、溢れたジョブは受け付けない(リクエストの処理を待たせない)
+    - 失敗したジョブは指数的に間隔を空けて再試行する
+    - 同じkeyのジョブが待機中か実行中であれば、新しいジョブは受け付けない
+    - キューの長さ、待ち時間、実行時間などをstats()で返す
+"""
+
+import logging, queue, threading, time
+from typing import Any, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, func: Callable, args: tuple, kwargs: dict, key: Optional[str]):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class BackgroundJobQueue:
+    """
+    決まった数のワーカースレッドでジョブを実行するキュー。
+
+    引数:
+        max_workers (int): ワーカースレッドの数。
+        max_queue_size (int): 待機できるジョブの数の上限。
+        max_retries (int): 失敗したジョブを再試行する回数。
+        backoff_base (float): 最初の再試行までの秒数。再試行の度に2倍になる。
+        backoff_max (float): 再試行までの秒数の上限。
+        name (str): ワーカースレッドの名前の接頭辞。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_queue_size: int = 100,
+        max_retries: int = 3,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        name: str = "background-job",
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queue: "queue.Queue[Optional[_Job]]" = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._keys: Set[str] = set()
+        self._running = 0
+        self._retry_waiting = 0
+        self._num_started = 0
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+            "rejected": 0,
+            "deduplicated": 0,
+        }
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._run_time_total = 0.0
+        self._run_time_max = 0.0
+        self._workers = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(
+        self, func: Callable, *args: Any, key: Optional[str] = None, **kwargs: Any
+    ) -> bool:
+        """
+        ジョブをキューに入れる。待たずにすぐ戻る。
+
+        引数:
+            func (Callable): 実行する関数。
+            *args, **kwargs: funcに渡す引数。
+            key (str, optional): 重複を除くためのキー。同じキーのジョブが待機中か実行中であれば受け付けない。
+
+        戻り値:
+            bool: 受け付けたか。キューが一杯か、同じキーのジョブがあればFalse。
+        """
+        job = _Job(func, args, kwargs, key)
+        with self._lock:
+            if key is not None and key in self._keys:
+                self._stats["deduplicated"] += 1
+                return False
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._stats["rejected"] += 1
+                return False
+            if key is not None:
+                self._keys.add(key)
+            self._stats["submitted"] += 1
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        """受け付け・完了・失敗などの数と、キューの長さ、待ち時間と実行時間の平均と最大を返す。"""
+        with self._lock:
+            started = self._num_started
+            finished = started - self._running
+            return {
+                **self._stats,
+                "queue_depth": self._queue.qsize(),
+                "running": self._running,
+                "retry_waiting": self._retry_waiting,
+                "wait_time_avg": self._wait_time_total / started if started else 0.0,
+                "wait_time_max": self._wait_time_max,
+                "run_time_avg": self._run_time_total / finished if finished else 0.0,
+                "run_time_max": self._run_time_max,
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """待機中のジョブを実行し終えたらワーカースレッドを止める。"""
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            started_at = time.monotonic()
+            wait_time = started_at - job.enqueued_at
+            with self._lock:
+                self._running += 1
+                self._num_started += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+            job.attempts += 1
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                self._finish(job, started_at, error=e)
+            else:
+                self._finish(job, started_at)
+
+    def _finish(
+        self, job: _Job, started_at: float, error: Optional[Exception] = None
+    ) -> None:
+        run_time = time.monotonic() - started_at
+        with self._lock:
+            self._running -= 1
+            self._run_time_total += run_time
+            self._run_time_max = max(self._run_time_max, run_time)
+            if error is None:
+                self._stats["completed"] += 1
+            elif job.attempts <= self.max_retries:
+                self._stats["retried"] += 1
+                self._retry_waiting += 1
+            else:
+                self._stats["failed"] += 1
+            if (error is None or job.attempts > self.max_retries) and job.key is not None:
+                self._keys.discard(job.key)
+        if error is None:
+            return
+        if job.attempts > self.max_retries:
+            logger.error(f"background job {job.func.__name__} failed : {error}")
+            return
+        delay = min(self.backoff_base * 2 ** (job.attempts - 1), self.backoff_max)
+        logger.warning(
+            f"background job {job.func.__name__} failed, retrying in {delay}s : {error}"
+        )
+        timer = threading.Timer(delay, self._requeue, args=(job,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, job: _Job) -> None:
+        job.enqueued_at = time.monotonic()
+        with self._lock:
+            self._retry_waiting -= 1
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._stats["failed"] += 1
+                if job.key is not None:
+                    self._keys.discard(job.key)
+                logger.error(f"background job {job.func.__name__} dropped : queue is full")
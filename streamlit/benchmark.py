@@ -0,0 +1,911 @@
+"""
+オフラインのベンチマーク。
+
+Redisの代わりにfakeredis、モデルの代わりに決まった応答を返す偽のプロバイダーを使い、
+チャットの処理のうちデータ量に応じて遅くなりうる箇所の時間を計る。
+    trim_tokens         : 会話履歴の長さ(メッセージ数)
+    stream_write        : ストリーミングの応答の長さ(チャンク数)
+    usage               : その日のメッセージ数(コストの集計の書き込み・読み出し・作り直し)
+    user_sessions       : ユーザー数(サイドバーのセッション一覧)
+    csv_export          : redisCliChatDataのキー数
+chat_openai0_28.pyはimportするとstreamlitの画面を作るため、同じ処理を行う
+message_tokens, stream_writer, chat_store, usage_counter, chat_exportを直接呼ぶ。
+画面の操作からモデルの応答までを通した計測は、load_generator.pyで行う。
+
+各項目には、改善前(ベースラインのコミット)のchat_openai0_28.pyの処理を同じデータで行う
+"baseline"のケースがあり、同じサイズの改善後のケースとの中央値の比(baseline / 改善後)を
+"speedups"として表示・出力する。改善前の処理はデータ量の2乗で遅くなるものがあるため、
+BASELINE_MAX_SIZEを超えるサイズでは計らない。
+
+結果はJSONファイルに書き出す。--compareで前の結果を渡すと中央値の比を表示し、
+--max-ratioを超えて遅くなった項目があれば終了コード1で終わる。
+開発環境で
+    pip install fakeredis[lua]
+    python benchmark.py --output bench.json [--compare 前回のbench.json]
+のように実行する。
+"""
+
+import argparse, base64, csv, datetime, io, json, os, platform, statistics, subprocess, sys, time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import redis
+from cryptography.fernet import Fernet
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from chat_export import iter_chat_data_csv, unixtime_to_localtime
+from chat_store import (
+    ACCESS_TIME_DB,
+    CACHE_DB,
+    CHAT_DATA_DB,
+    MESSAGES_DB,
+    TITLE_AT_USER_DB,
+    USER_ACCESS_DB,
+    USER_SETTING_DB,
+    ChatStore,
+    user_sessions_key,
+)
+from message_tokens import MessageTokenCounter
+from storage_codec import LEGACY_VERSION, StorageCodec, compact_json
+from stream_writer import IncrementalTokenCounter, StreamingResponseWriter
+from usage_counter import get_daily_cost, record_usage, rebuild_usage
+
+MODEL = "bench-model"
+API_COST = {MODEL: {"prompt": 0.5, "response": 1.5}}
+EXPIRE_TIME = 24 * 3600
+# 暗号化の時間も計るが、結果を再現できるよう鍵は固定する
+ENCRYPT_KEY = base64.urlsafe_b64encode(bytes(32))
+
+SIZES = {
+    "trim_tokens": [10, 100, 1000, 10000],
+    "stream_write": [100, 1000, 5000],
+    "usage": [100, 1000, 5000],
+    "user_sessions": [10, 100, 1000],
+    "csv_export": [100, 1000, 5000],
+}
+QUICK_SIZES = {name: sizes[:2] for name, sizes in SIZES.items()}
+# baselineのケースを計る最大のサイズ
+BASELINE_MAX_SIZE = {
+    "trim_tokens": 1000,
+    "stream_write": 5000,
+    "usage": 5000,
+    "user_sessions": 1000,
+    "csv_export": 5000,
+}
+
+_WORDS = "これは ベンチマーク 用の メッセージ です 。 Redis stream token cost ".split()
+
+
+def fake_text(seed: int, num_words: int) -> str:
+    """seedから決まる文章を返す。"""
+    return " ".join(_WORDS[(seed * 7 + i * 3) % len(_WORDS)] for i in range(num_words))
+
+
+def fake_token_count(text: str, model: str = MODEL) -> int:
+    """偽のトークン数。3文字を1トークンとして数える。"""
+    return len(text) // 3 + 1
+
+
+def fake_completion(messages: List[dict], num_chunks: int) -> Iterator[str]:
+    """偽のプロバイダーのストリーミングの応答。メッセージの数から決まるチャンクを返す。"""
+    for i in range(num_chunks):
+        yield fake_text(len(messages) + i, 2)
+
+
+def fake_history(num_messages: int, num_words: int = 40) -> List[dict]:
+    """ユーザーとアシスタントが交互に話した会話履歴を返す。"""
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": fake_text(i, num_words)}
+        for i in range(num_messages)
+    ]
+
+
+class FakeRedisServer:
+    """
+    fakeredisのサーバー1つと、そこに繋ぐDB毎の接続プール。
+
+    引数:
+        dbs (List[int]): 接続プールを作るDB番号。
+    """
+
+    def __init__(
+        self,
+        dbs: Tuple[int, ...] = (
+            MESSAGES_DB,
+            USER_SETTING_DB,
+            TITLE_AT_USER_DB,
+            ACCESS_TIME_DB,
+            USER_ACCESS_DB,
+            CHAT_DATA_DB,
+            CACHE_DB,
+        ),
+    ):
+        self.server = fakeredis.FakeServer()
+        self.connection_pools = {
+            db: redis.ConnectionPool(
+                server=self.server, connection_class=fakeredis.FakeConnection, db=db
+            )
+            for db in dbs
+        }
+
+    def client(self, db: int) -> redis.Redis:
+        return redis.Redis(connection_pool=self.connection_pools[db])
+
+    def store(self) -> ChatStore:
+        return ChatStore(connection_pools=self.connection_pools)
+
+
+def measure(
+    run: Callable[[Any], Any],
+    setup: Callable[[], Any] = lambda: None,
+    repeat: int = 5,
+) -> Dict[str, float]:
+    """
+    setupの戻り値を渡してrunをrepeat回実行し、runだけにかかった秒数を集計する。
+
+    戻り値:
+        Dict[str, float]: 最小、中央値、平均の秒数と、最後の実行のrunの戻り値("last")。
+    """
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        arg = setup()
+        started_at = time.perf_counter()
+        result = run(arg)
+        seconds.append(time.perf_counter() - started_at)
+    return {
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "mean": statistics.mean(seconds),
+        "last": result,
+    }
+
+
+def make_result(
+    name: str, case: str, size: int, unit: str, timing: Dict[str, Any], **extra: Any
+) -> Dict[str, Any]:
+    """結果1件の辞書を作る。"""
+    return {
+        "name": name,
+        "case": case,
+        "size": size,
+        "unit": unit,
+        "min": timing["min"],
+        "median": timing["median"],
+        "mean": timing["mean"],
+        **extra,
+    }
+
+
+# ここから改善前の処理。ベースラインのコミットのchat_openai0_28.pyから、Streamlitの画面と
+# 暗号化の鍵以外をそのまま関数にしたもの。データは旧形式(StorageCodecのバージョン0)で書く。
+
+
+def baseline_trim_tokens(
+    messages: List[dict], max_tokens: int, model: str, count_func: Callable[[str, str], int]
+) -> List[dict]:
+    """改善前のtrim_tokens。str(messages)全体を数え、超えていれば先頭を1件削除して数え直す。"""
+    while True:
+        if count_func(str(messages), model) <= max_tokens:
+            break
+        messages.pop(0)
+        if len(messages) == 0:
+            raise ValueError("与えられたmessageはmax_tokens以下になりません。")
+    return messages
+
+
+def baseline_stream_write(
+    messages_client: redis.Redis,
+    chat_data_client: redis.Redis,
+    cipher: Fernet,
+    session_id: str,
+    messages_id: str,
+    chunks: Iterator[str],
+) -> str:
+    """
+    改善前のストリーミング中の書き込み。チャンク毎に応答全体を暗号化し、
+    redisCliMessagesのLSETとredisCliChatDataのHSETを行い、応答全体のトークン数を数え直す。
+    """
+    now = time.time()
+    messages_length = messages_client.llen(session_id)
+    assistant_msg = ""
+    assistant_messages = {"role": "assistant", "content": ""}
+    for chunk in chunks:
+        assistant_msg += chunk
+        assistant_msg_encrypted = cipher.encrypt(assistant_msg.encode()).decode()
+        assistant_messages["content"] = assistant_msg
+        messages_client.lset(
+            session_id,
+            messages_length - 1,
+            cipher.encrypt(json.dumps(assistant_messages).encode()),
+        )
+        chat_data_client.hset(
+            messages_id,
+            "response",
+            json.dumps(
+                {
+                    "USER_ID": "bench",
+                    "model": MODEL,
+                    "timestamp": now,
+                    "messages": assistant_msg_encrypted,
+                    "num_tokens": fake_token_count(assistant_msg),
+                }
+            ),
+        )
+    return assistant_msg
+
+
+def baseline_daily_cost(
+    access_client: redis.Redis, chat_data_client: redis.Redis, user_id: str, timestamp: float
+) -> Tuple[float, float]:
+    """改善前の今日のコストの計算。今日の全てのmessages_idのチャットデータを読み、JSONを解いて足す。"""
+    today_midnight = datetime.datetime.fromtimestamp(timestamp).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    cost_team, cost_mine = 0, 0
+    for message_id in access_client.zrangebyscore(
+        "access", int(today_midnight.timestamp()), "+inf"
+    ):
+        for kind, data in chat_data_client.hgetall(message_id).items():
+            data = json.loads(data)
+            cost_team += API_COST[data["model"]][kind.decode()] / 1000
+            if data.get("USER_ID") == user_id:
+                cost_mine += API_COST[data["model"]][kind.decode()] / 1000
+    return cost_team, cost_mine
+
+
+def baseline_user_sessions(
+    access_client: redis.Redis,
+    title_client: redis.Redis,
+    cipher: Fernet,
+    user_id: str,
+    since: float,
+) -> List[Tuple[str, str]]:
+    """
+    改善前の過去のチャットの一覧。全ユーザーの期間内のmessages_idからsession_idを集め、
+    ユーザーの全てのタイトルを読んで復号し、期間内のものに絞る。
+    """
+    session_ids = {
+        "_".join(id_num.decode().split("_")[:-1])
+        for id_num in access_client.zrangebyscore("access", since, "+inf")
+    }
+    return sorted(
+        {
+            session_id.decode(): cipher.decrypt(title).decode()
+            for session_id, title in title_client.hgetall(user_id).items()
+            if session_id.decode() in session_ids
+        }.items(),
+        reverse=True,
+    )
+
+
+def baseline_csv_export(chat_data_client: redis.Redis) -> bytes:
+    """改善前のCSVエクスポート。KEYSで全てのキーを取り、キー毎にHGETALLしてCSV全体を作る。"""
+    csv_output = io.StringIO()
+    writer = csv.DictWriter(
+        csv_output,
+        fieldnames=["messages_id", "kind", "USER_ID", "model", "timestamp", "messages", "num_tokens"],
+    )
+    writer.writeheader()
+    for key in chat_data_client.keys():
+        for kind, value in chat_data_client.hgetall(key).items():
+            value_dict = json.loads(value)
+            writer.writerow(
+                {
+                    "USER_ID": value_dict["USER_ID"],
+                    "messages_id": key.decode(),
+                    "kind": kind.decode(),
+                    "model": value_dict["model"],
+                    "timestamp": unixtime_to_localtime(value_dict["timestamp"]),
+                    "messages": json.dumps(value_dict["messages"], ensure_ascii=False),
+                    "num_tokens": value_dict["num_tokens"],
+                }
+            )
+    return csv_output.getvalue().encode("shift_jis", errors="replace")
+
+
+def bench_trim_tokens(sizes: List[int], repeat: int) -> List[Dict[str, Any]]:
+    """
+    会話履歴の長さに対するtrim_tokensとsum_message_tokensの時間。
+    cold     : 索引が空(セッションの最初の再実行)
+    warm     : 前回までの索引があり、新しいメッセージが1件だけ増えた状態
+    sum      : 索引がある状態での履歴全体のトークン数の見積もり(ログ出力で使う)
+    baseline : 改善前のtrim_tokens(トークン数の計算はキャッシュしない)
+    """
+    results = []
+    max_tokens = 4096
+    for size in sizes:
+        history = fake_history(size)
+        calls = {"count": 0}
+
+        def counted(text: str, model: str) -> int:
+            calls["count"] += 1
+            return fake_token_count(text, model)
+
+        counter = MessageTokenCounter(counted, index_max_size=max(size, 1000))
+
+        def run_trim(arg):
+            messages, token_index = arg
+            calls["count"] = 0
+            counter.trim_tokens(messages, max_tokens, MODEL, token_index)
+            return calls["count"]
+
+        timing = measure(run_trim, lambda: (list(history), {}), repeat)
+        results.append(
+            make_result(
+                "trim_tokens", "cold", size, "messages", timing, token_counts=timing["last"]
+            )
+        )
+
+        warm_index: Dict[Tuple[str, str], int] = {}
+        counter.trim_tokens(list(history[:-1]), max_tokens, MODEL, warm_index)
+        timing = measure(run_trim, lambda: (list(history), dict(warm_index)), repeat)
+        results.append(
+            make_result(
+                "trim_tokens", "warm", size, "messages", timing, token_counts=timing["last"]
+            )
+        )
+
+        full_index: Dict[Tuple[str, str], int] = {}
+        counter.sum_message_tokens(history, MODEL, full_index)
+        timing = measure(
+            lambda _: counter.sum_message_tokens(history, MODEL, full_index),
+            repeat=repeat,
+        )
+        results.append(make_result("trim_tokens", "sum", size, "messages", timing))
+
+        if size <= BASELINE_MAX_SIZE["trim_tokens"]:
+
+            def run_baseline(messages):
+                calls["count"] = 0
+                baseline_trim_tokens(messages, max_tokens, MODEL, counted)
+                return calls["count"]
+
+            timing = measure(run_baseline, lambda: list(history), repeat)
+            results.append(
+                make_result(
+                    "trim_tokens", "baseline", size, "messages", timing, token_counts=timing["last"]
+                )
+            )
+    return results
+
+
+def bench_stream_write(
+    sizes: List[int], repeat: int, codec: StorageCodec, flush_chunks: int = 20
+) -> List[Dict[str, Any]]:
+    """
+    応答のチャンク数に対するストリーミング中の書き込みの時間。
+    チャット本体と同じく、flush_chunks個毎にその時点までの応答全体を暗号化して
+    ChatStore.write_responseで書き込む。時間による書き込みは結果がぶれるため行わない。
+    baselineはチャンク毎に書き込む改善前の処理。
+    """
+    results = []
+    for size in sizes:
+        fake = FakeRedisServer()
+        session_id = "bench_00000000000000000000"
+        placeholder = codec.encode_message({"role": "assistant", "content": ""})
+
+        def setup():
+            store = fake.store()
+            fake.client(MESSAGES_DB).delete(session_id)
+            fake.client(MESSAGES_DB).rpush(session_id, placeholder)
+            return store
+
+        def run(store: ChatStore):
+            now = time.time()
+            token_counter = IncrementalTokenCounter(fake_token_count)
+            message = {"role": "assistant", "content": ""}
+
+            def write(text: str, final: bool) -> None:
+                num_tokens = (
+                    token_counter.finalize(text) if final else token_counter.update(text)
+                )
+                message["content"] = text
+                store.write_response(
+                    session_id=session_id,
+                    index=0,
+                    message_encrypted=codec.encode_message(message),
+                    messages_id=f"{session_id}_000001",
+                    response=codec.encode_record(
+                        user_id="bench",
+                        model=MODEL,
+                        timestamp=now,
+                        num_tokens=num_tokens,
+                        messages=text,
+                    ),
+                    usage=(
+                        {
+                            "user_id": "bench",
+                            "model": MODEL,
+                            "kind": "response",
+                            "num_tokens": num_tokens,
+                            "cost": 0.0,
+                            "timestamp": now,
+                        }
+                        if final
+                        else None
+                    ),
+                    expire_time=EXPIRE_TIME,
+                )
+
+            with StreamingResponseWriter(
+                write, flush_interval=float("inf"), flush_chunks=flush_chunks
+            ) as writer:
+                for chunk in fake_completion([], size):
+                    writer.append(chunk)
+            return writer.num_flushes, store.round_trips.count, len(writer.text)
+
+        timing = measure(run, setup, repeat)
+        flushes, round_trips, length = timing["last"]
+        results.append(
+            make_result(
+                "stream_write",
+                "flush",
+                size,
+                "chunks",
+                timing,
+                flushes=flushes,
+                round_trips=round_trips,
+                response_chars=length,
+            )
+        )
+
+        if size <= BASELINE_MAX_SIZE["stream_write"]:
+            messages_id = f"{session_id}_000001"
+
+            def setup_baseline():
+                fake.client(MESSAGES_DB).delete(session_id)
+                fake.client(MESSAGES_DB).rpush(
+                    session_id,
+                    codec.cipher.encrypt(json.dumps({"role": "assistant", "content": ""}).encode()),
+                )
+                return fake.store()
+
+            def run_baseline(store: ChatStore):
+                text = baseline_stream_write(
+                    store.messages,
+                    store.chat_data,
+                    codec.cipher,
+                    session_id,
+                    messages_id,
+                    fake_completion([], size),
+                )
+                return store.round_trips.count, len(text)
+
+            timing = measure(run_baseline, setup_baseline, repeat)
+            round_trips, length = timing["last"]
+            results.append(
+                make_result(
+                    "stream_write",
+                    "baseline",
+                    size,
+                    "chunks",
+                    timing,
+                    round_trips=round_trips,
+                    response_chars=length,
+                )
+            )
+    return results
+
+
+def bench_usage(
+    sizes: List[int], repeat: int, codec: StorageCodec, num_users: int = 20
+) -> List[Dict[str, Any]]:
+    """
+    その日のメッセージ数に対するコストの集計の時間。
+    record  : 1件分の集計の加算(メッセージ毎に行う)
+    read    : その日のチームとユーザーのコストの読み出し(再実行毎に行う)
+    rebuild : redisCliChatDataの全記録からの集計の作り直し(usage_counter.py --rebuild)
+    baseline: 改善前の、今日の全てのチャットデータを読む再実行毎のコストの計算(readと比べる)
+    """
+    legacy_codec = StorageCodec(codec.cipher, write_version=LEGACY_VERSION)
+    results = []
+    now = time.time()
+    for size in sizes:
+        fake = FakeRedisServer()
+        usage_client = fake.client(ACCESS_TIME_DB)
+        chat_data_client = fake.client(CHAT_DATA_DB)
+        pipe = chat_data_client.pipeline(transaction=False)
+        for i in range(size):
+            user_id = f"user{i % num_users}"
+            kind = "prompt" if i % 2 == 0 else "response"
+            pipe.hset(
+                f"{user_id}_{i:0>20}_{i:0>6}",
+                kind,
+                codec.encode_record(
+                    user_id=user_id,
+                    model=MODEL,
+                    timestamp=now,
+                    num_tokens=100,
+                    messages=fake_text(i, 20),
+                ),
+            )
+        pipe.execute()
+        for i in range(size):
+            record_usage(
+                usage_client,
+                user_id=f"user{i % num_users}",
+                model=MODEL,
+                kind="prompt",
+                num_tokens=100,
+                cost=0.05,
+                timestamp=now,
+                expire_time=EXPIRE_TIME,
+            )
+
+        timing = measure(
+            lambda _: record_usage(
+                usage_client,
+                user_id="user0",
+                model=MODEL,
+                kind="prompt",
+                num_tokens=100,
+                cost=0.05,
+                timestamp=now,
+                expire_time=EXPIRE_TIME,
+            ),
+            repeat=repeat,
+        )
+        results.append(make_result("usage", "record", size, "messages/day", timing))
+
+        timing = measure(
+            lambda _: get_daily_cost(usage_client, "user0", now), repeat=repeat
+        )
+        results.append(make_result("usage", "read", size, "messages/day", timing))
+
+        timing = measure(
+            lambda _: rebuild_usage(chat_data_client, usage_client, API_COST, EXPIRE_TIME),
+            repeat=repeat,
+        )
+        results.append(make_result("usage", "rebuild", size, "messages/day", timing))
+
+        if size <= BASELINE_MAX_SIZE["usage"]:
+            legacy = FakeRedisServer()
+            access_pipe = legacy.client(ACCESS_TIME_DB).pipeline(transaction=False)
+            chat_data_pipe = legacy.client(CHAT_DATA_DB).pipeline(transaction=False)
+            for i in range(size):
+                user_id = f"user{i % num_users}"
+                messages_id = f"{user_id}_{i:0>20}_{i:0>6}"
+                chat_data_pipe.hset(
+                    messages_id,
+                    "prompt" if i % 2 == 0 else "response",
+                    legacy_codec.encode_record(
+                        user_id=user_id,
+                        model=MODEL,
+                        timestamp=now,
+                        num_tokens=100,
+                        messages=fake_text(i, 20),
+                    ),
+                )
+                access_pipe.zadd("access", {messages_id: now})
+            chat_data_pipe.execute()
+            access_pipe.execute()
+            timing = measure(
+                lambda _: baseline_daily_cost(
+                    legacy.client(ACCESS_TIME_DB), legacy.client(CHAT_DATA_DB), "user0", now
+                ),
+                repeat=repeat,
+            )
+            results.append(make_result("usage", "baseline", size, "messages/day", timing))
+    return results
+
+
+def bench_user_sessions(
+    sizes: List[int], repeat: int, codec: StorageCodec, sessions_per_user: int = 30
+) -> List[Dict[str, Any]]:
+    """
+    ユーザー数に対する、1人のユーザーのセッション一覧の取得とタイトルの復号の時間。
+    ユーザー毎の索引を使うため、ユーザー数が増えても変わらないはずである。
+    baselineは全ユーザーの"access"を読む改善前の処理で、ユーザー数に比例して遅くなる。
+    """
+    results = []
+    now = time.time()
+    since = now - 7 * 24 * 3600
+    for size in sizes:
+        fake = FakeRedisServer()
+        client = fake.client(TITLE_AT_USER_DB)
+        pipe = client.pipeline(transaction=False)
+        access_pipe = fake.client(ACCESS_TIME_DB).pipeline(transaction=False)
+        for u in range(size):
+            user_id = f"user{u}"
+            sessions = {
+                f"{user_id}_{s:0>20}": now - s * 3600 for s in range(sessions_per_user)
+            }
+            pipe.zadd(user_sessions_key(user_id), sessions)
+            access_pipe.zadd(
+                "access",
+                {f"{session_id}_000001": score for session_id, score in sessions.items()},
+            )
+            pipe.hset(
+                user_id,
+                mapping={
+                    session_id: codec.cipher.encrypt(fake_text(s, 5).encode())
+                    for s, session_id in enumerate(sessions)
+                },
+            )
+        pipe.execute()
+        access_pipe.execute()
+
+        def run(store: ChatStore):
+            sessions = store.get_user_sessions("user0", since, extra=100)["sessions"]
+            titles = [
+                (session_id.decode(), codec.cipher.decrypt(title).decode())
+                for session_id, title in sessions
+                if title is not None
+            ]
+            return len(titles), store.round_trips.count
+
+        timing = measure(run, fake.store, repeat)
+        num_sessions, round_trips = timing["last"]
+        results.append(
+            make_result(
+                "user_sessions",
+                "sidebar",
+                size,
+                "users",
+                timing,
+                sessions=num_sessions,
+                round_trips=round_trips,
+            )
+        )
+
+        if size <= BASELINE_MAX_SIZE["user_sessions"]:
+            timing = measure(
+                lambda _: len(
+                    baseline_user_sessions(
+                        fake.client(ACCESS_TIME_DB), client, codec.cipher, "user0", since
+                    )
+                ),
+                repeat=repeat,
+            )
+            results.append(
+                make_result(
+                    "user_sessions", "baseline", size, "users", timing, sessions=timing["last"]
+                )
+            )
+    return results
+
+
+def bench_csv_export(
+    sizes: List[int], repeat: int, codec: StorageCodec, turns_per_session: int = 5
+) -> List[Dict[str, Any]]:
+    """
+    redisCliChatDataのキー数に対するCSVエクスポートの時間。
+    プロンプトは差分形式で記録し、エクスポート時にセッションのメッセージから復元する。
+    scan     : 期間を指定しない(SCAN)
+    period   : 期間を指定する("access"の索引)
+    baseline : 改善前の、KEYSとキー毎のHGETALLでCSV全体を作る処理。プロンプトは旧形式の会話全体。
+    改善後は差分形式のプロンプトを復号して復元する分だけ1行あたりの処理が多く、速さではなく
+    KEYSでRedisを止めないことと、CSV全体をメモリに持たないことが改善点である。
+    """
+    legacy_codec = StorageCodec(codec.cipher, write_version=LEGACY_VERSION)
+    results = []
+    now = time.time()
+    for size in sizes:
+        fake = FakeRedisServer()
+        legacy = FakeRedisServer()
+        messages_pipe = fake.client(MESSAGES_DB).pipeline(transaction=False)
+        chat_data_pipe = fake.client(CHAT_DATA_DB).pipeline(transaction=False)
+        access_pipe = fake.client(ACCESS_TIME_DB).pipeline(transaction=False)
+        legacy_pipe = legacy.client(CHAT_DATA_DB).pipeline(transaction=False)
+        for s in range((size + turns_per_session - 1) // turns_per_session):
+            session_id = f"user{s % 20}_{s:0>20}"
+            history = fake_history(2 * turns_per_session)
+            messages_pipe.rpush(
+                session_id, *(codec.encode_message(message) for message in history)
+            )
+            for t in range(turns_per_session):
+                position = 2 * t + 1
+                messages_id = f"{session_id}_{position:0>6}"
+                timestamp = now - s
+                chat_data_pipe.hset(
+                    messages_id,
+                    mapping={
+                        "prompt": codec.encode_record(
+                            user_id=f"user{s % 20}",
+                            model=MODEL,
+                            timestamp=timestamp,
+                            num_tokens=100,
+                            messages=compact_json(history[position - 1 : position]),
+                            history_range=(0, position - 1),
+                        ),
+                        "response": codec.encode_record(
+                            user_id=f"user{s % 20}",
+                            model=MODEL,
+                            timestamp=timestamp,
+                            num_tokens=50,
+                            messages=history[position]["content"],
+                        ),
+                    },
+                )
+                access_pipe.zadd("access", {messages_id: timestamp})
+                legacy_pipe.hset(
+                    messages_id,
+                    mapping={
+                        "prompt": legacy_codec.encode_record(
+                            user_id=f"user{s % 20}",
+                            model=MODEL,
+                            timestamp=timestamp,
+                            num_tokens=100,
+                            messages=json.dumps(history[:position]),
+                        ),
+                        "response": legacy_codec.encode_record(
+                            user_id=f"user{s % 20}",
+                            model=MODEL,
+                            timestamp=timestamp,
+                            num_tokens=50,
+                            messages=history[position]["content"],
+                        ),
+                    },
+                )
+        messages_pipe.execute()
+        chat_data_pipe.execute()
+        access_pipe.execute()
+        legacy_pipe.execute()
+
+        for case, period in (("scan", {}), ("period", {"since": 0, "until": now + 1})):
+
+            def run(_):
+                return sum(
+                    1
+                    for _ in iter_chat_data_csv(
+                        fake.client(CHAT_DATA_DB),
+                        fake.client(ACCESS_TIME_DB),
+                        codec=codec,
+                        messages_client=fake.client(MESSAGES_DB),
+                        **period,
+                    )
+                )
+
+            timing = measure(run, repeat=repeat)
+            results.append(
+                make_result("csv_export", case, size, "keys", timing, lines=timing["last"])
+            )
+
+        if size <= BASELINE_MAX_SIZE["csv_export"]:
+            timing = measure(
+                lambda _: baseline_csv_export(legacy.client(CHAT_DATA_DB)), repeat=repeat
+            )
+            results.append(make_result("csv_export", "baseline", size, "keys", timing))
+    return results
+
+
+def git_commit() -> Optional[str]:
+    """ベンチマークを実行したコミットのハッシュ。gitが無ければNone。"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    names: List[str], sizes: Dict[str, List[int]], repeat: int
+) -> Dict[str, Any]:
+    """namesのベンチマークを実行し、実行環境の情報と結果を返す。"""
+    codec = StorageCodec(Fernet(ENCRYPT_KEY))
+    benchmarks = {
+        "trim_tokens": lambda: bench_trim_tokens(sizes["trim_tokens"], repeat),
+        "stream_write": lambda: bench_stream_write(sizes["stream_write"], repeat, codec),
+        "usage": lambda: bench_usage(sizes["usage"], repeat, codec),
+        "user_sessions": lambda: bench_user_sessions(sizes["user_sessions"], repeat, codec),
+        "csv_export": lambda: bench_csv_export(sizes["csv_export"], repeat, codec),
+    }
+    results = []
+    for name in names:
+        print(f"running {name} ...", file=sys.stderr)
+        results.extend(benchmarks[name]())
+    return {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "fakeredis": fakeredis.__version__,
+            "repeat": repeat,
+        },
+        "results": results,
+        "speedups": speedups(results),
+    }
+
+
+# baselineと比べる改善後のケース
+IMPROVED_CASES = {
+    "trim_tokens": ["cold", "warm"],
+    "stream_write": ["flush"],
+    "usage": ["read"],
+    "user_sessions": ["sidebar"],
+    "csv_export": ["scan", "period"],
+}
+
+
+def speedups(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """同じ項目とサイズのbaselineと改善後のケースの中央値の比(baseline / 改善後)。"""
+    baselines = {
+        (r["name"], r["size"]): r["median"] for r in results if r["case"] == "baseline"
+    }
+    return [
+        {
+            "name": r["name"],
+            "case": r["case"],
+            "size": r["size"],
+            "speedup": baselines[(r["name"], r["size"])] / r["median"],
+        }
+        for r in results
+        if r["case"] in IMPROVED_CASES.get(r["name"], ())
+        and (r["name"], r["size"]) in baselines
+        and r["median"]
+    ]
+
+
+def compare(
+    current: Dict[str, Any], previous: Dict[str, Any], max_ratio: float
+) -> List[Dict[str, Any]]:
+    """
+    (name, case, size)が同じ結果の中央値の比(今回 / 前回)を表示する。
+
+    戻り値:
+        List[Dict[str, Any]]: 比がmax_ratioを超えた結果。
+    """
+    previous_results = {
+        (r["name"], r["case"], r["size"]): r for r in previous["results"]
+    }
+    regressions = []
+    for result in current["results"]:
+        key = (result["name"], result["case"], result["size"])
+        if key not in previous_results or not previous_results[key]["median"]:
+            continue
+        ratio = result["median"] / previous_results[key]["median"]
+        mark = " <- slower" if ratio > max_ratio else ""
+        print(f"{'/'.join(map(str, key)):<32} {ratio:6.2f}x{mark}")
+        if ratio > max_ratio:
+            regressions.append({**result, "ratio": ratio})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="fakeredisと偽のプロバイダーでチャットの処理の時間を計り、JSONに書き出す。"
+    )
+    parser.add_argument("--output", default="bench.json", help="結果を書き出すJSONファイル。")
+    parser.add_argument(
+        "--only", nargs="+", choices=list(SIZES), default=list(SIZES), help="実行するベンチマーク。"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="1項目あたりの繰り返し回数。")
+    parser.add_argument("--quick", action="store_true", help="小さいサイズだけで実行する。")
+    parser.add_argument("--compare", help="比べる前回の結果のJSONファイル。")
+    parser.add_argument(
+        "--max-ratio", type=float, default=1.5, help="前回の中央値の何倍を超えたら遅くなったとするか。"
+    )
+    args = parser.parse_args()
+    if fakeredis is None:
+        sys.exit("fakeredisが必要です。pip install fakeredis[lua] を実行してください。")
+    os.environ.setdefault("TZ", "Asia/Tokyo")
+
+    report = run_benchmarks(args.only, QUICK_SIZES if args.quick else SIZES, args.repeat)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    for result in report["results"]:
+        print(
+            f"{result['name']:<14} {result['case']:<8} {result['size']:>6} {result['unit']:<13}"
+            f" median {result['median'] * 1000:9.3f} ms"
+        )
+    for speedup in report["speedups"]:
+        print(
+            f"{speedup['name']:<14} {speedup['case']:<8} {speedup['size']:>6}"
+            f" baseline / {speedup['case']} {speedup['speedup']:8.2f}x"
+        )
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.max_ratio)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,256 @@
+"""
+redisCliChatDataのCSVエクスポート。
+
+KEYSで全キーを取得したり、CSV全体をメモリ上に作ったりせずに、
+SCAN(期間を指定した場合は"access"の索引)でキーを少しずつ取得し、
+パイプラインでまとめたHGETALLの結果を1行ずつエンコードしたCSVとして返す。
+差分形式のプロンプトの記録は、redisCliMessagesのセッションのメッセージから全体を復元して出力する。
+
+streamlitのコンテナで
+    python chat_export.py --since 2024-04-01 --until 2024-05-01 --user <USER_ID> > chat_data.csv
+のように実行するとファイルに書き出せる。
+"""
+
+import argparse, csv, datetime, io, json, os, sys
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import pytz
+import redis
+
+from storage_codec import StorageCodec, codec_from_env, read_record_metadata
+
+FIELDNAMES = [
+    "messages_id",
+    "kind",
+    "USER_ID",
+    "model",
+    "timestamp",
+    "messages",
+    "num_tokens",
+]
+
+
+# Unixタイムスタンプをローカルタイムに変換する関数
+def unixtime_to_localtime(unixtime):
+    utc_time = datetime.datetime.utcfromtimestamp(unixtime)
+    local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(
+        pytz.timezone(os.environ["TZ"])
+    )  # Noneを指定するとローカルタイムゾーンに変換される
+    formatted_time = local_time.strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )  # エクセルでも扱いやすい形式にフォーマット
+    return formatted_time
+
+
+def session_id_of(messages_id: bytes) -> bytes:
+    """
+    messages_id(f"{USER_ID}_{時刻:0>20}_{番号:0>6}")のsession_idの部分を返す。
+    ファンアウトで比べたモデルの記録は末尾にf"_{モデルの順番:0>2}"が付くため、前から2つまでを使う。
+    """
+    return b"_".join(messages_id.split(b"_", 2)[:2])
+
+
+def iter_messages_ids(
+    chat_data_client: redis.Redis,
+    access_client: Optional[redis.Redis] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    user_id: Optional[str] = None,
+    batch_size: int = 500,
+) -> Iterator[List[bytes]]:
+    """
+    エクスポートするmessages_idをbatch_size件程度ずつ返す。
+
+    期間を指定しない場合はredisCliChatDataをSCANする。期間を指定した場合は
+    "access"の索引をスコア(unixtime)の範囲でページングし、その期間に始まった
+    セッションのタイトル生成の記録(f"{session_id}_000000")も含める。
+    messages_idはUSER_IDで始まるため、ユーザーの絞り込みはHGETALLの前に行う。
+    """
+    if since is None and until is None:
+        match = f"{user_id}_*" if user_id else None
+        batch: List[bytes] = []
+        for messages_id in chat_data_client.scan_iter(match=match, count=batch_size):
+            batch.append(messages_id)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    if access_client is None:
+        raise ValueError("期間を指定する場合はaccess_clientが必要です。")
+    prefix = f"{user_id}_".encode() if user_id else b""
+    offset = 0
+    while True:
+        page: List[bytes] = access_client.zrangebyscore(
+            "access",
+            "-inf" if since is None else since,
+            "+inf" if until is None else f"({until}",
+            start=offset,
+            num=batch_size,
+        )
+        if not page:
+            return
+        offset += len(page)
+        batch = []
+        for messages_id in page:
+            if not messages_id.startswith(prefix):
+                continue
+            # セッションの最初のメッセージならタイトル生成の記録も含める
+            if messages_id.endswith(b"_000001"):
+                batch.append(messages_id[: -len(b"000001")] + b"000000")
+            batch.append(messages_id)
+        if batch:
+            yield batch
+
+
+def iter_chat_data_rows(
+    chat_data_client: redis.Redis,
+    messages_id_batches: Iterable[List[bytes]],
+    codec: Optional[StorageCodec] = None,
+    messages_client: Optional[redis.Redis] = None,
+) -> Iterator[Dict[str, str]]:
+    """
+    messages_idのバッチ毎にHGETALLをパイプラインで1往復にまとめ、CSVの行を返す。
+    差分形式のプロンプトの記録があれば、そのセッションのメッセージの範囲もLRANGEの
+    パイプラインで1往復にまとめて読み、全体を復元する。セッションのメッセージが既に
+    無いなどで復元できない記録のmessagesは空にする。
+    codecを省略すると旧形式の記録しか読めない。
+    """
+    for batch in messages_id_batches:
+        pipe = chat_data_client.pipeline(transaction=False)
+        for messages_id in batch:
+            pipe.hgetall(messages_id)
+        records = [
+            (messages_id, kind, value)
+            for messages_id, data in zip(batch, pipe.execute())
+            for kind, value in data.items()
+        ]
+
+        # 差分形式のプロンプトが参照するセッションのメッセージを読む
+        histories: Dict[int, List[bytes]] = {}
+        if messages_client is not None:
+            history_pipe = messages_client.pipeline(transaction=False)
+            history_indexes: List[int] = []
+            for i, (messages_id, kind, value) in enumerate(records):
+                history_range = read_record_metadata(value).get("history_range")
+                if history_range is None:
+                    continue
+                start, stop = history_range
+                session_id = session_id_of(messages_id)
+                history_pipe.lrange(session_id, start, stop - 1)
+                history_indexes.append(i)
+            if history_indexes:
+                histories = dict(zip(history_indexes, history_pipe.execute()))
+
+        for i, (messages_id, kind, value) in enumerate(records):
+            if codec is None:
+                value_dict = json.loads(value)
+            else:
+                try:
+                    value_dict = codec.decode_record(value, histories.get(i))
+                except ValueError:
+                    value_dict = read_record_metadata(value)
+                    value_dict["messages"] = ""
+            yield {
+                "USER_ID": value_dict["USER_ID"],
+                "messages_id": messages_id.decode(),
+                "kind": kind.decode(),
+                "model": value_dict["model"],
+                "timestamp": unixtime_to_localtime(value_dict["timestamp"]),
+                # ここで ensure_ascii=False を設定
+                "messages": json.dumps(
+                    value_dict["messages"], ensure_ascii=False
+                ),  # 日本語がエスケープされずに出力される
+                "num_tokens": value_dict["num_tokens"],
+            }
+
+
+def iter_csv_bytes(
+    rows: Iterable[Dict[str, str]], encoding: str = "shift_jis"
+) -> Iterator[bytes]:
+    """ヘッダーと各行を1行ずつCSVにしてエンコードしたbytesを返す。"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDNAMES)
+
+    def take() -> bytes:
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line.encode(encoding, errors="replace")
+
+    writer.writeheader()
+    yield take()
+    for row in rows:
+        writer.writerow(row)
+        yield take()
+
+
+def iter_chat_data_csv(
+    chat_data_client: redis.Redis,
+    access_client: Optional[redis.Redis] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    user_id: Optional[str] = None,
+    batch_size: int = 500,
+    encoding: str = "shift_jis",
+    codec: Optional[StorageCodec] = None,
+    messages_client: Optional[redis.Redis] = None,
+) -> Iterator[bytes]:
+    """
+    redisCliChatDataの記録をCSVとして1行ずつ返す。
+
+    引数:
+        chat_data_client (redis.Redis): redisCliChatDataのクライアント。
+        access_client (redis.Redis, optional): "access"の索引があるredisCliAccessTimeのクライアント。期間を指定する場合に必要。
+        since (float, optional): この時刻(unixtime)以降の記録に絞る。
+        until (float, optional): この時刻(unixtime)より前の記録に絞る。
+        user_id (str, optional): このUSER_IDの記録に絞る。
+        batch_size (int): SCANやページングとパイプラインの1回あたりの件数。
+        encoding (str): CSVのエンコーディング。
+        codec (StorageCodec, optional): 記録を読むコーデック。省略すると旧形式の記録しか読めない。
+        messages_client (redis.Redis, optional): 差分形式のプロンプトを復元するredisCliMessagesのクライアント。
+
+    戻り値:
+        Iterator[bytes]: エンコードされたCSVの行。
+    """
+    batches = iter_messages_ids(
+        chat_data_client,
+        access_client,
+        since=since,
+        until=until,
+        user_id=user_id,
+        batch_size=batch_size,
+    )
+    return iter_csv_bytes(
+        iter_chat_data_rows(chat_data_client, batches, codec, messages_client),
+        encoding,
+    )
+
+
+def parse_date(date: str) -> float:
+    """YYYY-MM-DDのローカル日付の深夜0時をunixtimeにする。"""
+    return datetime.datetime.strptime(date, "%Y-%m-%d").timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="redisCliChatDataをShift-JISのCSVとして標準出力に書き出す。"
+    )
+    parser.add_argument("--since", help="この日付(YYYY-MM-DD)以降の記録に絞る。")
+    parser.add_argument("--until", help="この日付(YYYY-MM-DD)より前の記録に絞る。")
+    parser.add_argument("--user", help="このUSER_IDの記録に絞る。")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    for line in iter_chat_data_csv(
+        redis.Redis(host="redis", port=6379, db=5),
+        redis.Redis(host="redis", port=6379, db=3),
+        since=parse_date(args.since) if args.since else None,
+        until=parse_date(args.until) if args.until else None,
+        user_id=args.user,
+        batch_size=args.batch_size,
+        codec=codec_from_env(),
+        messages_client=redis.Redis(host="redis", port=6379, db=0),
+    ):
+        sys.stdout.buffer.write(line)
@@ -1,18 +1,45 @@
 # %%
 
+import time
+
+# 再実行にかかる時間の計測の開始。importの時間も含める。
+rerun_started_at = time.perf_counter()
+
 import streamlit as st
 from streamlit.web.server.websocket_headers import _get_websocket_headers
-import pytz, re, logging, csv, io, openai, os, redis, time, json, tiktoken, datetime, hashlib, jwt, anthropic
+import pytz, re, logging, csv, io, os, redis, json, datetime, hashlib, jwt
 from logging.handlers import TimedRotatingFileHandler
-from bokeh.models.widgets import Div
-from typing import Union, Literal, Tuple, Set, Any, List, Generator, Iterable, Dict
-from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Literal, Tuple, Set, Any, List, Generator, Iterable, Dict, Callable
 from collections import Counter
 from cryptography.fernet import Fernet
 import httpx, traceback
-from litellm import completion, token_counter
-from anthropic import Anthropic
-anthropic_client = Anthropic()
+from model_clients import (
+    completion,
+    token_counter,
+    get_anthropic_client,
+    HttpClientPool,
+    configure_http_pool,
+    http_pool_stats,
+)
+from token_cache import TokenCountCache
+from stream_writer import StreamingResponseWriter, IncrementalTokenCounter, read_chunk
+from usage_counter import calc_cost, record_usage
+from chat_export import iter_chat_data_csv
+from rate_limiter import RateLimiter
+from admission_queue import AdmissionQueue
+from chat_store import ChatStore, get_redis, user_sessions_key, CACHE_DB, ACCESS_TIME_DB
+from history_cache import HistoryCache
+from background_jobs import BackgroundJobQueue
+from response_cache import ResponseCache, parse_stats, stats_summary
+from storage_codec import StorageCodec, compact_json
+from message_tokens import MessageTokenCounter, truncate_middle_to_tokens
+from fanout import FanOut
+from model_router import LatencyTracker, ModelRouter
+import turn_metrics
+
+# この再実行での処理時間の計測。やり取りが完了したらメトリクスとしてRedisに加算する。
+current_turn_metrics = turn_metrics.TurnMetrics()
+turn_metrics.activate(current_turn_metrics)
 
 hide_deploy_button_style = """
 <style>
@@ -22,50 +49,19 @@ hide_deploy_button_style = """
 st.markdown(hide_deploy_button_style, unsafe_allow_html=True)
 
 
-def trim_tokens(
-    messages: List[dict],
-    max_tokens: int,
-    model: str = "gpt-3.5-turbo-0301",
-) -> List[dict]:
-    """
-    メッセージのトークン数が指定した最大トークン数を超える場合、
-    メッセージの先頭から順に削除し、トークン数を最大トークン数以下に保つ。
-
-    引数:
-        messages (List[dict]): メッセージのリスト。
-        max_tokens (int): 最大トークン数。
-        model (str): モデル名（デフォルトは'gpt-3.5-turbo-0301'）。
-
-    戻り値:
-        List[dict]: トークン数が最大トークン数以下になったメッセージのリスト。
-    """
-    # 無限ループを開始
-    while True:
-        # 現在のメッセージのトークン数を計算
-        total_tokens = calc_token_tiktoken(
-            str(messages), model=model
-        )
-        # トークン数が最大トークン数以下になった場合、ループを終了
-        if total_tokens <= max_tokens:
-            break
-        # トークン数が最大トークン数を超えている場合、メッセージの先頭を削除
-        messages.pop(0)
-        
-        # messagesの長さが0になったらエラー
-        if len(messages) == 0:
-            raise ValueError("与えられたmessageはmax_tokens以下になりません。")
-        
-
-    # 修正されたメッセージ���リストを返す
-    return messages
-
-
 def response_chatmodel(
     messages: List[dict],
     model: str,
     stream: bool,
     max_tokens: int,
     custom_instruction: str = "",
+    token_index: Dict[Tuple[str, str], int] = None,
+    usage: Dict[str, int] = None,
+    input_max_tokens: int = None,
+    use_cache: bool = False,
+    fallback_model: str = None,
+    route: Dict[str, Any] = None,
+    messages_id: str = None,
 ) -> Tuple[Generator, List[dict]]:
     """
     指定されたモデル(OpenAIまたはAnthropic)からのレスポンスを取得します。
@@ -75,37 +71,54 @@ def response_chatmodel(
         model (str): 使用するモデル名。
         stream (bool): ストリーム処理するか。
         max_tokens (int): 生成するトークンの最大数。
+        custom_instruction (str): 最後のメッセージの前に付加する指示。
+        token_index (Dict[Tuple[str, str], int]): メッセージ毎のトークン数の索引。
+        usage (Dict[str, int]): ストリームの最後にプロバイダーが返したトークン数を書き込む辞書。
+        input_max_tokens (int): 入力の最大トークン数。省略するとINPUT_MAX_TOKENS。
+        use_cache (bool): 応答キャッシュを使うか。ヒットした場合はusage["cached"]に1が書き込まれる。
+        fallback_model (str): ストリームで、最初のチャンクが遅いか失敗した場合にヘッジするモデル。
+            省略するとmodelだけを呼ぶ(呼び出しのTTFTと失敗はどちらでもmodel_routerに残す)。
+        route (Dict[str, Any]): 実際に応答したモデル名を"model"に書き込む辞書。
+        messages_id (str): ヘッジで閉じたモデルのプロンプトを記録するメッセージID。
     戻り値:
         response: モデルからのレスポンス。
-        trimed_messages: トークン数を調整した後のメッセージリスト。
+        trimed_messages: トークン数を調整した後のメッセージリスト。ヘッジでフォールバックのモデルが
+            応答した場合は、そのモデルに送ったメッセージリスト。
     """
-    # logger.debug(role(user_msg))
-    logger.debug(f"trim_tokens前のmessages: {messages}")
-    logger.debug(
-        f"trim_tokens前のmessagesのトークン数: {calc_token_tiktoken(str(messages))}"
-    )
-    # logger.debug(f"trim_tokens前のmessages_role: {type(messages)}")
-    # 設定により、custorm_instructionを必要ならば付加する。
-    if custom_instruction:
-        messages[-1]["content"] = custom_instruction + "\n" + messages[-1]["content"]
-        logger.debug(
-            f"custom_instruction付加後のmessagesのmessagesのトークン数: {calc_token_tiktoken(str(messages))}")
-    trimed_messages: List[dict] = trim_tokens(messages, INPUT_MAX_TOKENS, model=model)
-    logger.debug(f"trim_tokens後のmessages: {str(messages)}")
-    logger.debug(
-        f"trim_tokens後のmessagesのトークン数: {calc_token_tiktoken(str(messages))}"
+    trimed_messages = trim_messages_for_model(
+        messages,
+        model,
+        custom_instruction=custom_instruction,
+        token_index=token_index,
+        input_max_tokens=input_max_tokens,
     )
 
     try:
         logger.info(
             f"Sending request to OpenAI API with messages: {messages}, model : {model}"
         )
-        response = common_message_function(
-                model=model,
-                messages=trimed_messages,
-                stream=stream,
-                max_tokens=max_tokens,
+        if stream:
+            response = route_message_stream(
+                model,
+                fallback_model,
+                trimed_messages,
+                max_tokens,
+                usage=usage,
+                use_cache=use_cache,
+                route=route,
+                messages_id=messages_id,
             )
+            if route is not None:
+                trimed_messages = route.get("messages", trimed_messages)
+        else:
+            response = common_message_function(
+                    model=model,
+                    messages=trimed_messages,
+                    stream=stream,
+                    max_tokens=max_tokens,
+                    usage=usage,
+                    use_cache=use_cache,
+                )
 
 
     except Exception as e:
@@ -115,6 +128,50 @@ def response_chatmodel(
     return response, trimed_messages
 
 
+def trim_messages_for_model(
+    messages: List[dict],
+    model: str,
+    custom_instruction: str = "",
+    token_index: Dict[Tuple[str, str], int] = None,
+    input_max_tokens: int = None,
+) -> List[dict]:
+    """
+    custom_instructionを付加し、最大トークン数に収まるようにメッセージをトリムする。
+    ファンアウトでは、全てのモデルに送る1つのプロンプトをこれで作る。
+    引数はresponse_chatmodelと同じ。
+
+    戻り値:
+        List[dict]: トークン数を調整した後のメッセージリスト。
+    """
+    if token_index is None:
+        token_index = {}
+    # logger.debug(role(user_msg))
+    logger.debug(f"trim_tokens前のmessages: {messages}")
+    logger.debug(
+        f"trim_tokens前のmessagesのトークン数: {sum_message_tokens(messages, model, token_index)}"
+    )
+    # logger.debug(f"trim_tokens前のmessages_role: {type(messages)}")
+    if input_max_tokens is None:
+        input_max_tokens = INPUT_MAX_TOKENS
+    # 設定により、custorm_instructionを必要ならば付加する。
+    # 付加してからトリムするので、custom_instructionもモデルのトークナイザーで数えられる。
+    if custom_instruction:
+        messages[-1]["content"] = custom_instruction + "\n" + messages[-1]["content"]
+        logger.debug(
+            f"custom_instruction付加後のmessagesのmessagesのトークン数: {sum_message_tokens(messages, model, token_index)}")
+    with turn_metrics.measure("trim_seconds"):
+        trimed_messages: List[dict] = trim_tokens(
+            messages,
+            input_max_tokens,
+            model=model,
+            token_index=token_index,
+        )
+    trimed_tokens: int = sum_message_tokens(messages, model, token_index)
+    logger.debug(f"trim_tokens後のmessages: {str(messages)}")
+    logger.debug(f"trim_tokens後のmessagesのトークン数: {trimed_tokens}")
+    return trimed_messages
+
+
 def calc_token_tiktoken(
     chat: str, model: str = "claude-3-haiku-20240307"
 ) -> int:
@@ -125,51 +182,206 @@ def calc_token_tiktoken(
     
     # model: 使用するAIモデルの名前。この引数は、特定のAIモデルに対応するエンコーディングを自動で選択するために使用されます。
     # 例えば 'gpt-3.5-turbo-0301' というモデル名を指定すれば、そのモデルに適したエンコーディングが選ばれます。
+
+    # 同じテキストは(モデル名, ハッシュ)をキーとしたキャッシュから返し、一度しか計算しない。
+    """
+    with turn_metrics.measure("tokenize_seconds"):
+        return token_count_cache.count(str(chat), model, count_tokens_uncached)
+
+
+def count_tokens_uncached(chat: str, model: str) -> int:
+    """
+    キャッシュを使わずにトークン数を計算する。claudeのモデルはAnthropicのAPIで、
+    それ以外はlitellmのtoken_counterで計算する。
     """
-    chat = str(chat)
-    
     if 'claude' in model:
-        return anthropic_client.count_tokens(chat)
+        return get_anthropic_client().count_tokens(chat)
     else:
         return token_counter(model=model, text=chat)
 
 
 
+def build_rate_limits(
+    model: str, num_tokens: int = 0
+) -> Tuple[List[Tuple[str, int, float]], List[Tuple[str, int, float, int]], List[str]]:
+    """
+    Builds the rate limits that apply to a request from LATE_LIMIT and AVAILABLE_MODELS.
+
+    LATE_LIMIT: {"COUNT", "PERIOD"} is the global request limit. Optional keys are
+    "USER_COUNT"/"USER_PERIOD" (requests per user) and "TOKENS"/"TOKENS_PERIOD"
+    (tokens for the whole team, per 60 seconds by default).
+    AVAILABLE_MODELS[model]["LATE_LIMIT"] may set the same "COUNT"/"PERIOD" and
+    "TOKENS"/"TOKENS_PERIOD" keys for a single model.
+    The per-user and per-model limits are the request's own limits: requests waiting ahead
+    in the admission queue only hold back the global limits (see rate_limiter.py).
+
+    Args:
+        model (str): The model name.
+        num_tokens (int, optional): The estimated number of tokens the request uses.
+
+    Returns:
+        Tuple[list, list, list]: The sliding windows (name, limit, period), the token buckets
+            (name, capacity, period, cost) and the names of the request's own limits.
+    """
+    windows = [("global", LATE_LIMIT_COUNT, LATE_LIMIT_PERIOD)]
+    buckets = []
+    if "USER_COUNT" in LATE_LIMIT:
+        windows.append(
+            (
+                f"user:{USER_ID}",
+                LATE_LIMIT["USER_COUNT"],
+                LATE_LIMIT.get("USER_PERIOD", LATE_LIMIT_PERIOD),
+            )
+        )
+    if "TOKENS" in LATE_LIMIT:
+        buckets.append(
+            ("tokens", LATE_LIMIT["TOKENS"], LATE_LIMIT.get("TOKENS_PERIOD", 60), num_tokens)
+        )
+    model_limit: dict = AVAILABLE_MODELS[model].get("LATE_LIMIT", {})
+    if "COUNT" in model_limit:
+        windows.append(
+            (
+                f"model:{model}",
+                model_limit["COUNT"],
+                model_limit.get("PERIOD", LATE_LIMIT_PERIOD),
+            )
+        )
+    if "TOKENS" in model_limit:
+        buckets.append(
+            (
+                f"tokens:{model}",
+                model_limit["TOKENS"],
+                model_limit.get("TOKENS_PERIOD", 60),
+                num_tokens,
+            )
+        )
+    own_limits = [
+        name for name, *_ in windows + buckets if name.startswith(("user:", "model:", "tokens:"))
+    ]
+    return windows, buckets, own_limits
+
+
 def check_rate_limit_exceed(
     redis_client: redis.Redis,
-    key_name: str = "access",
-    late_limit: int = 1,
-    late_limit_period: float = 1.0,
+    model: str,
+    num_tokens: int = 0,
+    member: str = "",
 ) -> bool:
     """
-    Checks if the rate limit exceeds for a given period.
+    Checks every rate limit for a request and, only if none is exceeded, records it.
+    The check and the record are done atomically in one round trip by a Lua script,
+    so concurrent sessions cannot both pass the last free slot.
 
     Args:
         redis_client (redis.Redis): The Redis client object.
-        key_name : Redis client key name.
-        late_limit (int, optional): The maximum number of access data within a certain period. Defaults to 1.
-        late_limit_period (float, optional): The period in seconds. If the number of access data within this period is less than `late_limit`, the data from the previous day is also retrieved. Defaults to 1.0.
+        model (str): The model name the request is sent to.
+        num_tokens (int, optional): The estimated number of tokens the request uses.
+        member (str, optional): A unique name of the request. Defaults to the current time in nanoseconds.
 
     Returns:
-        bool: True if the rate limit is exceeded, False otherwise.
+        bool: True if the rate limit is exceeded or other requests are waiting in the admission queue, False otherwise.
     """
-    # Get the current timestamp
-    now = time.time()
-    # Retrieve the access data for the current date from the Redis client
-    access_data = redis_client.zrangebyscore(
-        key_name,
-        now - late_limit_period,
-        "+inf",
+    windows, buckets, own_limits = build_rate_limits(model, num_tokens)
+    allowed, exceeded, retry_after = RateLimiter(redis_client).acquire(
+        member or f"{USER_ID}_{time.time_ns()}",
+        windows,
+        buckets,
+        admission=admission_queue,
+        own_limits=own_limits,
     )
+    if not allowed:
+        logger.debug(f"Rate limit exceeded: {exceeded} (retry after {retry_after:.3f}s)")
+    return not allowed
 
-    # Log the number of past access data
-    logger.debug(f"Number of past access data: {len(access_data)}")
-    # If the number of access data is less than the late limit, return False
-    if len(access_data) < late_limit:
-        return False
-    # Otherwise, return True
-    else:
-        return True
+
+def wait_for_admission(
+    redis_client: redis.Redis,
+    model: str,
+    num_tokens: int = 0,
+) -> None:
+    """
+    Passes the rate limits like check_rate_limit_exceed, but instead of rejecting the request
+    when they are exceeded, puts it in the admission queue and waits until the global limits have
+    room for it and the requests ahead of it, and its own per-user and per-model limits have room.
+    The position in the queue is shown while waiting.
+    Requests are ordered by weighted fair queueing across USER_IDs (see admission_queue.py),
+    and a waiter is dispatched atomically with the rate limit check. A waiter held by its own
+    limits does not hold back the waiters behind it.
+    Each waiter re-checks when its turn is expected (the head when the limits have room,
+    the others when the requests ahead of them are expected to have passed), at least every
+    ADMISSION_POLL_INTERVAL seconds.
+
+    This blocks the script thread while waiting. Pressing the cancel button (or any other
+    interaction) reruns the script; Streamlit stops this run at the next status update, so the
+    wait ends within ADMISSION_POLL_INTERVAL seconds and the ticket is removed from the queue.
+    The caller has to roll back anything it stored for the request on the next rerun.
+
+    Args:
+        redis_client (redis.Redis): The Redis client object.
+        model (str): The model name the request is sent to.
+        num_tokens (int, optional): The estimated number of tokens the request uses.
+
+    Raises:
+        Exception: If the queue is disabled or full, or the request waited ADMISSION_MAX_WAIT seconds.
+    """
+    windows, buckets, own_limits = build_rate_limits(model, num_tokens)
+    limiter = RateLimiter(redis_client)
+    ticket = AdmissionQueue.make_ticket(USER_ID)
+    allowed, exceeded, retry_after, position, length = limiter.acquire_queued(
+        ticket, windows, buckets, admission=admission_queue, own_limits=own_limits
+    )
+    if allowed:
+        return
+    logger.debug(f"Rate limit exceeded: {exceeded} (retry after {retry_after:.3f}s)")
+    queued = (
+        admission_queue.enqueue(ticket, USER_ID, ADMISSION_USER_WEIGHTS.get(USER_ID, 1.0))
+        if admission_queue is not None
+        else None
+    )
+    if queued is None:
+        raise Exception(
+            "アクセス数が多いため、接続できません。しばらくお待ちください。"
+        )
+    position, length = queued
+    deadline = time.monotonic() + ADMISSION_MAX_WAIT
+    status_area = st.empty()
+    cancel_area = st.empty()
+    cancel_area.button("順番待ちをやめる", key=f"admission_cancel_{ticket}")
+    try:
+        with turn_metrics.measure("admission_wait_seconds"):
+            while True:
+                status_area.info(
+                    "アクセス数が多いため、順番待ちをしています。"
+                    + (f"あと{position}人で順番です。" if position else "次の順番です。")
+                    + f"(待っている人数 : {length})"
+                )
+                # 列の先頭は制限に空きができる時刻に、それ以外は前の待ちが通ると見込まれる時刻に確認し直す。
+                # 見込みの時刻が過ぎていても、後ろの待ちほど間隔を空けて確認が集中しないようにする
+                time.sleep(
+                    max(
+                        min(retry_after, ADMISSION_POLL_INTERVAL, deadline - time.monotonic()),
+                        min(
+                            ADMISSION_MIN_POLL_INTERVAL * max(1, position),
+                            ADMISSION_POLL_INTERVAL,
+                        ),
+                    )
+                )
+                allowed, exceeded, retry_after, position, length = limiter.acquire_queued(
+                    ticket, windows, buckets, admission=admission_queue, own_limits=own_limits
+                )
+                if allowed:
+                    logger.debug(f"admitted from the queue : {ticket}")
+                    return
+                if position < 0 or time.monotonic() >= deadline:
+                    raise Exception(
+                        "アクセス数が多いため、接続できませんでした。しばらくお待ちください。"
+                        f"({ADMISSION_MAX_WAIT:.0f}秒待ちました)"
+                    )
+    finally:
+        status_area.empty()
+        cancel_area.empty()
+        if not allowed:
+            admission_queue.cancel(ticket)
 
 
 def initialize_logger(user_id=""):
@@ -252,9 +464,10 @@ def initialize_logger(user_id=""):
     # ログファイルの日付形式を設定します
     file_handler.suffix = "%Y-%m-%d"
 
-    # ロガーにハンドラを追加します
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    # ロガーにハンドラを追加します。ロガーはプロセスで共有されるため、追加するのは最初の1回だけにします
+    if not logger.handlers:
+        logger.addHandler(console_handler)
+        logger.addHandler(file_handler)
 
     # ユーザーIDが指定された場合、カスタムロガーを返します
     if user_id:
@@ -264,18 +477,6 @@ def initialize_logger(user_id=""):
         return logger
 
 
-# ユーザーのログイン処理を行う関数
-def login_check(login_time: float) -> None:
-    """
-    ユーザーのログイン状態を確認し、必要に応じてログイン処理を行う関数。
-
-    引数:
-        login_time (float): ユーザーがログインした時間（UNIX時間）。
-    """
-    # 最後のアクセスログが存在しない場合、ログイン時間を登録
-    redisCliUserAccess.zadd(USER_ID, {f"LOGIN_{login_time*10**9}": login_time})
-
-
 def jump_to_url(url: str, token: str = ""):
     """
     指定されたURLに新しいタブで移動する関数。
@@ -298,6 +499,9 @@ def jump_to_url(url: str, token: str = ""):
     # JavaScriptを組み合わせて新しいタブで指定されたURLを開く
     js_open_new_tab = f"window.location.replace('{url}')"
     html = '<img src onerror="{}">'.format(js_open_new_tab)
+    # bokehはimportに時間がかかるため、画面を移動するときだけimportする
+    from bokeh.models.widgets import Div
+
     div = Div(text=html)
     st.bokeh_chart(div)
 
@@ -346,42 +550,34 @@ def record_title_at_user_redis(
         "<以降メッセージ>"
     )
 
-    # メッセージの長さがタイトルモデルの最大長を超える場合、メッセージを省略
-    if (
-        len(first_message_content) + len(additional_message)
-        > TITLE_MODEL_CHAR_MAX_LENGTH
-    ):
-        half_message_length = int(
-            (TITLE_MODEL_CHAR_MAX_LENGTH - len(additional_message) - 3) / 2
-        )
-        message_for_title = (
-            additional_message
-            + first_message_content[:half_message_length]
-            + "..."
-            + first_message_content[-half_message_length:]
-        )
-    else:
-        message_for_title = additional_message + first_message_content
-
-    # タイトル生成のためのプロンプトを作成
+    # タイトル生成のためのプロンプトを作成する。メッセージがタイトルモデルの最大文字数や
+    # 最大トークン数を超える場合、メッセージの中央を省略する。
+    # トークン数の索引を共有するため、response_chatmodelでのトリムと記録するトークン数の計算では数え直さない。
+    title_token_index: Dict[Tuple[str, str], int] = {}
+    message_for_title, title_prompt_tokens = truncate_middle_to_tokens(
+        additional_message,
+        first_message_content,
+        TITLE_INPUT_MAX_TOKENS,
+        lambda content: sum_message_tokens(
+            [{"role": "user", "content": content}], TITLE_MODEL, title_token_index
+        ),
+        max_chars=TITLE_MODEL_CHAR_MAX_LENGTH,
+    )
     title_prompt = [{"role": "user", "content": message_for_title}]
 
-    # プロンプトのトークン数がタイトルモデルの最大トークン数を超える場合、プロンプトを削減
-    while INPUT_MAX_TOKENS < calc_token_tiktoken(str(title_prompt), model=TITLE_MODEL):
-        title_prompt[0]["content"] = title_prompt[0]["content"][:-1]
-
     # タイトルを生成
+    title_usage: Dict[str, int] = {}
     generated_title, title_prompt_trimed = response_chatmodel(
         title_prompt,
         model=TITLE_MODEL,
         stream=False,
         max_tokens=16,
+        token_index=title_token_index,
+        usage=title_usage,
+        input_max_tokens=TITLE_INPUT_MAX_TOKENS,
+        use_cache="title" in RESPONSE_CACHE_TARGETS,
     )
-
-    # プロンプトを暗号化
-    title_prompt_encrypted = cipher_suite.encrypt(
-        json.dumps(title_prompt_trimed).encode()
-    ).decode()
+    title_cached = bool(title_usage.get("cached"))
 
     # 生成されたタイトルから不要な文字を削除
     washed_title = re.sub(
@@ -389,156 +585,329 @@ def record_title_at_user_redis(
     )
     washed_title = washed_title if washed_title else generated_title
 
-    # 整形されたタイトルと生成されたタイトルを暗号化
+    # 整形されたタイトルを暗号化
     encrypted_washed_title = cipher_suite.encrypt(washed_title.encode())
-    encrypted_genarated_title_response = cipher_suite.encrypt(
-        json.dumps([{"role": "assistant", "content": generated_title}]).encode()
-    ).decode()
-
-    # ユーザーのタイトルをRedisに保存
-    redisCliTitleAtUser.hset(USER_ID, session_id, encrypted_washed_title)
 
     # メッセージIDを生成
     message_id = f"{session_id}_{0:0>6}"
 
-    # チャットデータをRedisに保存
-    redisCliChatData.hset(
-        message_id,
-        "prompt",
-        json.dumps(
-            {
-                "USER_ID": USER_ID,
-                "messages": title_prompt_encrypted,
-                "timestamp": timestamp,
-                "num_tokens": calc_token_tiktoken(
-                    str(title_prompt_trimed), model=TITLE_MODEL
-                ),
-                "model": TITLE_MODEL,
-            }
+    title_response_tokens = calc_token_tiktoken(generated_title, model=TITLE_MODEL)
+
+    # ユーザーのタイトルとチャットデータをRedisに保存し、コストを集計に加算する
+    # 別スレッドで動くため、往復回数は再実行のものとは別に数える
+    ChatStore().record_title(
+        user_id=USER_ID,
+        session_id=session_id,
+        title_encrypted=encrypted_washed_title,
+        messages_id=message_id,
+        # プロンプトと生成されたタイトルは圧縮・暗号化して保存する
+        prompt=storage_codec.encode_record(
+            user_id=USER_ID,
+            model=TITLE_MODEL,
+            timestamp=timestamp,
+            num_tokens=title_prompt_tokens,
+            messages=compact_json(title_prompt_trimed),
+            cached=title_cached,
         ),
-    )
-    redisCliChatData.expire(message_id, EXPIRE_TIME)
-    redisCliChatData.hset(
-        message_id,
-        "response",
-        json.dumps(
-            {
-                "USER_ID": USER_ID,
-                "messages": encrypted_genarated_title_response,
-                "timestamp": timestamp,
-                "num_tokens": calc_token_tiktoken(generated_title, model=TITLE_MODEL),
-                "model": TITLE_MODEL,
-            }
+        response=storage_codec.encode_record(
+            user_id=USER_ID,
+            model=TITLE_MODEL,
+            timestamp=timestamp,
+            num_tokens=title_response_tokens,
+            messages=compact_json([{"role": "assistant", "content": generated_title}]),
+            cached=title_cached,
         ),
+        usages=[
+            make_usage_record(
+                "prompt", TITLE_MODEL, title_prompt_tokens, timestamp, title_cached
+            ),
+            make_usage_record(
+                "response", TITLE_MODEL, title_response_tokens, timestamp, title_cached
+            ),
+        ],
+        expire_time=EXPIRE_TIME,
     )
 
     return washed_title
 
 
-def get_user_chats_within_last_several_days_sorted(days: int) -> list[tuple]:
+def make_usage_record(
+    kind: Literal["prompt", "response"],
+    model: str,
+    num_tokens: int,
+    timestamp: float,
+    cached: bool = False,
+) -> Dict[str, Any]:
     """
-    指定された日数以内のユーザーのチャットデータを取得し、タイムスタンプの降順でソートして返します。
+    プロンプトかレスポンスの記録1件分について、日毎の集計に加算する内容を作る。
 
-    Args:
-        days (int):  指定された日数。
+    引数:
+        kind (str): "prompt"か"response"。
+        model (str): モデル名。
+        num_tokens (int): トークン数。
+        timestamp (float): 記録のタイムスタンプ。
+        cached (bool): 応答キャッシュで返したか。Trueならコストは0にする。
 
-    Returns:
-        list[tuple]:  ユーザーのチャットデータのリスト。各チャットデータはタプルで、セッションIDとタイトルのペアです。
+    戻り値:
+        Dict[str, Any]: usage_counter.queue_usageに渡す引数。
+    """
+    try:
+        cost = 0 if cached else calc_cost(API_COST, model, kind)
+    except KeyError:
+        logger.error(f"{model} is not in available model!")
+        cost = 0
+    return {
+        "user_id": USER_ID,
+        "model": model,
+        "kind": kind,
+        "num_tokens": num_tokens,
+        "cost": cost,
+        "timestamp": timestamp,
+    }
+
+
+def record_model_prompt(
+    model: str,
+    session_id: str,
+    messages_id: str,
+    trimed_messages: List[dict],
+    prompt_record_messages: List[dict],
+    prompt_history_range: Tuple[int, int],
+    timestamp: float,
+    cached: bool = False,
+    assistant_placeholder: bytes = None,
+) -> int:
+    """
+    RedisにメッセージIDと'prompt'のキーで、モデル名、メッセージ、タイムスタンプ、トークン数を保存し、
+    "access"とユーザーのセッションの索引の更新、コストの集計、
+    セッションIDへのアシスタントのメッセージの追加を1往復で行う。
+
+    引数:
+        model (str): プロンプトを送ったモデル名。トークン数とコストはこのモデルで計算する。
+        session_id (str): セッションID。
+        messages_id (str): 記録するメッセージID。
+        trimed_messages (List[dict]): モデルに送ったトリム後のメッセージ。
+        prompt_record_messages (List[dict]): 記録に保存するメッセージ。
+        prompt_history_range (Tuple[int, int]): 差分形式での、前に付くセッションのメッセージの範囲。
+        timestamp (float): タイムスタンプ。
+        cached (bool): 応答キャッシュで返したか。
+        assistant_placeholder (bytes, optional): セッションに追加する暗号化された空のアシスタントのメッセージ。
+            省略するとセッションのメッセージには追加しない。
+
+    戻り値:
+        int: セッションIDに関連するメッセージの長さ。assistant_placeholderを省略した場合はNone。
+    """
+    prompt_tokens = sum_message_tokens(
+        trimed_messages, model, st.session_state["token_index"]
+    )
+    return store.record_prompt(
+        user_id=USER_ID,
+        session_id=session_id,
+        messages_id=messages_id,
+        prompt=storage_codec.encode_record(
+            user_id=USER_ID,
+            model=model,  #  使用するAIモデルの名前
+            timestamp=timestamp,  #  メッセージのタイムスタンプ
+            num_tokens=prompt_tokens,  #  トリムされたメッセージのトークン数
+            messages=compact_json(prompt_record_messages),  #  トリムされたメッセージのリスト。圧縮・暗号化される
+            history_range=prompt_history_range,  #  差分形式での、前に付くセッションのメッセージの範囲
+            cached=cached,  #  応答キャッシュで返したか。コストの集計を作り直すときに0として数える
+        ),
+        timestamp=timestamp,
+        assistant_placeholder=assistant_placeholder,
+        usage=make_usage_record("prompt", model, prompt_tokens, timestamp, cached),
+        expire_time=EXPIRE_TIME,
+    )
+
+
+def make_response_writer(
+    model: str,
+    session_id: str,
+    messages_id: str,
+    timestamp: float,
+    stream_usage: Dict[str, int],
+    message_index: int = None,
+) -> Callable[[str, bool], None]:
     """
+    StreamingResponseWriterに渡す、アシスタントのメッセージの書き込み関数を作る。
+
+    引数:
+        model (str): 応答したモデル名。トークン数とコストはこのモデルで計算する。
+        session_id (str): セッションID。
+        messages_id (str): レスポンスを記録するメッセージID。
+        timestamp (float): タイムスタンプ。
+        stream_usage (Dict[str, int]): ストリームの最後にプロバイダーが返したトークン数の受け取り先。
+        message_index (int, optional): 更新するセッションのメッセージの位置。
+            省略するとredisCliChatDataのレスポンスの記録だけを書き込む。
+
+    戻り値:
+        Callable[[str, bool], None]: その時点までの応答と、最後の書き込みかどうかを受け取る関数。
+    """
+    def count_delta_tokens(text: str) -> int:
+        # 差分は二度と同じテキストにならないので、token_count_cacheを通さずに数える
+        with turn_metrics.measure("tokenize_seconds"):
+            return count_tokens_uncached(text, model)
+
+    # 応答のトークン数は、書き込みの度に前回からの差分だけ数えて足していく
+    response_token_counter = IncrementalTokenCounter(count_delta_tokens)
+    assistant_messages: Dict[str, str] = {"role": "assistant", "content": ""}
+
+    def write_assistant_response(assistant_msg: str, final: bool) -> None:
+        """
+        その時点までのアシスタントのメッセージを暗号化し、
+        redisCliMessagesとredisCliChatDataに1往復で書き込む。
+        最後の書き込み(final)ではプロバイダーが返したトークン数があればそれで確定する。
+        """
+        if final:
+            num_tokens = response_token_counter.finalize(
+                assistant_msg, stream_usage.get("completion_tokens")
+            )
+        else:
+            num_tokens = response_token_counter.update(assistant_msg)
+        #  アシスタントのメッセージを更新
+        assistant_messages["content"] = assistant_msg
+        # roleも含まれたmessagesについても暗号化
+        assistant_messages_encrypted: bytes = (
+            storage_codec.encode_message(assistant_messages)
+            if message_index is not None
+            else None
+        )
+
+        #  セッションIDにアシスタントのメッセージを更新し、メッセージIDにアシスタントのレスポンスを保存
+        #  レスポンスのコストは最後の書き込みで1回だけ集計に加算する
+        store.write_response(
+            session_id=session_id if message_index is not None else None,
+            index=message_index,
+            message_encrypted=assistant_messages_encrypted,
+            messages_id=messages_id,
+            response=storage_codec.encode_record(
+                user_id=USER_ID,
+                model=model,  #   使用するAIモデルの名前
+                timestamp=timestamp,  #   メッセージのタイムスタンプ
+                num_tokens=num_tokens,  #   アシスタントのメッセージのトークン数
+                messages=assistant_msg,  #   アシスタントのメッセージ。圧縮・暗号化される
+                cached=bool(stream_usage.get("cached")),  #   応答キャッシュで返したか
+            ),
+            usage=(
+                make_usage_record(
+                    "response", model, num_tokens, timestamp, bool(stream_usage.get("cached"))
+                )
+                if final
+                else None
+            ),
+            expire_time=EXPIRE_TIME,
+        )
+
+    return write_assistant_response
+
+
+def several_days_ago_unixtime(days: int) -> int:
+    """指定日数前の深夜0時をUNIXタイムスタンプ（秒単位の時間）で返す。"""
     #  指定日数前の日時を取得し、その日の深夜0時を表すdatetimeオブジェクトを作成
     several_days_ago = datetime.datetime.now() - datetime.timedelta(days=days)
     several_days_ago_midnight = several_days_ago.replace(
         hour=0, minute=0, second=0, microsecond=0
     )
+    return int(several_days_ago_midnight.timestamp())
 
-    #  指定日数前の深夜0時をUNIXタイムスタンプ（秒単位の時間）に変換
-    several_days_ago_unixtime = int(several_days_ago_midnight.timestamp())
 
-    # Redisの"access"スコアレッドにおいて、指定日数前のUNIXタイムスタンプよりも大きいスコアを持つmessagesIDを取得
-    messages_id_with_chat_num_within_last_several_days: List[bytes] = (
-        redisCliAccessTime.zrangebyscore("access", several_days_ago_unixtime, "+inf")
+def backfill_user_sessions() -> bool:
+    """
+    セッションの索引が無いユーザーについて、タイトルのあるsession_idから索引を作る。
+    最終利用時刻は分からないため、session_idに含まれる作成時刻を使う。
+
+    Returns:
+        bool: 索引を作ったか。
+    """
+    session_ids: List[bytes] = redisCliTitleAtUser.hkeys(USER_ID)
+    if not session_ids:
+        return False
+    store.save_rerun_state(
+        user_id=USER_ID,
+        sessions_backfill={
+            session_id: int(session_id.decode().split("_")[-1]) / 10**9
+            for session_id in session_ids
+        },
     )
+    return True
 
-    #  取得したmessagesIDからsessionIDを抽出し、セットに格納
-    session_id_within_last_several_days: Set[str] = {
-        "_".join(id_num.decode().split("_")[:-1])
-        for id_num in messages_id_with_chat_num_within_last_several_days
-    }
 
-    # USER_IDについての、指定日数以内のsession_idとtitleを抽出し、辞書に格納
-    user_session_id_title_within_last_several_days: Dict[str, str] = {
-        session_id.decode(): cipher_suite.decrypt(title).decode()
-        for session_id, title in redisCliTitleAtUser.hgetall(USER_ID).items()
-        if session_id.decode() in session_id_within_last_several_days
-    }
+def get_user_chats_within_last_several_days_sorted(
+    days: int,
+    floor: str = None,
+    extra: int = 100,
+    preloaded: Dict[str, Any] = None,
+) -> Tuple[list[tuple], str, bool]:
+    """
+    指定された日数以内に利用したユーザーのセッションとタイトルを、最終利用時刻の降順で返します。
+    ユーザー毎のセッションの索引を使い、表示する分だけを読むため、他のユーザーの利用量にも
+    ユーザーの過去のチャットの数にも依存しません。
 
-    #  指定日数以内のチャットデータをタイムスタンプの降順でソート
-    user_session_id_title_within_last_several_days_sorted: list[tuple] = sorted(
-        user_session_id_title_within_last_several_days.items(), reverse=True
-    )
-    return user_session_id_title_within_last_several_days_sorted
-
-
-# Unixタイムスタンプをローカルタイムに変換する関数
-def unixtime_to_localtime(unixtime):
-    utc_time = datetime.datetime.utcfromtimestamp(unixtime)
-    local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(
-        pytz.timezone(os.environ["TZ"])
-    )  # Noneを指定するとローカルタイムゾーンに変換される
-    formatted_time = local_time.strftime(
-        "%Y-%m-%d %H:%M:%S"
-    )  # エクセルでも扱いやすい形式にフォーマット
-    return formatted_time
-
-
-def get_chat_data_as_csv():
-    # StringIOオブジェクトを初期化してCSVデータを保持する
-    csv_output = io.StringIO()
-    fieldnames = [
-        "messages_id",
-        "kind",
-        "USER_ID",
-        "model",
-        "timestamp",
-        "messages",
-        "num_tokens",
+    Args:
+        days (int):  指定された日数。
+        floor (str, optional): 前回表示した中で最も古い最終利用時刻。それ以降は全て返す。
+        extra (int): floorより古いものを返す件数。floorを省略すると新しい方からextra件。
+        preloaded (Dict[str, Any], optional): ChatStore.load_rerun_stateで読み出し済みの
+            過去のチャットの一覧(parse_user_sessionsの辞書)。省略するとRedisから読む。
+
+    Returns:
+        Tuple[list[tuple], str, bool]:  (セッションIDとタイトルのペアのリスト,
+            次のfloor, まだ古いセッションがあるか)。
+    """
+    since = several_days_ago_unixtime(days)
+    if preloaded is None:
+        page = store.get_user_sessions(USER_ID, since, floor=floor, extra=extra)
+    else:
+        page = preloaded
+
+    # 索引がまだ無いユーザーは一度だけ作ってから取り直す
+    if not page["sessions"] and not page["index_exists"] and backfill_user_sessions():
+        page = store.get_user_sessions(USER_ID, since, floor=floor, extra=extra)
+
+    # 表示するsession_idのタイトルだけを復号する。タイトルがまだ無いものは除く。
+    # 復号したタイトルは暗号文をキーにセッションに残し、表示し続ける間は復号し直さない。
+    previous_titles: Dict[bytes, str] = st.session_state.get("sidebar_titles", {})
+    titles: Dict[bytes, str] = {}
+    with turn_metrics.measure("decrypt_seconds"):
+        for _, title in page["sessions"]:
+            if title is not None and title not in titles:
+                titles[title] = previous_titles.get(title) or cipher_suite.decrypt(
+                    title
+                ).decode()
+    st.session_state["sidebar_titles"] = titles
+    user_session_id_title_within_last_several_days_sorted: list[tuple] = [
+        (session_id.decode(), titles[title])
+        for session_id, title in page["sessions"]
+        if title is not None
     ]
-    writer = csv.DictWriter(csv_output, fieldnames=fieldnames)
-
-    # ヘッダーを書き込む
-    writer.writeheader()
-
-    # Redisハッシュからすべてのキーを取得する（仮のコード部分）
-    keys = (
-        redisCliChatData.keys()
-    )  # この行は仮のコードで、実際のRedisクライアントのコードに置き換えてください。
-    for key in keys:
-        # 各キーのデータを取得する
-        data = redisCliChatData.hgetall(key)  # この行も仮のコードです。
-        for kind, value in data.items():
-            value_dict = json.loads(value)
-            localtime = unixtime_to_localtime(value_dict["timestamp"])
-            writer.writerow(
-                {
-                    "USER_ID": value_dict["USER_ID"],
-                    "messages_id": key.decode(),
-                    "kind": kind.decode(),
-                    "model": value_dict["model"],
-                    "timestamp": localtime,
-                    # ここで ensure_ascii=False を設定
-                    "messages": json.dumps(
-                        value_dict["messages"], ensure_ascii=False
-                    ),  # 日本語がエスケープされずに出力される
-                    "num_tokens": value_dict["num_tokens"],
-                }
-            )
+    return (
+        user_session_id_title_within_last_several_days_sorted,
+        page["floor"],
+        page["has_more"],
+    )
+
 
-    # CSVデータをstrとして取得する
-    csv_data_str = csv_output.getvalue()
-    # CSVデータをShift-JISでエンコードする
-    csv_data_shift_jis = csv_data_str.encode("shift_jis", errors="replace")
+def get_chat_data_as_csv(
+    since: float = None, until: float = None, user_id: str = None
+) -> Generator[bytes, None, None]:
+    """
+    redisCliChatDataの記録をShift-JISのCSVとして1行ずつ返すgenerator。
+    SCANとパイプラインでまとめたHGETALLで少しずつ読むため、Redisを止めず、メモリにも溜めない。
 
-    return csv_data_shift_jis
+    引数:
+        since (float, optional): この時刻(unixtime)以降の記録に絞る。
+        until (float, optional): この時刻(unixtime)より前の記録に絞る。
+        user_id (str, optional): このUSER_IDの記録に絞る。
+    """
+    return iter_chat_data_csv(
+        redisCliChatData,
+        redisCliAccessTime,
+        since=since,
+        until=until,
+        user_id=user_id,
+        codec=storage_codec,
+        messages_client=redisCliMessages,
+    )
 
 
 def hash_string_md5_with_salt(input_string: str, hash_salt: str) -> str:
@@ -566,53 +935,288 @@ def common_message_function(*, model:str,
                             messages:List,
                             max_tokens:int=None,
                             stream:bool=False,
+                            usage:Dict[str, int]=None,
+                            use_cache:bool=False,
                             **kwargs):
+    # usageに辞書を渡すと、ストリームの最後にプロバイダーが返したトークン数(prompt_tokens, completion_tokens)を書き込む
+    # use_cacheがTrueで応答キャッシュが有効な場合、同じ入力の応答を再利用し、usage["cached"]に1を書き込む
+    cache = response_cache if use_cache else None
+    if cache is not None:
+        cached_response = cache.get(
+            model, max_tokens, messages, saved_cost=calc_saved_cost(model)
+        )
+        if cached_response is not None:
+            if usage is not None:
+                usage["cached"] = 1
+            if not stream:
+                return cached_response
+
+            # ストリームの呼び出し元には、保存された応答を少しずつ返すgeneratorにして渡す
+            def replay_stream():
+                yield
+                for i in range(0, len(cached_response), RESPONSE_CACHE_REPLAY_CHARS):
+                    yield cached_response[i : i + RESPONSE_CACHE_REPLAY_CHARS]
+
+            rs = replay_stream()
+            rs.__next__()
+            return rs
+
     if stream:
+        # 呼び出したスレッドの計測。最初と最後のチャンクまでの時間とチャンクの速さを記録する。
+        metrics = turn_metrics.current()
+        requested_at = time.perf_counter()
 
         def chat_stream():
-            for i, text in enumerate(
-                completion(
-                    messages=messages, model=model, max_tokens=max_tokens, stream=True,
-                **kwargs)
-            ):
-                if not i:
-                    yield
-                yield text["choices"][0]["delta"].get("content", "") or ""
+            pieces = []
+            first_chunk_at = None
+            response = completion(
+                messages=messages, model=model, max_tokens=max_tokens, stream=True,
+            **kwargs)
+            # 途中で閉じられた(ヘッジで負けた、画面を離れた)場合も、応答の接続をすぐに閉じる
+            try:
+                for i, text in enumerate(response):
+                    if not i:
+                        yield
+                        first_chunk_at = time.perf_counter()
+                    piece = read_chunk(text, usage)
+                    # stream_optionsのinclude_usageで最後に来る、トークン数だけのチャンクには本文が無い
+                    if piece is None:
+                        continue
+                    pieces.append(piece)
+                    yield piece
+            finally:
+                close = getattr(response, "close", None)
+                if close is not None:
+                    close()
+            if metrics is not None and first_chunk_at is not None:
+                last_chunk_at = time.perf_counter()
+                metrics.set("first_chunk_seconds", first_chunk_at - requested_at)
+                metrics.set("stream_seconds", last_chunk_at - requested_at)
+                if last_chunk_at > first_chunk_at:
+                    metrics.set(
+                        "chunks_per_second", i / (last_chunk_at - first_chunk_at)
+                    )
+            # 最後まで受け取れた応答だけを保存する
+            if cache is not None:
+                cache.put(model, max_tokens, messages, "".join(pieces))
 
         cs = chat_stream()
         cs.__next__()
         return cs
     else:
-        return completion(
+        content = completion(
             messages=messages, model=model, max_tokens=max_tokens, stream=False,
             **kwargs
         )["choices"][0]["message"]["content"]
+        if cache is not None:
+            cache.put(model, max_tokens, messages, content)
+        return content
+
+
+def route_message_stream(
+    model: str,
+    fallback_model: str,
+    messages: List[dict],
+    max_tokens: int,
+    usage: Dict[str, int] = None,
+    use_cache: bool = False,
+    route: Dict[str, Any] = None,
+    messages_id: str = None,
+) -> Generator:
+    """
+    model_routerを通してcommon_message_functionのストリームを始める。
+    fallback_modelがあり、modelの最初のチャンクがTTFTのHEDGE_PERCENTILEを過ぎても来ないか失敗したら、
+    fallback_modelにも送り、先に最初のチャンクが届いた方を返す。
+    fallback_modelには、その最大トークン数でトリムし直したメッセージのコピーを送る。
+    ヘッジすると決めた時にだけfallback_modelのレート制限の枠を取り、超えていれば(順番待ちがあれば)呼ばない。
+    先に他方が応答したため閉じたモデルも、プロンプトのトークン数をコストの集計に加え、
+    messages_idがあればそのプロンプトをCANCELLED_PROMPT_FIELDに記録する(集計を作り直すときにも数える)。
+
+    引数:
+        model (str): 呼ぶモデル名。
+        fallback_model (str): ヘッジするモデル名。Noneならmodelだけを呼ぶ。
+        messages (List[dict]): トリム後のメッセージ。
+        max_tokens (int): modelの生成するトークンの最大数。fallback_modelではその最大出力トークン数までに抑える。
+        usage (Dict[str, int]): 応答したモデルについて、プロバイダーが返したトークン数を書き込む辞書。
+        use_cache (bool): 応答キャッシュを使うか。
+        route (Dict[str, Any]): 実際に応答したモデル名を"model"に、ヘッジしたかを"hedged"に、
+            そのモデルに送ったメッセージを"messages"に書き込む辞書。
+        messages_id (str): ヘッジで閉じたモデルのプロンプトを記録するメッセージID。
+            省略するとコストの集計にだけ加える。
+
+    戻り値:
+        Generator: 応答したモデルのストリーム。
+    """
+    # 呼び出したスレッドの計測を、呼び出しのスレッドでも使う
+    metrics = turn_metrics.current()
+    # 呼び出しのスレッドではst.session_stateを使えないため、索引を先に取り出しておく
+    token_index = st.session_state["token_index"]
+    attempt_usages: Dict[str, Dict[str, int]] = {}
+    attempt_messages: Dict[str, List[dict]] = {model: messages}
+
+    def start(attempt_model: str) -> Generator:
+        turn_metrics.activate(metrics)
+        attempt_usages[attempt_model] = {}
+        return common_message_function(
+            model=attempt_model,
+            messages=attempt_messages[attempt_model],
+            stream=True,
+            max_tokens=(
+                max_tokens
+                if attempt_model == model
+                else min(max_tokens, AVAILABLE_MODELS[attempt_model]["OUTPUT_MAX_TOKENS"])
+            ),
+            usage=attempt_usages[attempt_model],
+            use_cache=use_cache,
+        )
+
+    def allow_fallback(attempt_model: str) -> bool:
+        try:
+            attempt_messages[attempt_model] = trim_tokens(
+                list(messages),
+                AVAILABLE_MODELS[attempt_model]["INPUT_MAX_TOKENS"],
+                model=attempt_model,
+                token_index=token_index,
+            )
+        except ValueError as e:
+            logger.warning(f"{attempt_model} can not take the prompt: {e}")
+            return False
+        return not check_rate_limit_exceed(
+            redisCliAccessTime,
+            attempt_model,
+            num_tokens=sum_message_tokens(
+                attempt_messages[attempt_model], attempt_model, token_index
+            )
+            + AVAILABLE_MODELS[attempt_model]["OUTPUT_MAX_TOKENS"],
+        )
+
+    def record_cancelled(attempt_model: str) -> None:
+        attempt_usage = attempt_usages[attempt_model]
+        prompt_tokens = attempt_usage.get("prompt_tokens") or sum_message_tokens(
+            attempt_messages[attempt_model], attempt_model, token_index
+        )
+        timestamp = time.time()
+        cached = bool(attempt_usage.get("cached"))
+        usage_record = make_usage_record("prompt", attempt_model, prompt_tokens, timestamp, cached)
+        if messages_id is None:
+            record_usage(redisCliAccessTime, **usage_record, expire_time=EXPIRE_TIME)
+            return
+        # 呼び出しのスレッドで動くため、往復回数は再実行のものとは別に数える
+        ChatStore().record_cancelled_prompt(
+            messages_id=messages_id,
+            prompt=storage_codec.encode_record(
+                user_id=USER_ID,
+                model=attempt_model,
+                timestamp=timestamp,
+                num_tokens=prompt_tokens,
+                messages=compact_json(attempt_messages[attempt_model]),
+                cached=cached,
+            ),
+            usage=usage_record,
+            expire_time=EXPIRE_TIME,
+        )
+
+    answered_model, stream = model_router.start(
+        model,
+        fallback_model,
+        start,
+        allow_fallback=allow_fallback,
+        on_cancelled=record_cancelled,
+    )
+    if route is not None:
+        route["model"] = answered_model
+        route["hedged"] = len(attempt_usages) > 1
+        route["messages"] = attempt_messages[answered_model]
+    if usage is None:
+        return stream
+    answered_usage = attempt_usages[answered_model]
+
+    # 応答したモデルのトークン数を、チャンク毎に呼び出し元のusageに写す
+    def relay():
+        usage.update(answered_usage)
+        yield
+        for chunk in stream:
+            yield chunk
+            usage.update(answered_usage)
+        usage.update(answered_usage)
+
+    rs = relay()
+    rs.__next__()
+    return rs
+
+
+def calc_saved_cost(model: str) -> float:
+    """応答キャッシュがヒットした場合に節約できるプロンプトとレスポンスの記録のコストを返す。"""
+    try:
+        return calc_cost(API_COST, model, "prompt") + calc_cost(API_COST, model, "response")
+    except KeyError:
+        return 0.0
 
 
 # USER_ID : AzureEntraIDで与えられる"Oidc_claim_sub"
 # session_id : 一連のChatのやり取りをsessionと呼び、それに割り振られたID。USER_IDとsession作成時間のナノ秒で構成。"{}_{:0>20}".format(USER_ID, int(time.time_ns())
 # messages_id : sessionのうち、そのchat数で管理されているID。session_idとそのchat数で構成。f"{session_id}_{chat数:0>6}"
+#               ファンアウトで比べたモデルの記録は、モデルの順番(1から)を加える。f"{session_id}_{chat数:0>6}_{順番:0>2}"
+
+# Redisへのデータアクセス層。接続プールはプロセスで共有し、往復回数はこの再実行の分を数える。
+store = ChatStore()
 
 # redisCliMessages : session_idでchat_messageを管理する。構造 {session_id : [{"role": "user", "content": user_msg},{"role": "assistant", "content": assistant_msg} ,...]}
-redisCliMessages = redis.Redis(host="redis", port=6379, db=0)
-# redisCliUserSetting : USER_IDで設定を管理する。構造{USER_ID : {"model" : model_name(str), "custom_instruction" : custom_instruction(str)}
-redisCliUserSetting = redis.Redis(host="redis", port=6379, db=1)
+redisCliMessages = store.messages
+# redisCliUserSetting : USER_IDで設定を管理する。構造{USER_ID : {"model" : model_name(str), "custom_instruction" : custom_instruction(str), "custom_instruction_tokens" : 設定画面でcl100k_baseで数えたトークン数(int、上限の検証と表示用)}
+redisCliUserSetting = store.user_setting
 # redisCliTitleAtUser : USER_IDとsession_idでタイトルを管理する。構造{USER_ID : {session_id, timestamp}}
-redisCliTitleAtUser = redis.Redis(host="redis", port=6379, db=2)
+#                       USER_ID毎にsession_idを最終利用時刻で管理する。構造{f"sessions:{USER_ID}" : {session_id : unixtime(as score)}}
+redisCliTitleAtUser = store.title_at_user
 # redisCliAccessTime : messages_idとscoreとしてunixtimeを管理。構造{'access' : {messages_id : unixtime(as score)}}
-redisCliAccessTime = redis.Redis(host="redis", port=6379, db=3)
+#                      レート制限のウィンドウとバケットも管理。構造{f"ratelimit:{name}" : ...} (rate_limiter.py参照)
+#                      レート制限を超えたリクエストの順番待ちの列も管理。構造{"admission:queue" : ...} (admission_queue.py参照)
+#                      日毎の利用量とコストの集計も管理。構造{f"usage:{YYYY-MM-DD}" : {"team" : cost, f"user:{USER_ID}" : cost, ...}} (usage_counter.py参照)
+redisCliAccessTime = store.access_time
 # redisCliUserAccess : USER_IDと'LOGIN'、'LOGOUT'の別でscoreとしてlogin_timeを管理する。構造{USER_ID : {kind('LOGOUT' or 'LOGIN') : unixtime(as score)}}
-redisCliUserAccess = redis.Redis(host="redis", port=6379, db=4)
-# redisCliChatData : messages_idと'prompt'か'response'の別で、messages、トークン数、timestamp及びモデル名を管理。構造{messages_id: {kind('send' or 'accept') : {'model' : mode, 'title' : title(str), 'timestamp' : timestamp, 'messages' : messages(List[dict]), 'num_tokens' : num_tokens(int)}
-redisCliChatData = redis.Redis(host="redis", port=6379, db=5)
+redisCliUserAccess = store.user_access
+# redisCliMessagesとredisCliChatDataの値はstorage_codecの形式で圧縮・暗号化されている。
+# redisCliChatData : messages_idと'prompt'か'response'(ヘッジで閉じたモデルのプロンプトは'prompt:cancelled')の別で、messages、トークン数、timestamp及びモデル名を管理。構造{messages_id: {kind('send' or 'accept') : {'model' : mode, 'title' : title(str), 'timestamp' : timestamp, 'messages' : messages(List[dict]), 'num_tokens' : num_tokens(int)}
+redisCliChatData = store.chat_data
+# redisCliCache : 再計算を避けるためのキャッシュを管理。構造{f"token_count:{model}:{sha256(text)}" : num_tokens(int)}
+#                 応答キャッシュも管理。構造{f"response_cache:{sha256}" : 暗号化された応答, ...} (response_cache.py参照)
+redisCliCache = store.cache
+
+
+def env_flag(name: str, default: str = "True") -> bool:
+    """
+    環境変数をオンオフの設定として読む。空白、"0"、"False"、"No"(大文字小文字を問わない)はFalse。
+    bool(os.environ.get(...))では"False"もTrueになるため、真偽値の設定はこれで読む。
+    """
+    return os.environ.get(name, default).strip().lower() not in ("", "0", "false", "no")
 
 
 # JWTでの鍵
 JWT_SECRET_KEY = os.environ["JWT_SECRET_KEY"]
 
 # メッセージを暗号化する鍵と暗号化インスタンス
-ENCRYPT_KEY = os.environ["ENCRYPT_KEY"].encode()
-cipher_suite = Fernet(ENCRYPT_KEY)
+@st.cache_resource
+def get_storage_codec() -> StorageCodec:
+    """
+    プロセスで一つの暗号化インスタンスと、redisCliMessagesとredisCliChatDataに保存する値の形式を返す。
+    平文を圧縮してから暗号化する。STORAGE_FORMAT_VERSIONを0にすると旧形式で書き込む。
+    読み出しはどちらの形式も読める。
+    STORAGE_COMPRESSIONは"zlib"、"zstd"(zstandardが必要)、"none"のいずれか。
+    """
+    return StorageCodec(
+        Fernet(os.environ["ENCRYPT_KEY"].encode()),
+        compression=os.environ.get("STORAGE_COMPRESSION", "zlib"),
+        compress_min_bytes=int(os.environ.get("STORAGE_COMPRESS_MIN_BYTES", 256)),
+        write_version=int(os.environ.get("STORAGE_FORMAT_VERSION", 1)),
+    )
+
+
+storage_codec = get_storage_codec()
+cipher_suite = storage_codec.cipher
+
+# プロンプトの記録を、新しいターンとセッションのメッセージの範囲だけの差分形式で保存するか。
+# 空白かFalseであればトリムされた会話全体を保存する。
+PROMPT_RECORD_DELTA = env_flag("PROMPT_RECORD_DELTA")
 
 # ハッシュ関数に加えるソルト
 HASH_SALT = os.environ["HASH_SALT"]
@@ -622,8 +1226,10 @@ SESSION_TIMEOUT_PERIOD = int(os.environ.get("SESSION_TIMEOUT_PERIOD", 3600))
 # 環境変数からDOMAIN_NAMEを取得
 DOMAIN_NAME = os.environ.get("DOMAIN_NAME", "localhost")
 LOGOUT_URL = f"https://{DOMAIN_NAME}/logout"
+# 設定画面に渡すJWTの有効期限(秒)。同じトークンで設定のAPI(/api/settings)も使える。
+SETTINGS_TOKEN_EXPIRE_TIME = float(os.environ.get("SETTINGS_TOKEN_EXPIRE_TIME", 600))
 
-# CustomInstructionの最大トークン数
+# CustomInstructionの最大トークン数。設定画面(flask)で保存する時に検証する。
 CUSTOM_INSTRUCTION_MAX_TOKENS = int(os.environ.get("CUSTOM_INSTRUCTION_MAX_TOKENS", 0))
 
 # redisのキーの蒸発時間を決める。基本366日
@@ -633,13 +1239,29 @@ EXPIRE_TIME = int(os.environ.get("EXPIRE_TIME", 24 * 3600 * 366))
 #  ユーザーに対して表示する警告メッセージを定義します。
 ASSISTANT_WARNING = "注意：私はAIチャットボットで、情報が常に最新または正確であるとは限りません。重要な決定をする前には、他の信頼できる情報源を確認してください。"
 
+@st.cache_resource
+def load_model_config() -> Dict[str, Any]:
+    """
+    環境変数からJSON形式のモデルの設定を読み込む。再実行の度に解析しないよう、プロセスで1回だけ行う。
+    戻り値は共有されるため、書き換えてはいけない。
+    """
+    return {
+        "AVAILABLE_MODELS": json.loads(os.environ["AVAILABLE_MODELS"]),
+        "LATE_LIMIT": json.loads(os.environ["LATE_LIMIT"]),
+        "TITLE_MODEL": tuple(json.loads(os.environ["TITLE_MODEL"]).items())[0],
+        "API_COST": json.loads(os.environ["API_COST"]),
+    }
+
+
+model_config = load_model_config()
+
 #  利用可能なGPTモデルのリスト
 # 環境変数から利用可能なGPTモデルのリストをJSON形式で取得し、辞書として定義します。
-AVAILABLE_MODELS: dict[str, int] = json.loads(os.environ["AVAILABLE_MODELS"])
+AVAILABLE_MODELS: dict[str, int] = model_config["AVAILABLE_MODELS"]
 
 #  レート制限の設定
 # 環境変数からレート制限の設定をJSON形式で取得し、辞書として定義します。
-LATE_LIMIT: dict = json.loads(os.environ["LATE_LIMIT"])
+LATE_LIMIT: dict = model_config["LATE_LIMIT"]
 
 #  レート制限のカウント
 #  レート制限の設定からカウントを取得し、整数として定義します。
@@ -649,16 +1271,188 @@ LATE_LIMIT_COUNT: int = LATE_LIMIT["COUNT"]
 #  レート制限の設定から期間を取得し、浮動小数点数として定義します。
 LATE_LIMIT_PERIOD: float = LATE_LIMIT["PERIOD"]
 
+# レート制限を超えたリクエストを並べる順番待ちの列。待つ最大の秒数(0であれば並べずに断る)、
+# 並べられる数、列を確認し直す間隔(秒)、この秒数確認に来ない待ちを列から除く秒数、
+# USER_ID毎の重み(JSON。{USER_ID : 重み}で、無いユーザーは1)
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", 60))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 100))
+ADMISSION_POLL_INTERVAL = float(os.environ.get("ADMISSION_POLL_INTERVAL", 1.0))
+ADMISSION_MIN_POLL_INTERVAL = 0.05
+ADMISSION_STALE_AFTER = float(
+    os.environ.get("ADMISSION_STALE_AFTER", max(10.0, ADMISSION_POLL_INTERVAL * 3))
+)
+ADMISSION_USER_WEIGHTS: Dict[str, float] = json.loads(
+    os.environ.get("ADMISSION_USER_WEIGHTS", "{}")
+)
+
+
+@st.cache_resource
+def get_admission_queue() -> AdmissionQueue:
+    """プロセスで一つの順番待ちの列を返す。列の状態はRedisにあり、全てのプロセスで共有される。"""
+    return AdmissionQueue(
+        get_redis(ACCESS_TIME_DB),
+        max_queue_size=ADMISSION_MAX_QUEUE,
+        stale_after=ADMISSION_STALE_AFTER,
+    )
+
+
+admission_queue = get_admission_queue() if ADMISSION_MAX_WAIT > 0 else None
+
 #  タイトル生成モデルの設定
 # 環境変数からタイトル生成モデルの設定をJSON形式で取得し、タプルとして定義します。
 TITLE_MODEL: str
 TITLE_MODEL_CHAR_MAX_LENGTH: int
-TITLE_MODEL, TITLE_MODEL_CHAR_MAX_LENGTH = tuple(
-    json.loads(os.environ["TITLE_MODEL"]).items()
-)[0]
+TITLE_MODEL, TITLE_MODEL_CHAR_MAX_LENGTH = model_config["TITLE_MODEL"]
+# タイトル生成のプロンプトの最大トークン数
+TITLE_INPUT_MAX_TOKENS = int(os.environ.get("TITLE_INPUT_MAX_TOKENS", 512))
 
 # api_costの計算用(1Kトークン毎の日本円）　構造{<モデル名>:{"prompt":1.234,"response":2.345},....}
-API_COST = json.loads(os.environ["API_COST"])
+API_COST = model_config["API_COST"]
+
+# セッション毎に保持するメッセージ毎のトークン数の索引の最大件数
+TOKEN_INDEX_MAX_SIZE = int(os.environ.get("TOKEN_INDEX_MAX_SIZE", 1000))
+
+# トークン数キャッシュのプロセス内の最大件数、Redisを使うか(空白かFalseであれば使わない)、Redisでの寿命
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get("TOKEN_CACHE_MAX_SIZE", 4096))
+TOKEN_CACHE_USE_REDIS = env_flag("TOKEN_CACHE_USE_REDIS")
+TOKEN_CACHE_EXPIRE_TIME = int(os.environ.get("TOKEN_CACHE_EXPIRE_TIME", 7 * 24 * 3600))
+
+# ストリーミング中の応答をRedisに書き込む間隔(秒)とチャンク数。どちらかに達したら書き込む。
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", 0.5))
+STREAM_FLUSH_CHUNKS = int(os.environ.get("STREAM_FLUSH_CHUNKS", 20))
+
+# サイドバーに過去のチャットを表示する日数と、最初と「もっと見る」毎に表示する件数
+SIDEBAR_LOOKBACK_DAYS = int(os.environ.get("SIDEBAR_LOOKBACK_DAYS", 7))
+SIDEBAR_PAGE_SIZE = int(os.environ.get("SIDEBAR_PAGE_SIZE", 20))
+
+# 同じメッセージを同時に送って比べられるモデルの数(選んだモデルを除く)。0であればファンアウトは使わない。
+FANOUT_MAX_MODELS = int(os.environ.get("FANOUT_MAX_MODELS", 3))
+
+
+@st.cache_resource
+def get_token_count_cache() -> TokenCountCache:
+    """
+    プロセスで一つのトークン数キャッシュを返す。再実行やセッションをまたいで共有される。
+    """
+    return TokenCountCache(
+        maxsize=TOKEN_CACHE_MAX_SIZE,
+        redis_client=get_redis(CACHE_DB) if TOKEN_CACHE_USE_REDIS else None,
+        expire_time=TOKEN_CACHE_EXPIRE_TIME,
+    )
+
+
+# スクリプトの実行中に取得しておき、タイトル生成のスレッドからも同じものを使う
+token_count_cache = get_token_count_cache()
+
+# メッセージ毎のトークン数の索引を使った見積もりとトリム
+message_token_counter = MessageTokenCounter(
+    calc_token_tiktoken, index_max_size=TOKEN_INDEX_MAX_SIZE
+)
+sum_message_tokens = message_token_counter.sum_message_tokens
+trim_tokens = message_token_counter.trim_tokens
+
+# タイトル生成などの応答後の処理を行うワーカースレッドの数、待機できるジョブの数、再試行の回数
+BACKGROUND_JOB_WORKERS = int(os.environ.get("BACKGROUND_JOB_WORKERS", 2))
+BACKGROUND_JOB_QUEUE_SIZE = int(os.environ.get("BACKGROUND_JOB_QUEUE_SIZE", 100))
+BACKGROUND_JOB_MAX_RETRIES = int(os.environ.get("BACKGROUND_JOB_MAX_RETRIES", 2))
+
+
+@st.cache_resource
+def get_background_jobs() -> BackgroundJobQueue:
+    """
+    プロセスで一つのバックグラウンドジョブのキューを返す。再実行やセッションをまたいで共有される。
+    """
+    return BackgroundJobQueue(
+        max_workers=BACKGROUND_JOB_WORKERS,
+        max_queue_size=BACKGROUND_JOB_QUEUE_SIZE,
+        max_retries=BACKGROUND_JOB_MAX_RETRIES,
+    )
+
+
+background_jobs = get_background_jobs()
+
+# モデルのAPIへの接続プール。1つのクライアントの最大接続数、張ったままにしておく接続数と
+# その秒数、接続と読み出しのタイムアウト(秒)、HTTP/2を使うか(空白であれば使わない)
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", 100))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+)
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", 60))
+LLM_HTTP_CONNECT_TIMEOUT = float(os.environ.get("LLM_HTTP_CONNECT_TIMEOUT", 10))
+LLM_HTTP_READ_TIMEOUT = float(os.environ.get("LLM_HTTP_READ_TIMEOUT", 120))
+LLM_HTTP2 = env_flag("LLM_HTTP2")
+
+
+@st.cache_resource
+def get_http_pool() -> HttpClientPool:
+    """
+    プロセスで一つの、モデルのAPIへのkeep-aliveの接続プールを返す。
+    応答、トークン数の計算、タイトル生成の全てで接続を使い回す。
+    """
+    pool = HttpClientPool(
+        max_connections=LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+        connect_timeout=LLM_HTTP_CONNECT_TIMEOUT,
+        read_timeout=LLM_HTTP_READ_TIMEOUT,
+        http2=LLM_HTTP2,
+    )
+    configure_http_pool(pool)
+    return pool
+
+
+http_pool = get_http_pool()
+
+# ヘッジ: モデル毎の直近HEDGE_WINDOW_SIZE回の呼び出しのTTFTのHEDGE_PERCENTILEパーセンタイルを過ぎても
+# 最初のチャンクが来なければ、AVAILABLE_MODELSの"FALLBACK"のモデルにも送る。呼び出しがHEDGE_MIN_SAMPLES回に
+# 満たない間はHEDGE_DEFAULT_DELAY秒待ち、どの場合もHEDGE_MIN_DELAY秒は待つ。
+# 直近の失敗の割合がHEDGE_ERROR_RATE以上のモデルは、待たずにフォールバックのモデルにも送る。
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 95))
+HEDGE_WINDOW_SIZE = int(os.environ.get("HEDGE_WINDOW_SIZE", 100))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 10))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 0.5))
+HEDGE_ERROR_RATE = float(os.environ.get("HEDGE_ERROR_RATE", 0.5))
+
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """
+    プロセスで一つの、モデル毎のTTFTと失敗の計測に基づいてヘッジするルーターを返す。
+    """
+    return ModelRouter(
+        LatencyTracker(window_size=HEDGE_WINDOW_SIZE, min_samples=HEDGE_MIN_SAMPLES),
+        percentile=HEDGE_PERCENTILE,
+        default_delay=HEDGE_DEFAULT_DELAY,
+        min_delay=HEDGE_MIN_DELAY,
+        error_rate_threshold=HEDGE_ERROR_RATE,
+    )
+
+
+model_router = get_model_router()
+
+# 応答キャッシュを使う呼び出し。"title"(タイトル生成)と"chat"(チャット)をカンマ区切りで指定する。空白であれば使わない。
+RESPONSE_CACHE_TARGETS: Set[str] = {
+    target.strip()
+    for target in os.environ.get("RESPONSE_CACHE_TARGETS", "").split(",")
+    if target.strip()
+}
+# 応答キャッシュの寿命(秒)と保存する件数の上限
+RESPONSE_CACHE_EXPIRE_TIME = int(os.environ.get("RESPONSE_CACHE_EXPIRE_TIME", 86400))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+# ストリームで保存された応答を返すときの1チャンクの文字数
+RESPONSE_CACHE_REPLAY_CHARS = 16
+response_cache = (
+    ResponseCache(
+        get_redis(CACHE_DB),
+        storage_codec,
+        expire_time=RESPONSE_CACHE_EXPIRE_TIME,
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        stats_expire_time=EXPIRE_TIME,
+    )
+    if RESPONSE_CACHE_TARGETS
+    else None
+)
 
 
 headers = _get_websocket_headers()
@@ -673,13 +1467,6 @@ try:
     # USER_ID: str = headers["Oidc_claim_email"]
     if not USER_ID:
         raise Exception("No email info in claim.")
-    MY_NAME_ENCRYPTED : str = redisCliUserSetting.hget(USER_ID, "user_name")
-    if MY_NAME_ENCRYPTED is None:
-        MY_NAME = 'Enter Nickname'
-        MY_NAME_ENCRYPTED = cipher_suite.encrypt(MY_NAME.encode())
-        redisCliUserSetting.hset(USER_ID, "user_name", MY_NAME_ENCRYPTED)
-    else:
-        MY_NAME = cipher_suite.decrypt(MY_NAME_ENCRYPTED).decode('utf-8')
     #login_time = int(headers["Oidc_claim_exp"]) - 3600
     login_time = time.time()
 
@@ -717,9 +1504,8 @@ else:
     logger.info("logger not initialized!!!")
 logger.debug(f"headers : {headers}")
 logger.debug(f"st.session_state : {st.session_state}")
-executor1 = ThreadPoolExecutor(1)
-
-login_check(login_time)
+logger.debug(f"token count cache stats : {token_count_cache.stats()}")
+logger.debug(f"background job stats : {background_jobs.stats()}")
 
 
 
@@ -727,70 +1513,102 @@ login_check(login_time)
 # %%
 
 
+# メッセージ毎のトークン数の索引。{(モデル名, str(message)) : トークン数}
+# 再実行をまたいで保持し、新しいメッセージだけトークン数を計算する。
+if "token_index" not in st.session_state:
+    st.session_state["token_index"] = {}
+
+# 復号済みの会話履歴。再実行をまたいで保持し、新しいメッセージだけ取得して復号する。
+if "history_cache" not in st.session_state:
+    st.session_state["history_cache"] = HistoryCache()
+history_cache: HistoryCache = st.session_state["history_cache"]
+
 # Streamlitアプリの開始時にセッション状態を初期化
-if "id" not in st.session_state:
+new_session = "id" not in st.session_state
+if new_session:
     logger.debug("session initialized")
     st.session_state["id"] = "{}_{:0>20}".format(USER_ID, int(time.time_ns()))
     # st.warning('not id')
 
-    # もしUSER_IDに対応するモデルが設定されていない場合、最初の利用可能なモデルを設定
-    if not redisCliUserSetting.hexists(USER_ID, "model"):
-        redisCliUserSetting.hset(USER_ID, "model", list(AVAILABLE_MODELS.keys())[0])
-    # もしUSER_IDに対応するモデルが利用可能なモデルのリストに含まれていない場合、最初の利用可能なモデルを設定
-    if redisCliUserSetting.hget(USER_ID, "model").decode() not in AVAILABLE_MODELS:
-        redisCliUserSetting.hset(USER_ID, "model", list(AVAILABLE_MODELS.keys())[0])
-    # 先にcalc_token_tiktokenを実行して、cashに入れておく
-    model: str = redisCliUserSetting.hget(USER_ID, "model").decode()
-    calc_token_tiktoken("test", model=model)
-
-    # accesstimeのEXPIRE_TIMEよりも古いものは消す
-    redisCliAccessTime.zremrangebyscore("access", "-inf", time.time() - EXPIRE_TIME)
-
-    # もしUSER_IDに対応するcustom instructionが設定されていない場合、''を設定
-    if not redisCliUserSetting.hexists(USER_ID, "custom_instruction"):
-        redisCliUserSetting.hset(
-            USER_ID, "custom_instruction", cipher_suite.encrypt(b"")
-        )
-    # もしUSER_IDに対応するuse_custom_instruction_flagが設定されていない場合、""を設定
-    if not redisCliUserSetting.hexists(USER_ID, "use_custom_instruction_flag"):
-        redisCliUserSetting.hset(USER_ID, "use_custom_instruction_flag", "")
+# 順番待ちの途中で再実行された(やめるボタンなど)やり取りは、追加したユーザーメッセージを削除する
+admission_waiting_session = st.session_state.pop("admission_waiting", None)
+if admission_waiting_session is not None:
+    store.remove_last_message(admission_waiting_session)
+    st.info("順番待ちをやめました。")
+
+# 再実行に必要な読み出しと、ログイン時間の記録、USER_IDについてのEXPIRE_TIMEの設定を1往復で行う。
+# EXPIRE_TIMEの設定により最後にログインした時から１年間は消えない。
+history_start = history_cache.fetch_start(st.session_state["id"])
+# 過去のチャットは表示中の分(sidebar_floor以降)だけ読み、「もっと見る」が押されたら1ページ分増やす。
+# 最初は新しい方から1ページ分を読む。
+sidebar_floor = st.session_state.get("sidebar_floor")
+sidebar_more_clicked = st.session_state.get("sidebar_more_button", False)
+rerun_state = store.load_rerun_state(
+    user_id=USER_ID,
+    session_id=st.session_state["id"],
+    login_time=login_time,
+    sessions_since=several_days_ago_unixtime(SIDEBAR_LOOKBACK_DAYS),
+    sessions_floor=sidebar_floor,
+    sessions_extra=(
+        SIDEBAR_PAGE_SIZE if sidebar_floor is None or sidebar_more_clicked else 0
+    ),
+    expire_time=EXPIRE_TIME,
+    history_start=history_start,
+    response_cache_stats_key=(
+        response_cache.stats_key(login_time) if response_cache else None
+    ),
+)
+if not history_cache.update(
+    st.session_state["id"],
+    history_start,
+    rerun_state["history_length"],
+    rerun_state["history"],
+    storage_codec.decode_message,
+):
+    # キャッシュと長さが合わなければ全件を取り直す
+    history_cache.replace(
+        st.session_state["id"],
+        store.load_history(st.session_state["id"]),
+        storage_codec.decode_message,
+    )
+user_settings: Dict[str, bytes] = {
+    key.decode(): value for key, value in rerun_state["settings"].items()
+}
+
+# ユーザー設定に無い項目は初期値を設定する
+settings_updates: Dict[str, bytes] = {}
+if "user_name" not in user_settings:
+    settings_updates["user_name"] = cipher_suite.encrypt("Enter Nickname".encode())
+# もしUSER_IDに対応するモデルが設定されていないか、利用可能なモデルのリストに含まれていない場合、最初の利用可能なモデルを設定
+if user_settings.get("model", b"").decode() not in AVAILABLE_MODELS:
+    settings_updates["model"] = list(AVAILABLE_MODELS.keys())[0].encode()
+# もしUSER_IDに対応するcustom instructionが設定されていない場合、''を設定
+if "custom_instruction" not in user_settings:
+    settings_updates["custom_instruction"] = cipher_suite.encrypt(b"")
+# もしUSER_IDに対応するuse_custom_instruction_flagが設定されていない場合、""を設定
+if "use_custom_instruction_flag" not in user_settings:
+    settings_updates["use_custom_instruction_flag"] = b""
+user_settings.update(settings_updates)
+
+# 初期値の書き込みと、新しいセッションではaccesstimeとセッションの索引のEXPIRE_TIMEよりも古いものの削除を1往復で行う
+store.save_rerun_state(
+    user_id=USER_ID,
+    settings=settings_updates,
+    prune_before=time.time() - EXPIRE_TIME if new_session else None,
+)
 
+MY_NAME = cipher_suite.decrypt(user_settings["user_name"]).decode("utf-8")
 
-# USER_IDについてEXPIRE_TIMEを設定する。これにより最後にログインした時から１年間は消えない。
-redisCliUserSetting.expire(USER_ID, EXPIRE_TIME)
-redisCliUserAccess.expire(USER_ID, EXPIRE_TIME)
-redisCliTitleAtUser.expire(USER_ID, EXPIRE_TIME)
+if new_session:
+    # 先にcalc_token_tiktokenを実行して、cashに入れておく
+    calc_token_tiktoken("test", model=user_settings["model"].decode())
 
 logger.debug(f"session_id first : {st.session_state['id']}")
 
-#  今日のの深夜0時を表すdatetimeオブジェクトを作成
-today = datetime.datetime.now()
-today_midnight = today.replace(hour=0, minute=0, second=0, microsecond=0)
-#  今日の深夜0時をUNIXタイムスタンプ（秒単位の時間）に変換
-today_midnight_unixtime = int(today_midnight.timestamp())
-
-# Redisの"access"スコアレッドにおいて、指定日数前のUNIXタイムスタンプよりも大きいスコアを持つmessagesIDを取得
-messages_id_within_today: List[bytes] = redisCliAccessTime.zrangebyscore(
-    "access", today_midnight_unixtime, "+inf"
-)
 logger.debug("Now model : ")
 
-# 今日のコスト計算
-
-cost_team, cost_mine = 0, 0
-for message_id in messages_id_within_today:
-    for kind, data in redisCliChatData.hgetall(message_id).items():
-        data = json.loads(data)
-        kind = kind.decode()
-        # logger.debug(f'data : {data}')
-        #key = kind.decode() + "_" + data["model"]
-        try:
-            cost_team += API_COST[data["model"]][kind]/1000
-            if data.get("USER_ID") == USER_ID:
-                cost_mine += API_COST[data["model"]][kind]/1000
-        except KeyError as e:
-            print(e)
-            logger.error(f"{data['model']} is not in available model!")
+# 今日のコスト。記録の度に加算している日毎の集計から読み出し済み。
+cost_team, cost_mine = rerun_state["cost"]
 
 st.title(MY_NAME + "さんとのチャット")
 
@@ -804,31 +1622,59 @@ st.sidebar.markdown(
     f"<p style='font-size:20px; color:green;'>{cost_mine:.3f}/{cost_team:.3f}</p>",
     unsafe_allow_html=True,
 )
+# 応答キャッシュを使っていれば、今日のチームのヒット率/節約したコスト
+if rerun_state["response_cache"] is not None:
+    response_cache_stats = stats_summary(parse_stats(rerun_state["response_cache"]))
+    st.sidebar.markdown(
+        f"<p style='font-size:14px; color:gray;'>cache {response_cache_stats['hit_rate']:.1%}"
+        f" / saved {response_cache_stats['saved']:.3f}</p>",
+        unsafe_allow_html=True,
+    )
 
 # 設定ボタンを作る。設定画面に飛ぶ
 if st.sidebar.button("Settings"):
-    token = make_jwt_token({"user_id": USER_ID}, expire_time=2.0)
+    token = make_jwt_token({"user_id": USER_ID}, expire_time=SETTINGS_TOKEN_EXPIRE_TIME)
     jump_to_url(f"https://{DOMAIN_NAME}/settings", token=token)
 
 
 # Streamlitのサイドバーに利用可能なGPTモデルを選択するためのドロップダウンメニューを追加
-model: str = redisCliUserSetting.hget(USER_ID, "model").decode()
-
-redisCliUserSetting.hset(
-    USER_ID,
-    "model",
-    st.sidebar.selectbox(
-        "GPTモデルを選択してください",  # GPTモデルを選択するためのドロップダウンメニューを表示
-        AVAILABLE_MODELS,  # 利用可能なGPTモデルのリスト
-        index=list(AVAILABLE_MODELS).index(  # 現在のモデルのインデックスを取得
-            model  # 現在のモデルを取得
-        ),
-    ),  # 選択されたモデルを設定
+model: str = user_settings["model"].decode()
+
+selected_model: str = st.sidebar.selectbox(
+    "GPTモデルを選択してください",  # GPTモデルを選択するためのドロップダウンメニューを表示
+    AVAILABLE_MODELS,  # 利用可能なGPTモデルのリスト
+    index=list(AVAILABLE_MODELS).index(  # 現在のモデルのインデックスを取得
+        model  # 現在のモデルを取得
+    ),
 )
+# 選択されたモデルが変わった場合だけ設定する
+if selected_model != model:
+    redisCliUserSetting.hset(USER_ID, "model", selected_model)
 # modelから限界トークン数を得る。
 INPUT_MAX_TOKENS = AVAILABLE_MODELS[model]["INPUT_MAX_TOKENS"]
 OUTPUT_MAX_TOKENS = AVAILABLE_MODELS[model]["OUTPUT_MAX_TOKENS"]
 
+# 同じメッセージを同時に送り、応答を横に並べて比べるモデル。会話には選んだモデルの応答だけを残す。
+fanout_models: List[str] = (
+    st.sidebar.multiselect(
+        "同時に送って比べるモデル",
+        [m for m in AVAILABLE_MODELS if m != model],
+        max_selections=FANOUT_MAX_MODELS,
+        key="fanout_models",
+    )
+    if FANOUT_MAX_MODELS > 0
+    else []
+)
+# 最初のチャンクが遅いか失敗した場合にヘッジするモデル。AVAILABLE_MODELS[model]["FALLBACK"]で指定する。
+# ファンアウトでは使わない。
+fallback_model: str = AVAILABLE_MODELS[model].get("FALLBACK")
+if fallback_model not in AVAILABLE_MODELS or fallback_model == model or fanout_models:
+    fallback_model = None
+# このやり取りで呼ぶモデル。全てのモデルに同じプロンプトを送るため、最も小さい最大トークン数でトリムする。
+# フォールバックのモデルには、ヘッジするときにそのモデルの最大トークン数でトリムし直したコピーを送る。
+turn_models: List[str] = [model] + fanout_models
+turn_input_max_tokens: int = min(AVAILABLE_MODELS[m]["INPUT_MAX_TOKENS"] for m in turn_models)
+
 
 # サイドバーに「New chat」ボタンを追加します。
 # ボタンがクリックされたときにアプリケーションを再実行します。
@@ -836,10 +1682,19 @@ if st.sidebar.button("🔄 **New chat**"):
     del st.session_state["id"]
     st.rerun()
 
-# 7日前のUSERに係るsession_idとtitleとのlistを得る。
-user_session_id_title_within_last_7days_sorted = (
-    get_user_chats_within_last_several_days_sorted(7)
+# SIDEBAR_LOOKBACK_DAYS日前からのUSERに係るsession_idとtitleとのlistのうち、表示する分を得る。
+(
+    user_session_id_title_sorted,
+    sessions_floor,
+    sessions_has_more,
+) = get_user_chats_within_last_several_days_sorted(
+    SIDEBAR_LOOKBACK_DAYS,
+    floor=sidebar_floor,
+    extra=SIDEBAR_PAGE_SIZE,
+    preloaded=rerun_state["sessions"],
 )
+# 以後の再実行では、表示した中で最も古いものまでを表示し続ける
+st.session_state["sidebar_floor"] = sessions_floor
 
 #  サイドバーに過去のチャットのタイトルを表示するためのマークダウンを設定
 #  ユーザーが過去のチャットを参照できるように、サイドバーにタイトルを表示します。
@@ -850,30 +1705,33 @@ st.sidebar.markdown(
 
 #  ユーザーが過去のチャットを選択できるように、サイドバーにボタンを配置
 # 過去のチャットのタイトルをボタンとして表示し、ユーザーがクリックすると、そのチャットに移動します。
-titles = []
-for session_id, title in user_session_id_title_within_last_7days_sorted:
+# 省略後に同じになったタイトルには、2つ目から出現した番号を付ける
+title_counter = Counter()
+for session_id, title in user_session_id_title_sorted:
     if len(title) > 15:
         title = title[:15] + "..."
-    titles.append(title)
-    counter = Counter(titles)
-    if counter[title] > 1:
-        title += str(counter[title])
+    title_counter[title] += 1
+    if title_counter[title] > 1:
+        title += str(title_counter[title])
 
-    if st.sidebar.button(title):
+    if st.sidebar.button(title, key=f"session_button_{session_id}"):
         #  ボタンがクリックされた場合、session_idをst.session_state['id']に代入
         #  これにより、選択されたチャットのIDが現在のセッションとして設定されます。
         st.session_state["id"] = session_id
         #  画面をリフレッシュして、選択されたチャットの内容を表示
         st.rerun()
 
+# 表示していない古いチャットがあれば、押された次の再実行で1ページ分増やして読む
+if sessions_has_more:
+    st.sidebar.button("もっと見る", key="sidebar_more_button")
+
 # アシスタントからの警告を載せる
 with st.chat_message("assistant"):
     st.write(ASSISTANT_WARNING)
 
 
 # 以前のチャットログを表示
-for chat_encrypted in redisCliMessages.lrange(st.session_state["id"], 0, -1):
-    chat: dict = json.loads(cipher_suite.decrypt(chat_encrypted))
+for chat in history_cache.messages:
     with st.chat_message(chat["role"]):
         st.write(chat["content"])
 
@@ -893,155 +1751,385 @@ if user_msg:
     with st.chat_message("user"):
         st.write(user_msg)
     new_messages: Dict[str, str] = {"role": "user", "content": user_msg}
-    new_messages_encrypted: bytes = cipher_suite.encrypt(
-        json.dumps(new_messages).encode()
+    new_messages_encrypted: bytes = storage_codec.encode_message(new_messages)
+    # メッセージを追加し、追加後の長さとキャッシュに無い末尾のメッセージを1往復で得る
+    history_start = history_cache.fetch_start(st.session_state["id"])
+    user_message_position, history_tail = store.append_user_message(
+        st.session_state["id"],
+        new_messages_encrypted,
+        EXPIRE_TIME,
+        history_start=history_start,
     )
-    redisCliMessages.rpush(st.session_state["id"], new_messages_encrypted)
-    redisCliMessages.expire(st.session_state["id"], EXPIRE_TIME)
+    if not history_cache.update(
+        st.session_state["id"],
+        history_start,
+        user_message_position,
+        history_tail,
+        storage_codec.decode_message,
+    ):
+        history_cache.replace(
+            st.session_state["id"],
+            store.load_history(st.session_state["id"]),
+            storage_codec.decode_message,
+        )
+    # messages_idを定義。session_idにmessagesの長さを加える。
+    messages_id = f"{st.session_state['id']}_{user_message_position:0>6}"
     error_flag = False
     try:
         now: float = time.time()
         # 入力メッセージのトークン数を計算
-        user_msg_tokens: int = calc_token_tiktoken(str([new_messages]), model=model)
+        user_msg_tokens: int = sum_message_tokens(
+            [new_messages], model, st.session_state["token_index"]
+        )
         logger.debug(f"入力メッセージのトークン数: {user_msg_tokens}")
-        if user_msg_tokens > INPUT_MAX_TOKENS:
+        if user_msg_tokens > turn_input_max_tokens:
             raise Exception(
                 "メッセージが長すぎます。短くしてください。"
                 f"({user_msg_tokens}tokens)"
             )
-        if check_rate_limit_exceed(
+        # response_chatmodelがメッセージを書き換えるため、キャッシュのコピーを渡す
+        messages = [dict(message) for message in history_cache.messages]
+        # トークン数の制限に使う見積もり。trim後のプロンプトと最大出力トークン数の和。
+        estimated_prompt_tokens: int = sum_message_tokens(
+            trim_tokens(
+                list(messages),
+                turn_input_max_tokens,
+                model=model,
+                token_index=st.session_state["token_index"],
+            ),
+            model,
+            st.session_state["token_index"],
+        )
+        # レート制限を超えていれば、順番待ちの列に並んで空きができるまで待つ。
+        # 待っている間に再実行されたら、次の再実行でユーザーメッセージを削除する
+        st.session_state["admission_waiting"] = st.session_state["id"]
+        wait_for_admission(
             redisCliAccessTime,
-            key_name="access",
-            late_limit=LATE_LIMIT_COUNT,
-            late_limit_period=LATE_LIMIT_PERIOD,
-        ):
-            raise Exception(
-                "アクセス数が多いため、接続できません。しばらくお待ちください。"
-            )
-        messages = [
-            json.loads(cipher_suite.decrypt(mes))
-            for mes in redisCliMessages.lrange(st.session_state["id"], 0, -1)
-        ]
+            model,
+            num_tokens=estimated_prompt_tokens + OUTPUT_MAX_TOKENS,
+        )
+        # 比べるモデルは選んだモデルの枠を持ったまま待たせないよう、列に並ばずに一度だけ確認し、
+        # 空きが無ければ今回は送らない
+        for fanout_model in fanout_models:
+            if check_rate_limit_exceed(
+                redisCliAccessTime,
+                fanout_model,
+                num_tokens=estimated_prompt_tokens
+                + AVAILABLE_MODELS[fanout_model]["OUTPUT_MAX_TOKENS"],
+            ):
+                logger.debug(f"{fanout_model} is not admitted")
+                st.warning(f"{fanout_model}はアクセス数が多いため、今回は送りません。")
+                turn_models.remove(fanout_model)
+        del st.session_state["admission_waiting"]
         # custom_instructionの読み出し
-        if redisCliUserSetting.hget(USER_ID, "use_custom_instruction_flag").decode():
+        if user_settings["use_custom_instruction_flag"].decode():
             custom_instruction = cipher_suite.decrypt(
-                redisCliUserSetting.hget(USER_ID, "custom_instruction")
+                user_settings["custom_instruction"]
             ).decode()
         else:
             custom_instruction = ''
 
-        # generatorだが、エラーが起きたら一個目の生成前に止まる。
-        response, trimed_messages = response_chatmodel(
-            messages,
-            model=model,
-            stream=True,
-            max_tokens=OUTPUT_MAX_TOKENS,
-            custom_instruction=custom_instruction,
-        )
+        # ストリームの最後にプロバイダーが返すトークン数の受け取り先
+        stream_usage: Dict[str, int] = {}
+        # 実際に応答したモデル(ヘッジでフォールバックのモデルが先に応答した場合はそのモデル)の受け取り先
+        stream_route: Dict[str, Any] = {}
+        if len(turn_models) == 1:
+            # generatorだが、エラーが起きたら一個目の生成前に止まる。
+            response, trimed_messages = response_chatmodel(
+                messages,
+                model=model,
+                stream=True,
+                max_tokens=OUTPUT_MAX_TOKENS,
+                custom_instruction=custom_instruction,
+                token_index=st.session_state["token_index"],
+                usage=stream_usage,
+                input_max_tokens=turn_input_max_tokens,
+                use_cache="chat" in RESPONSE_CACHE_TARGETS,
+                fallback_model=fallback_model,
+                route=stream_route,
+                messages_id=messages_id,
+            )
+        else:
+            # ファンアウトでは全てのモデルに送る1つのプロンプトを作り、呼び出しはFanOutのスレッドで行う
+            trimed_messages = trim_messages_for_model(
+                messages,
+                model,
+                custom_instruction=custom_instruction,
+                token_index=st.session_state["token_index"],
+                input_max_tokens=turn_input_max_tokens,
+            )
     except Exception as e:
         error_flag = True
         logger.error(e)
         traceback.print_exc()
         st.warning(e)
         # エラーが出たので今回のユーザーメッセージを削除する
-        redisCliMessages.rpop(st.session_state["id"], 1)
+        st.session_state.pop("admission_waiting", None)
+        store.remove_last_message(st.session_state["id"])
+        st.session_state["last_turn_metrics"] = {
+            "error": str(e),
+            "latency": time.perf_counter() - rerun_started_at,
+            "redis_round_trips": store.round_trips.count,
+        }
+        current_turn_metrics.model = model
+        store.record_turn_metrics(current_turn_metrics, error=True)
     if not error_flag:
 
-        encrypted_messages: str = cipher_suite.encrypt(
-            json.dumps(trimed_messages).encode()
-        ).decode()
-
         # 初回のmessages、つまりlen(messages)が1だったらタイトルを付ける。
         if len(messages) == 1:
-            # タイトルを付ける処理をする。
-            title_future = executor1.submit(
-                record_title_at_user_redis, messages, st.session_state["id"], now
-            )
+            # タイトルを付ける処理をする。応答を待たせないようバックグラウンドで行い、
+            # 同じセッションのタイトル生成が残っていれば重ねて行わない。
+            if not background_jobs.submit(
+                record_title_at_user_redis,
+                messages,
+                st.session_state["id"],
+                now,
+                key=f"title:{st.session_state['id']}",
+            ):
+                logger.warning("title generation was not queued")
             # title = record_title_at_user_redis(messages, st.session_state["id"], now)
 
-        # messages_idを定義。session_idにmessagesの長さを加える。
-        messages_id = f"{st.session_state['id']}_{redisCliMessages.llen(st.session_state['id']):0>6}"
+        # 差分形式では、送ったメッセージのうち最後の1件(custom_instruction付きのユーザーのメッセージ)だけを保存し、
+        # それより前はセッションのメッセージのリストの範囲[trim_start, user_message_position - 1)で指す。
+        if PROMPT_RECORD_DELTA:
+            trim_start = user_message_position - len(trimed_messages)
+            prompt_record_messages = trimed_messages[-1:]
+            prompt_history_range = (trim_start, user_message_position - 1)
+        else:
+            prompt_record_messages = trimed_messages
+            prompt_history_range = None
 
-        redisCliAccessTime.zadd(
-            "access",
-            {messages_id: now},
+        # roleも含まれた空のアシスタントのメッセージを暗号化し、応答の書き込み先としてセッションに追加する
+        assistant_messages_encrypted: bytes = storage_codec.encode_message(
+            {"role": "assistant", "content": ""}
         )
-        # RedisにメッセージIDと'prompt'のキーで、モデル名、メッセージ、タイムスタンプ、トークン数を保存します。
-        redisCliChatData.hset(
-            messages_id,
-            "prompt",
-            json.dumps(
-                {
-                    "USER_ID": USER_ID,
-                    "model": model,  #  使用するAIモデルの名前
-                    "timestamp": now,  #  メッセージのタイムスタンプ
-                    "messages": encrypted_messages,  #  トリムされ暗号化されたメッセージのリスト
-                    "num_tokens": calc_token_tiktoken(
-                        str(trimed_messages), model=model
-                    ),  #  トリムされたメッセージのトークン数
-                }
-            ),
-        )
-        redisCliChatData.expire(messages_id, EXPIRE_TIME)
 
-        #  アシスタントのメッセージを格納する辞書を初期化
-        assistant_messages: Dict[str, str] = {"role": "assistant", "content": ""}
-        # roleも含まれたmessagesについても暗号化
-        assistant_messages_encrypted: bytes = cipher_suite.encrypt(
-            json.dumps(assistant_messages).encode()
+    if not error_flag and len(turn_models) == 1:
+        # トークン数とコストは実際に応答したモデルで記録する
+        answered_model: str = stream_route.get("model", model)
+        # 戻り値はセッションIDに関連するメッセージの長さ
+        messages_length = record_model_prompt(
+            answered_model,
+            st.session_state["id"],
+            messages_id,
+            trimed_messages,
+            prompt_record_messages,
+            prompt_history_range,
+            now,
+            cached=bool(stream_usage.get("cached")),
+            assistant_placeholder=assistant_messages_encrypted,
         )
-        #  セッションIDにアシスタントのメッセージを追加
-        redisCliMessages.rpush(st.session_state["id"], assistant_messages_encrypted)
-        #  セッションIDに関連するメッセージの長さを取得
-        messages_length = redisCliMessages.llen(st.session_state["id"])
         # logger.info(f"messages_length : {messages_length}")
+        write_assistant_response = make_response_writer(
+            answered_model,
+            st.session_state["id"],
+            messages_id,
+            now,
+            stream_usage,
+            message_index=messages_length - 1,
+        )
 
         #  アシスタントからのメッセージを表示するためのストリームを開始
         with st.chat_message("assistant"):
-            #  アシスタントのメッセージを空文字列で初期化
-            assistant_msg: str = ""
+            if answered_model != model:
+                st.caption(f"{model}の応答が遅いか失敗したため、{answered_model}が応答しました")
             #  アシスタントのレスポンスを表示するためのエリアを作成
             assistant_response_area = st.empty()
-            #  レスポンスのチャンクを逐次処理
-            for chunk in response:
-                #  アシスタントのメッセージにチャンクの内容を追加
-                assistant_msg += chunk
-                # assistant_msgを暗号化
-                assistant_msg_encrypted: str = cipher_suite.encrypt(
-                    assistant_msg.encode()
-                ).decode()
+            #  レスポンスのチャンクを逐次処理し、Redisへの書き込みは一定時間・一定チャンク数毎にまとめる
+            with StreamingResponseWriter(
+                write_assistant_response,
+                flush_interval=STREAM_FLUSH_INTERVAL,
+                flush_chunks=STREAM_FLUSH_CHUNKS,
+            ) as response_writer:
+                first_chunk_at = None
+                for chunk in response:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                    #  アシスタントのメッセージにチャンクの内容を追加
+                    response_writer.append(chunk)
+                    #  アシスタントのレスポンスを表示エリアに書き込む
+                    assistant_response_area.write(response_writer.text)
+            assistant_msg: str = response_writer.text
+            logger.info(f"Response for chat : {assistant_msg}")
+            logger.debug(
+                f"response chunks : {response_writer.num_chunks}, flushes : {response_writer.num_flushes}"
+            )
+            # このやり取りの、再実行の開始から最初のチャンクまでと応答の完了までの時間。
+            # 負荷試験(load_generator.py)がsession_stateから読み出す。
+            st.session_state["last_turn_metrics"] = {
+                "error": None,
+                "ttft": (
+                    first_chunk_at - rerun_started_at
+                    if first_chunk_at is not None
+                    else None
+                ),
+                "latency": time.perf_counter() - rerun_started_at,
+                "redis_round_trips": store.round_trips.count,
+                "chunks": response_writer.num_chunks,
+                "model": answered_model,
+                "requested_model": model,
+                "hedged": stream_route.get("hedged", False),
+            }
+            current_turn_metrics.model = answered_model
+            current_turn_metrics.set(
+                "turn_seconds", st.session_state["last_turn_metrics"]["latency"]
+            )
+            current_turn_metrics.set("redis_seconds", store.round_trips.seconds)
+            st.session_state["last_turn_metrics"].update(current_turn_metrics.values)
+            store.record_turn_metrics(current_turn_metrics)
+            # logger.debug('Rerun')
 
-                #  アシスタントのメッセージを更新
-                assistant_messages["content"] = assistant_msg
-                # roleも含まれたmessagesについても暗号化
-                assistant_messages_encrypted: bytes = cipher_suite.encrypt(
-                    json.dumps(assistant_messages).encode()
-                )
+    elif not error_flag:
+        # ファンアウト: 全てのモデルを同時に呼び、届いたチャンクから横に並べた列に表示する。
+        # 待ち時間は最も遅いモデルの分になる。サイドバーで選んだモデル(先頭)の応答だけを
+        # セッションのメッセージに残し、比べるモデルはf"{messages_id}_{順番:0>2}"に
+        # プロンプトとレスポンスをそれぞれのコストで記録する。
+        fanout_usages: Dict[str, Dict[str, int]] = {m: {} for m in turn_models}
+        # 最初と最後のチャンクまでの時間は、モデル毎に呼び出したスレッドで計る
+        fanout_metrics: Dict[str, turn_metrics.TurnMetrics] = {
+            m: turn_metrics.TurnMetrics(m) for m in turn_models
+        }
+
+        def start_fanout_stream(fanout_model: str) -> Generator:
+            turn_metrics.activate(fanout_metrics[fanout_model])
+            # TTFTと失敗はmodel_routerの計測にも残す
+            return model_router.call(
+                fanout_model,
+                lambda m: common_message_function(
+                    model=m,
+                    messages=trimed_messages,
+                    stream=True,
+                    max_tokens=AVAILABLE_MODELS[m]["OUTPUT_MAX_TOKENS"],
+                    usage=fanout_usages[m],
+                    use_cache="chat" in RESPONSE_CACHE_TARGETS,
+                ),
+            )
 
-                #  セッションIDにアシスタントのメッセージを更新
-                redisCliMessages.lset(
-                    st.session_state["id"],
-                    messages_length - 1,
-                    assistant_messages_encrypted,
-                )
-                # logger.info(f"redisCliMessages set : {messages_length - 1}")
-                #  メッセージIDにアシスタントのレスポンスを保存
-                redisCliChatData.hset(
-                    messages_id,
-                    "response",
-                    json.dumps(
-                        {
-                            "USER_ID": USER_ID,
-                            "model": model,  #   使用するAIモデルの名前
-                            "timestamp": now,  #   メッセージのタイムスタンプ
-                            "messages": assistant_msg_encrypted,  #   トリムされたメッセージのリスト
-                            "num_tokens": calc_token_tiktoken(
-                                assistant_msg, model=model
-                            ),  #   トリムされたメッセージのトークン数
-                        }
-                    ),
+        fanout_writers: Dict[str, StreamingResponseWriter] = {}
+        fanout_results: Dict[str, Dict[str, Any]] = {}
+        primary_failed = False
+        with st.chat_message("assistant"):
+            fanout_areas = {}
+            for column, fanout_model in zip(st.columns(len(turn_models)), turn_models):
+                column.caption(fanout_model)
+                fanout_areas[fanout_model] = column.empty()
+            with FanOut(
+                {
+                    m: lambda fanout_model=m: start_fanout_stream(fanout_model)
+                    for m in turn_models
+                }
+            ) as fanout:
+                try:
+                    for fanout_model, kind, value in fanout:
+                        position = turn_models.index(fanout_model)
+                        if kind == FanOut.START:
+                            # 応答が始まったモデルだけ、プロンプトを記録してコストを集計する
+                            record_id = (
+                                f"{messages_id}_{position:0>2}" if position else messages_id
+                            )
+                            messages_length = record_model_prompt(
+                                fanout_model,
+                                st.session_state["id"],
+                                record_id,
+                                trimed_messages,
+                                prompt_record_messages,
+                                prompt_history_range,
+                                now,
+                                cached=bool(fanout_usages[fanout_model].get("cached")),
+                                assistant_placeholder=(
+                                    None if position else assistant_messages_encrypted
+                                ),
+                            )
+                            fanout_writers[fanout_model] = StreamingResponseWriter(
+                                make_response_writer(
+                                    fanout_model,
+                                    st.session_state["id"],
+                                    record_id,
+                                    now,
+                                    fanout_usages[fanout_model],
+                                    message_index=None if position else messages_length - 1,
+                                ),
+                                flush_interval=STREAM_FLUSH_INTERVAL,
+                                flush_chunks=STREAM_FLUSH_CHUNKS,
+                            )
+                            fanout_results[fanout_model] = {
+                                "error": None,
+                                "ttft": time.perf_counter() - rerun_started_at,
+                            }
+                        elif kind == FanOut.CHUNK:
+                            fanout_writers[fanout_model].append(value)
+                            fanout_areas[fanout_model].write(
+                                fanout_writers[fanout_model].text
+                            )
+                        else:
+                            # 終わったか途中で止まったモデルは、その時点までの応答を最後の書き込みとする
+                            response_writer = fanout_writers.pop(fanout_model, None)
+                            if response_writer is not None:
+                                response_writer.close()
+                            result = fanout_results.setdefault(fanout_model, {"ttft": None})
+                            result["latency"] = time.perf_counter() - rerun_started_at
+                            result["chunks"] = (
+                                response_writer.num_chunks if response_writer else 0
+                            )
+                            result["error"] = str(value) if kind == FanOut.ERROR else None
+                            if kind == FanOut.ERROR:
+                                fanout_areas[fanout_model].warning(value)
+                                if not position and response_writer is None:
+                                    # 選んだモデルが応答しなければ、今回のユーザーメッセージを削除する
+                                    store.remove_last_message(st.session_state["id"])
+                                    primary_failed = True
+                finally:
+                    for response_writer in fanout_writers.values():
+                        response_writer.close()
+            if primary_failed:
+                # やり取りごと取り消すので、比べるモデルの記録と"access"の索引も消す
+                store.remove_records(
+                    [
+                        f"{messages_id}_{turn_models.index(m):0>2}"
+                        for m, r in fanout_results.items()
+                        if m != model and r.get("ttft") is not None
+                    ]
                 )
-                #  アシスタントのレスポンスを表示エリアに書き込む
-                assistant_response_area.write(assistant_msg)
-            logger.info(f"Response for chat : {assistant_msg}")
-            # logger.debug('Rerun')
+            logger.info(
+                f"Responses for fan-out : { {m: r.get('error') or 'ok' for m, r in fanout_results.items()} }"
+            )
+            primary_result = fanout_results.get(model, {})
+            st.session_state["last_turn_metrics"] = {
+                "error": primary_result.get("error"),
+                "ttft": primary_result.get("ttft"),
+                "latency": time.perf_counter() - rerun_started_at,
+                "redis_round_trips": store.round_trips.count,
+                "chunks": primary_result.get("chunks"),
+                "model": model,
+                "fanout": fanout_results,
+            }
+            # メトリクスはモデル毎に記録する。再実行での計測は選んだモデルの分に含める。
+            current_turn_metrics.model = model
+            current_turn_metrics.values.update(fanout_metrics.pop(model).values)
+            current_turn_metrics.set("redis_seconds", store.round_trips.seconds)
+            fanout_metrics[model] = current_turn_metrics
+            for fanout_model, metrics in fanout_metrics.items():
+                result = fanout_results[fanout_model]
+                if not result["error"]:
+                    metrics.set("turn_seconds", result["latency"])
+                store.record_turn_metrics(metrics, error=bool(result["error"]))
+            st.session_state["last_turn_metrics"].update(current_turn_metrics.values)
+
+logger.debug(f"redis round trips in this rerun : {store.round_trips.count}")
+logger.debug(f"llm http pool : {http_pool_stats()}")
+logger.debug(f"model router : {model_router.stats()}")
+logger.debug(f"decrypted messages in this session : {history_cache.num_decrypted}")
+
+
+@st.cache_resource
+def get_rerun_counter() -> Dict[str, int]:
+    """プロセスでの再実行の回数。最初の再実行(コールドスタート)を見分けるために使う。"""
+    return {"reruns": 0}
+
+
+rerun_counter = get_rerun_counter()
+rerun_counter["reruns"] += 1
+logger.debug(
+    f"rerun time : {time.perf_counter() - rerun_started_at:.3f}s"
+    f" ({'cold start' if rerun_counter['reruns'] == 1 else 'rerun'} #{rerun_counter['reruns']})"
+)
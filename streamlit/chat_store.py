@@ -0,0 +1,591 @@
+"""
+RedisのDBへのデータアクセス層。
+
+Streamlitはやり取りの度にスクリプトを先頭から再実行するため、
+スクリプトの中でredis.Redisを作ると再実行毎に接続を張り直すことになる。
+このモジュールはimportされたまま残るので、接続プールはここでプロセスに一つだけ持つ。
+
+ChatStoreは再実行毎に作り、その再実行でのRedisへの往復回数を数える。
+複数のDBへの読み書きは、1本の接続の上でSELECTでDBを切り替えるパイプライン
+(MultiDbPipeline)にまとめ、1往復で送る。
+"""
+
+import threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from turn_metrics import TurnMetrics, queue_turn_metrics
+from usage_counter import CANCELLED_PROMPT_FIELD, queue_usage, usage_key
+
+# DB番号。各DBの構造はchat_openai0_28.pyのredisCli*の説明を参照。
+MESSAGES_DB = 0
+USER_SETTING_DB = 1
+TITLE_AT_USER_DB = 2
+ACCESS_TIME_DB = 3
+USER_ACCESS_DB = 4
+CHAT_DATA_DB = 5
+CACHE_DB = 6
+
+_connection_pools: Dict[Tuple[str, int, int], redis.ConnectionPool] = {}
+_connection_pools_lock = threading.Lock()
+
+# ユーザーのsession_idを新しい順に取り、そのタイトルも1往復で返すスクリプト。
+# floor(前回返した最も古いsession_idの最終利用時刻)以降の全てと、それより古いものをextra件返す。
+# floorが""なら新しい方からextra件返す。返す件数は閲覧した分だけで、索引全体の大きさには依らない。
+# KEYS : ユーザーのセッションの索引, タイトルのハッシュ  ARGV : since, floor, extra
+# 戻り値 : {session_idのリスト, タイトルのリスト(無ければnil), 索引があるか, 最も古い最終利用時刻, まだ古いものがあるか}
+USER_SESSIONS_SCRIPT = """
+local limit = tonumber(ARGV[3])
+if ARGV[2] ~= '' then
+    limit = limit + redis.call('ZCOUNT', KEYS[1], ARGV[2], '+inf')
+end
+local entries = redis.call('ZREVRANGEBYSCORE', KEYS[1], '+inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, limit + 1)
+if #entries == 0 then
+    return {{}, {}, redis.call('EXISTS', KEYS[1]), false, 0}
+end
+local ids = {}
+local floor = false
+for i = 1, math.min(#entries, limit * 2), 2 do
+    ids[#ids + 1] = entries[i]
+    floor = entries[i + 1]
+end
+if #ids == 0 then
+    return {{}, {}, 1, false, 1}
+end
+return {ids, redis.call('HMGET', KEYS[2], unpack(ids)), 1, floor, #entries > limit * 2 and 1 or 0}
+"""
+
+
+def get_connection_pool(
+    db: int, host: str = "redis", port: int = 6379
+) -> redis.ConnectionPool:
+    """プロセスで一つの、(host, port, db)毎の接続プールを返す。"""
+    key = (host, port, db)
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = redis.ConnectionPool(host=host, port=port, db=db)
+        return _connection_pools[key]
+
+
+def get_redis(db: int, host: str = "redis", port: int = 6379) -> redis.Redis:
+    """プロセスで共有する接続プールを使うRedisクライアントを返す。往復回数は数えない。"""
+    return redis.Redis(connection_pool=get_connection_pool(db, host, port))
+
+
+def user_sessions_key(user_id: str) -> str:
+    """ユーザーのsession_idを最終利用時刻順に管理するsorted setのキーを返す。"""
+    return f"sessions:{user_id}"
+
+
+def parse_user_sessions(reply: List[Any]) -> Dict[str, Any]:
+    """
+    USER_SESSIONS_SCRIPTの戻り値を辞書にする。
+
+    戻り値:
+        Dict[str, Any]:
+            "sessions" : (session_id, 暗号化されたタイトルかNone)のリスト
+            "index_exists" : セッションの索引があるか
+            "floor" : 返した中で最も古い最終利用時刻(次のページのカーソル)。無ければNone。
+            "has_more" : sinceまでにそれより古いセッションがあるか
+    """
+    session_ids, titles, index_exists, floor, has_more = reply
+    return {
+        "sessions": list(zip(session_ids, titles)),
+        "index_exists": bool(index_exists),
+        "floor": floor.decode() if floor else None,
+        "has_more": bool(has_more),
+    }
+
+
+class RoundTripCounter:
+    """Redisへの往復回数と、往復にかかった秒数の合計を数える。"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, num: int = 1, seconds: float = 0.0) -> None:
+        with self._lock:
+            self.count += num
+            self.seconds += seconds
+
+
+class CountingRedis(redis.Redis):
+    """
+    コマンド1回とパイプラインの実行1回をそれぞれ1往復として数え、かかった秒数も足すRedisクライアント。
+
+    引数:
+        round_trips (RoundTripCounter): 往復回数を加算するカウンター。
+        その他の引数はredis.Redisと同じ。
+    """
+
+    def __init__(self, *args, round_trips: RoundTripCounter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = round_trips
+
+    def execute_command(self, *args, **options):
+        started_at = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            self.round_trips.add(seconds=time.perf_counter() - started_at)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        round_trips = self.round_trips
+
+        def counted_execute(raise_on_error: bool = True):
+            started_at = time.perf_counter()
+            try:
+                return execute(raise_on_error)
+            finally:
+                round_trips.add(seconds=time.perf_counter() - started_at)
+
+        pipe.execute = counted_execute
+        return pipe
+
+
+class _BorrowedConnectionPool:
+    """
+    MultiDbPipelineが借りた接続を、redisのパイプラインに返させないための接続プールの代わり。
+    接続はMultiDbPipeline.executeが、実行に失敗していれば切断してから元のプールに返す。
+    """
+
+    def __init__(self, pool: redis.ConnectionPool):
+        self._pool = pool
+
+    def __getattr__(self, name: str):
+        return getattr(self._pool, name)
+
+    def release(self, connection) -> None:
+        pass
+
+
+class MultiDbPipeline:
+    """
+    1本の接続の上でSELECTでDBを切り替えながら、複数のDBへのコマンドを1往復で送るパイプライン。
+    on(db)でDBを切り替えた後は、redisのパイプラインと同じようにコマンドを積める。
+    実行の最後に元のDBへSELECTし直すため、接続は元のDBのままプールに戻る。
+    実行が途中で失敗した場合は、接続が別のDBを向いたままかもしれないので切断してからプールに戻す
+    (次に使われる時に元のDBで繋ぎ直される)。
+    execute()の戻り値にはSELECTの結果は含まれない。
+
+    引数:
+        client (redis.Redis): 接続を借りるクライアント。
+        transaction (bool): MULTI/EXECで囲んでアトミックに実行するか。
+    """
+
+    def __init__(self, client: redis.Redis, transaction: bool = True):
+        self._pool = client.connection_pool
+        self._pipe = client.pipeline(transaction=transaction)
+        self._pipe.connection_pool = _BorrowedConnectionPool(self._pool)
+        self._base_db = self._pool.connection_kwargs.get("db", 0)
+        self._db = self._base_db
+        self._select_positions: List[int] = []
+
+    def on(self, db: int) -> "MultiDbPipeline":
+        """以降のコマンドをdbに対して積む。"""
+        if db != self._db:
+            self._select_positions.append(len(self._pipe))
+            self._pipe.execute_command("SELECT", db)
+            self._db = db
+        return self
+
+    def __getattr__(self, name: str):
+        command = getattr(self._pipe, name)
+
+        def queue(*args, **kwargs) -> "MultiDbPipeline":
+            command(*args, **kwargs)
+            return self
+
+        return queue
+
+    def __len__(self) -> int:
+        return len(self._pipe) - len(self._select_positions)
+
+    def execute(self) -> List[Any]:
+        """積んだコマンドを1往復で実行し、SELECTを除いた結果を返す。"""
+        if not len(self):
+            return []
+        self.on(self._base_db)
+        skip = set(self._select_positions)
+        connection = self._get_connection()
+        self._pipe.connection = connection
+        completed = False
+        try:
+            results = self._pipe.execute()
+            completed = True
+        finally:
+            if not completed:
+                connection.disconnect()
+            self._pool.release(connection)
+        return [
+            result for position, result in enumerate(results) if position not in skip
+        ]
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_connection()
+        except TypeError:
+            # redis-pyの5.3より前はコマンド名が必要
+            return self._pool.get_connection("MULTI")
+
+
+class ChatStore:
+    """
+    チャットのデータアクセス層。再実行(またはスレッド)毎に作り、往復回数を数える。
+
+    引数:
+        host (str): Redisのホスト名。
+        port (int): Redisのポート番号。
+        connection_pools (Dict[int, redis.ConnectionPool], optional): DB番号毎の接続プール。
+            省略するとプロセスで共有する接続プールを使う。ベンチマークで偽のRedisに繋ぐ場合に渡す。
+    """
+
+    def __init__(
+        self,
+        host: str = "redis",
+        port: int = 6379,
+        connection_pools: Optional[Dict[int, redis.ConnectionPool]] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.connection_pools = connection_pools
+        self.round_trips = RoundTripCounter()
+        self.messages = self.client(MESSAGES_DB)
+        self.user_setting = self.client(USER_SETTING_DB)
+        self.title_at_user = self.client(TITLE_AT_USER_DB)
+        self.access_time = self.client(ACCESS_TIME_DB)
+        self.user_access = self.client(USER_ACCESS_DB)
+        self.chat_data = self.client(CHAT_DATA_DB)
+        self.cache = self.client(CACHE_DB)
+
+    def client(self, db: int) -> CountingRedis:
+        """共有の接続プールを使い、このChatStoreの往復回数を数えるクライアントを返す。"""
+        if self.connection_pools is not None:
+            connection_pool = self.connection_pools[db]
+        else:
+            connection_pool = get_connection_pool(db, self.host, self.port)
+        return CountingRedis(
+            connection_pool=connection_pool,
+            round_trips=self.round_trips,
+        )
+
+    def pipeline(self, transaction: bool = True) -> MultiDbPipeline:
+        """複数のDBへのコマンドを1往復で送るパイプラインを返す。"""
+        return MultiDbPipeline(self.messages, transaction=transaction)
+
+    def load_rerun_state(
+        self,
+        *,
+        user_id: str,
+        session_id: str,
+        login_time: float,
+        sessions_since: float,
+        sessions_floor: Optional[str],
+        sessions_extra: int,
+        expire_time: int,
+        history_start: int = 0,
+        response_cache_stats_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        再実行の最初に必要な読み出しと、読み出し結果によらない書き込みを1往復で行う。
+
+        行う処理:
+            ログイン時間の記録、USER_ID関連のキーの寿命の延長、ユーザー設定、
+            今日のコスト、過去のチャットの一覧とタイトル、現在のセッションのメッセージの読み出し
+            過去のチャットはsessions_floor以降の全てとそれより古いsessions_extra件(get_user_sessionsと同じ)、
+            メッセージはhistory_start以降だけを読み出す。
+            response_cache_stats_keyを渡すと応答キャッシュの統計も読み出す。
+
+        戻り値:
+            Dict[str, Any]:
+                "settings" : ユーザー設定のハッシュ(Dict[bytes, bytes])
+                "cost" : (チームのコスト, ユーザーのコスト)
+                "sessions" : 過去のチャットの一覧(parse_user_sessionsの辞書)
+                "history_length" : 現在のセッションのメッセージの長さ
+                "history" : 現在のセッションのhistory_start以降の暗号化されたメッセージのリスト
+                "response_cache" : 応答キャッシュの統計のHMGET("hits", "misses", "saved")の結果かNone
+        """
+        pipe = self.pipeline(transaction=False)
+        pipe.on(USER_ACCESS_DB)
+        pipe.zadd(user_id, {f"LOGIN_{login_time*10**9}": login_time})
+        pipe.expire(user_id, expire_time)
+        pipe.on(USER_SETTING_DB)
+        pipe.hgetall(user_id)
+        pipe.expire(user_id, expire_time)
+        pipe.on(TITLE_AT_USER_DB)
+        pipe.expire(user_id, expire_time)
+        pipe.expire(user_sessions_key(user_id), expire_time)
+        pipe.eval(
+            USER_SESSIONS_SCRIPT,
+            2,
+            user_sessions_key(user_id),
+            user_id,
+            int(sessions_since),
+            sessions_floor or "",
+            sessions_extra,
+        )
+        pipe.on(ACCESS_TIME_DB)
+        pipe.hmget(usage_key(login_time), "team", f"user:{user_id}")
+        pipe.on(MESSAGES_DB)
+        pipe.llen(session_id)
+        pipe.lrange(session_id, history_start, -1)
+        if response_cache_stats_key is not None:
+            pipe.on(CACHE_DB)
+            pipe.hmget(response_cache_stats_key, "hits", "misses", "saved")
+        (
+            _,
+            _,
+            settings,
+            _,
+            _,
+            _,
+            sessions,
+            cost,
+            history_length,
+            history,
+            *response_cache,
+        ) = pipe.execute()
+        return {
+            "settings": settings,
+            "cost": tuple(float(value or 0) for value in cost),
+            "sessions": parse_user_sessions(sessions),
+            "history_length": history_length,
+            "history": history,
+            "response_cache": response_cache[0] if response_cache else None,
+        }
+
+    def save_rerun_state(
+        self,
+        *,
+        user_id: str,
+        settings: Optional[Dict[str, Any]] = None,
+        sessions_backfill: Optional[Dict[str, float]] = None,
+        prune_before: Optional[float] = None,
+    ) -> None:
+        """
+        再実行の読み出し結果から決まる書き込みを1往復で行う。書き込むものが無ければ往復しない。
+
+        引数:
+            user_id (str): USER_ID。
+            settings (Dict[str, Any], optional): ユーザー設定に書き込むフィールド。
+            sessions_backfill (Dict[str, float], optional): セッションの索引に追加する{session_id : unixtime}。
+            prune_before (float, optional): "access"とセッションの索引からこれより古いものを消す。
+        """
+        pipe = self.pipeline(transaction=False)
+        if settings:
+            pipe.on(USER_SETTING_DB)
+            pipe.hset(user_id, mapping=settings)
+        if sessions_backfill:
+            pipe.on(TITLE_AT_USER_DB)
+            pipe.zadd(user_sessions_key(user_id), sessions_backfill)
+        if prune_before is not None:
+            pipe.on(TITLE_AT_USER_DB)
+            pipe.zremrangebyscore(user_sessions_key(user_id), "-inf", prune_before)
+            pipe.on(ACCESS_TIME_DB)
+            pipe.zremrangebyscore("access", "-inf", prune_before)
+        pipe.execute()
+
+    def get_user_sessions(
+        self,
+        user_id: str,
+        since: float,
+        floor: Optional[str] = None,
+        extra: int = 100,
+    ) -> Dict[str, Any]:
+        """
+        ユーザーのsince以降に利用したsession_idと暗号化されたタイトルを新しい順に1往復で返す。
+        floorを渡すと、その最終利用時刻以降の全てと、それより古いものをextra件返す。
+        floorを省略すると新しい方からextra件返す。
+
+        引数:
+            user_id (str): USER_ID。
+            since (float): これより前に最後に利用したセッションは返さない。
+            floor (str, optional): 前回の戻り値の"floor"。
+            extra (int): floorより古いものを返す件数。
+
+        戻り値:
+            Dict[str, Any]: parse_user_sessionsの辞書。
+        """
+        return parse_user_sessions(
+            self.title_at_user.eval(
+                USER_SESSIONS_SCRIPT,
+                2,
+                user_sessions_key(user_id),
+                user_id,
+                int(since),
+                floor or "",
+                extra,
+            )
+        )
+
+    def append_user_message(
+        self,
+        session_id: str,
+        message_encrypted: bytes,
+        expire_time: int,
+        history_start: int = 0,
+    ) -> Tuple[int, List[bytes]]:
+        """
+        ユーザーのメッセージを追加し、追加後の長さとセッションのhistory_start以降の
+        メッセージを1往復で返す。
+        """
+        length, _, history = (
+            self.pipeline(transaction=True)
+            .on(MESSAGES_DB)
+            .rpush(session_id, message_encrypted)
+            .expire(session_id, expire_time)
+            .lrange(session_id, history_start, -1)
+            .execute()
+        )
+        return length, history
+
+    def load_history(self, session_id: str) -> List[bytes]:
+        """セッションの全メッセージを返す。"""
+        return self.messages.lrange(session_id, 0, -1)
+
+    def remove_last_message(self, session_id: str) -> None:
+        """セッションの最後のメッセージを削除する。"""
+        self.messages.rpop(session_id, 1)
+
+    def record_prompt(
+        self,
+        *,
+        user_id: str,
+        session_id: str,
+        messages_id: str,
+        prompt: bytes,
+        timestamp: float,
+        assistant_placeholder: Optional[bytes],
+        usage: Dict[str, Any],
+        expire_time: int,
+    ) -> Optional[int]:
+        """
+        プロンプトの記録、アクセスとセッションの索引の更新、コストの集計、
+        アシスタントのメッセージの枠の追加を1往復でアトミックに行う。
+
+        引数:
+            user_id (str): USER_ID。
+            session_id (str): セッションID。
+            messages_id (str): メッセージID。
+            prompt (bytes): redisCliChatDataの'prompt'に保存する符号化された記録。
+            timestamp (float): タイムスタンプ。
+            assistant_placeholder (bytes, optional): 暗号化された空のアシスタントのメッセージ。
+                Noneならセッションのメッセージには追加しない(ファンアウトで比べるだけのモデル)。
+            usage (Dict[str, Any]): usage_counter.queue_usageに渡す集計の内容。
+            expire_time (int): キーの寿命(秒)。
+
+        戻り値:
+            Optional[int]: アシスタントのメッセージを追加した後のセッションのメッセージの長さ。
+                追加しなければNone。
+        """
+        pipe = self.pipeline(transaction=True)
+        pipe.on(ACCESS_TIME_DB)
+        pipe.zadd("access", {messages_id: timestamp})
+        queue_usage(pipe, **usage, expire_time=expire_time)
+        pipe.on(TITLE_AT_USER_DB)
+        pipe.zadd(user_sessions_key(user_id), {session_id: timestamp})
+        pipe.on(CHAT_DATA_DB)
+        pipe.hset(messages_id, "prompt", prompt)
+        pipe.expire(messages_id, expire_time)
+        if assistant_placeholder is None:
+            pipe.execute()
+            return None
+        pipe.on(MESSAGES_DB)
+        pipe.rpush(session_id, assistant_placeholder)
+        return pipe.execute()[-1]
+
+    def record_cancelled_prompt(
+        self,
+        *,
+        messages_id: str,
+        prompt: bytes,
+        usage: Dict[str, Any],
+        expire_time: int,
+    ) -> None:
+        """
+        ヘッジで先に他方が応答したため閉じたモデルのプロンプトの記録とコストの集計を1往復で書き込む。
+        記録はメッセージIDのCANCELLED_PROMPT_FIELDに置き、集計を作り直すときもプロンプトとして数える。
+        """
+        pipe = self.pipeline(transaction=True)
+        pipe.on(CHAT_DATA_DB)
+        pipe.hset(messages_id, CANCELLED_PROMPT_FIELD, prompt)
+        pipe.expire(messages_id, expire_time)
+        pipe.on(ACCESS_TIME_DB)
+        queue_usage(pipe, **usage, expire_time=expire_time)
+        pipe.execute()
+
+    def remove_records(self, messages_ids: List[str]) -> None:
+        """
+        メッセージIDの記録と"access"の索引を1往復で削除する。
+        コストの集計は実際に使ったトークン数なので残す。
+        """
+        if not messages_ids:
+            return
+        pipe = self.pipeline(transaction=True)
+        pipe.on(ACCESS_TIME_DB)
+        pipe.zrem("access", *messages_ids)
+        pipe.on(CHAT_DATA_DB)
+        pipe.delete(*messages_ids)
+        pipe.execute()
+
+    def write_response(
+        self,
+        *,
+        session_id: Optional[str],
+        index: Optional[int],
+        message_encrypted: Optional[bytes],
+        messages_id: str,
+        response: bytes,
+        usage: Optional[Dict[str, Any]] = None,
+        expire_time: int = 0,
+    ) -> None:
+        """
+        その時点までのアシスタントのメッセージとレスポンスの記録を1往復で書き込む。
+        usageを渡すとコストの集計にも加算する。
+        session_idがNoneならレスポンスの記録だけを書き込む(ファンアウトで比べるだけのモデル)。
+        """
+        pipe = self.pipeline(transaction=True)
+        if session_id is not None:
+            pipe.on(MESSAGES_DB)
+            pipe.lset(session_id, index, message_encrypted)
+        pipe.on(CHAT_DATA_DB)
+        pipe.hset(messages_id, "response", response)
+        if usage:
+            pipe.on(ACCESS_TIME_DB)
+            queue_usage(pipe, **usage, expire_time=expire_time)
+        pipe.execute()
+
+    def record_title(
+        self,
+        *,
+        user_id: str,
+        session_id: str,
+        title_encrypted: bytes,
+        messages_id: str,
+        prompt: bytes,
+        response: bytes,
+        usages: List[Dict[str, Any]],
+        expire_time: int,
+    ) -> None:
+        """タイトルと、タイトル生成のプロンプト・レスポンスの記録とコストの集計を1往復で書き込む。"""
+        pipe = self.pipeline(transaction=True)
+        pipe.on(TITLE_AT_USER_DB)
+        pipe.hset(user_id, session_id, title_encrypted)
+        pipe.on(CHAT_DATA_DB)
+        pipe.hset(messages_id, mapping={"prompt": prompt, "response": response})
+        pipe.expire(messages_id, expire_time)
+        pipe.on(ACCESS_TIME_DB)
+        for usage in usages:
+            queue_usage(pipe, **usage, expire_time=expire_time)
+        pipe.execute()
+
+    def record_turn_metrics(self, metrics: TurnMetrics, error: bool = False) -> None:
+        """やり取りの計測値をメトリクスのヒストグラムに1往復で加算する。"""
+        pipe = self.access_time.pipeline(transaction=False)
+        queue_turn_metrics(pipe, metrics, error=error)
+        pipe.execute()
@@ -0,0 +1,91 @@
+"""
+複数のモデルへの同時の呼び出し(ファンアウト)。
+
+同じプロンプトを選んだ複数のモデルに同時に送り、モデル毎に1つのスレッドでストリームを読み、
+届いたチャンクを到着順に1つのキューにまとめる。Streamlitの画面の更新とRedisへの書き込みは
+再実行のスレッドで行うため、呼び出し元はFanOutを反復して返るイベントを順に処理する。
+モデルを順に呼ぶと待ち時間は全てのモデルの和になるが、ファンアウトでは最も遅いモデルの分で済む。
+
+イベントは(モデル名, 種類, 値)のタプル。
+    "start" : ストリームが始まった(最初のチャンクを受け取った)。値はNone。
+    "chunk" : 応答のチャンク。値はstr。
+    "done"  : 最後まで受け取った。値はNone。
+    "error" : 呼び出しかストリームの途中で失敗した。値は例外。
+モデル毎に"start"の前か後に、"done"か"error"のどちらかが1回だけ返る。
+
+    with FanOut({"model-a": start_a, "model-b": start_b}) as fanout:
+        for model, kind, value in fanout:
+            ...
+"""
+
+import logging, queue, threading
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class FanOut:
+    """
+    モデル毎のストリームを別々のスレッドで読み、到着順のイベントとして返す。
+
+    引数:
+        starters (Dict[str, Callable[[], Iterator[str]]]): モデル名と、そのモデルを呼んで
+            ストリームを返す関数。関数はスレッドの中で呼ばれ、最初のチャンクを受け取るまで
+            戻らなくてもよい(common_message_functionのストリームと同じ)。
+        name (str): スレッドの名前の接頭辞。
+    """
+
+    # イベントの種類
+    START, CHUNK, DONE, ERROR = "start", "chunk", "done", "error"
+
+    def __init__(
+        self,
+        starters: Dict[str, Callable[[], Iterator[str]]],
+        name: str = "fanout",
+    ):
+        self._queue: "queue.Queue[Tuple[str, str, Any]]" = queue.Queue()
+        self._stop = threading.Event()
+        self._pending = len(starters)
+        self._threads = [
+            threading.Thread(
+                target=self._run, args=(model, start), name=f"{name}-{i}", daemon=True
+            )
+            for i, (model, start) in enumerate(starters.items())
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self, model: str, start: Callable[[], Iterator[str]]) -> None:
+        try:
+            stream = start()
+            self._queue.put((model, self.START, None))
+            for chunk in stream:
+                if self._stop.is_set():
+                    # 読み手がいなくなったら、残りの応答を待たずに打ち切る
+                    close = getattr(stream, "close", None)
+                    if close is not None:
+                        close()
+                    break
+                self._queue.put((model, self.CHUNK, chunk))
+            self._queue.put((model, self.DONE, None))
+        except Exception as e:
+            logger.error(f"fan-out to {model} failed: {e}")
+            self._queue.put((model, self.ERROR, e))
+
+    def __iter__(self) -> Iterator[Tuple[str, str, Any]]:
+        while self._pending:
+            event = self._queue.get()
+            if event[1] in (self.DONE, self.ERROR):
+                self._pending -= 1
+            yield event
+
+    def close(self) -> None:
+        """まだ読んでいるストリームを、次のチャンクで打ち切らせる。"""
+        self._stop.set()
+
+    def __enter__(self) -> "FanOut":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> bool:
+        self.close()
+        return False
@@ -0,0 +1,81 @@
+"""
+復号済みの会話履歴のキャッシュ。
+
+再実行の度にセッションの全メッセージを取得して復号・JSON変換すると、
+長いチャットほど1回のやり取りが遅くなる。st.session_stateにこのキャッシュを置き、
+キャッシュ済みの長さ以降の末尾だけを取得して復号する。
+
+アシスタントのメッセージはストリーミング中にLSETで書き換えられ、エラー時には
+RPOPで削除されるため、キャッシュの最後の1件は毎回取り直す。
+取得したリストの長さが合わない場合(他のタブからの書き込みなど)は全件を取り直す。
+"""
+
+from typing import Callable, List, Optional
+
+
+class HistoryCache:
+    """
+    一つのセッションの復号済みのメッセージを保持する。
+
+    使い方:
+        start = cache.fetch_start(session_id)
+        # LLENとLRANGE session_id start -1 を1往復で取得
+        if not cache.update(session_id, start, length, tail, storage_codec.decode_message):
+            cache.replace(session_id, redisCliMessages.lrange(session_id, 0, -1), storage_codec.decode_message)
+    """
+
+    def __init__(self):
+        self.session_id: Optional[str] = None
+        self.messages: List[dict] = []
+        self.num_decrypted = 0
+
+    def fetch_start(self, session_id: str) -> int:
+        """取得を始める位置を返す。セッションが変わっていればキャッシュを捨てる。"""
+        if session_id != self.session_id:
+            self.session_id = session_id
+            self.messages = []
+        # 最後の1件は書き換えられている可能性があるため取り直す
+        return max(len(self.messages) - 1, 0)
+
+    def update(
+        self,
+        session_id: str,
+        start: int,
+        length: int,
+        tail: List[bytes],
+        decode: Callable[[bytes], dict],
+    ) -> bool:
+        """
+        start以降の暗号化されたメッセージでキャッシュの末尾を置き換える。
+
+        引数:
+            session_id (str): セッションID。
+            start (int): tailの先頭の位置。fetch_startの戻り値。
+            length (int): 取得時のリストの長さ(LLEN)。
+            tail (List[bytes]): start以降の暗号化されたメッセージ。
+            decode (Callable[[bytes], dict]): 保存された値をメッセージに戻す関数。
+
+        戻り値:
+            bool: 置き換えられたか。Falseの場合はreplaceで全件を取り直す。
+        """
+        if (
+            session_id != self.session_id
+            or start > len(self.messages)
+            or start + len(tail) != length
+        ):
+            return False
+        del self.messages[start:]
+        self._extend(tail, decode)
+        return True
+
+    def replace(
+        self, session_id: str, history: List[bytes], decode: Callable[[bytes], dict]
+    ) -> None:
+        """全件の暗号化されたメッセージでキャッシュを作り直す。"""
+        self.session_id = session_id
+        self.messages = []
+        self._extend(history, decode)
+
+    def _extend(self, encoded: List[bytes], decode: Callable[[bytes], dict]) -> None:
+        self.messages.extend(decode(message) for message in encoded)
+        self.num_decrypted += len(encoded)
@@ -0,0 +1,299 @@
+"""
+同時に使うユーザー数に対する負荷試験。
+
+StreamlitのAppTestでchat_openai0_28.pyをユーザー毎に実行し、st.chat_inputに
+メッセージを入れて再実行する。画面の操作と同じコードを通るため、Redisへの読み書きや
+モデルの呼び出しも本番と同じになる。モデルはmock_llm_server.pyに向け、有料のAPIは使わない。
+ユーザーはOIDCのヘッダーの代わりに負荷試験用のメールアドレスで識別する。
+
+1回のやり取り毎に、スクリプトがsession_stateに残す
+    ttft              : 再実行の開始から最初のチャンクまでの秒数
+    latency           : 再実行の開始から応答の完了までの秒数
+    redis_round_trips : その再実行でのRedisへの往復回数
+を集め、p50/p95/p99を表示してJSONファイルに書き出す。Redisのサーバーが処理したコマンド数
+(INFO stats)の増分も、やり取りの数で割って出す(ページの表示やタイトル生成の分も含む)。
+スクリプトは同じプロセスで動くので、モデルのAPIへの接続プールの統計(新しく張った接続と
+使い回した接続の数)もそのまま読む。
+
+streamlitのコンテナで、.envの設定を読んだ状態で
+    python mock_llm_server.py --port 8000 --ttft 0.5 --tokens-per-sec 50 &
+    OPENAI_API_BASE=http://localhost:8000/v1 ANTHROPIC_API_BASE=http://localhost:8000 \\
+        python load_generator.py --users 20 --turns 5 --output load.json
+のように実行する。
+"""
+
+import argparse, datetime, json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from unittest.mock import MagicMock
+
+import redis
+import streamlit as st
+import streamlit.web.server.websocket_headers as websocket_headers
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import (
+    MemoryCacheStorageManager,
+)
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+from model_clients import http_pool_stats
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_openai0_28.py")
+
+_WORDS = "負荷 試験 の メッセージ です 。 Redis の 往復 回数 と 応答 時間 を 計る".split()
+
+
+def loadtest_headers() -> Dict[str, str]:
+    """
+    _get_websocket_headersの代わり。AppTestにはWebSocketのヘッダーが無いため、
+    session_stateに入れた負荷試験用のメールアドレスをOIDCのヘッダーとして返す。
+    """
+    return {"Oidc_claim_email": st.session_state["loadtest_email"]}
+
+
+def share_runtime() -> None:
+    """
+    AppTestは実行の度にRuntimeのシングルトンとスクリプトのキャッシュを作り、
+    終わるとRuntimeをNoneに戻すため、複数のAppTestを同時に実行すると
+    他のユーザーの実行中にRuntimeが消え、スクリプトのコンパイルも同時に走る。
+    本番の1つのstreamlitのプロセスと同じく、全ユーザーで1つずつ共有させる。
+    """
+    shared = MagicMock(spec=Runtime)
+    shared.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: shared)
+    Runtime.exists = classmethod(lambda cls: True)
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+
+def fake_message(user: int, turn: int, num_words: int) -> str:
+    """ユーザーとやり取りの番号から決まるメッセージを返す。"""
+    return " ".join(
+        _WORDS[(user * 5 + turn * 3 + i) % len(_WORDS)] for i in range(num_words)
+    )
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """valuesのpパーセンタイル(線形補間)。空ならNone。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """件数、平均、p50/p95/p99、最大を返す。"""
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def run_user(
+    user: int,
+    turns: int,
+    model: Optional[str],
+    think_time: float,
+    message_words: int,
+    timeout: float,
+    start_delay: float,
+) -> List[Dict[str, Any]]:
+    """
+    1人のユーザーとして、ページを開いてからturns回のやり取りを行う。
+
+    戻り値:
+        List[Dict[str, Any]]: やり取り毎にスクリプトが残したメトリクス。
+    """
+    time.sleep(start_delay)
+    at = AppTest.from_file(SCRIPT, default_timeout=timeout)
+    at.session_state["loadtest_email"] = f"loadtest-{user}@example.com"
+    at.run()
+    if model is not None and at.sidebar.selectbox[0].value != model:
+        at.sidebar.selectbox[0].select(model).run()
+
+    results = []
+    for turn in range(turns):
+        at.session_state["last_turn_metrics"] = None
+        started_at = time.perf_counter()
+        try:
+            at.chat_input[0].set_value(fake_message(user, turn, message_words)).run()
+            metrics = at.session_state["last_turn_metrics"]
+        except Exception as e:
+            metrics = {"error": f"{type(e).__name__}: {e}"}
+        if metrics is None:
+            # 応答まで進まなかった場合は画面に出た例外か警告を残す
+            messages = [e.message for e in at.exception] + [w.value for w in at.warning]
+            metrics = {"error": "; ".join(map(str, messages)) or "no response"}
+        metrics = {
+            **metrics,
+            "user": user,
+            "turn": turn,
+            "wall_time": time.perf_counter() - started_at,
+        }
+        results.append(metrics)
+        time.sleep(think_time)
+    return results
+
+
+def redis_commands_processed(client: redis.Redis) -> Optional[int]:
+    """Redisのサーバーが起動してから処理したコマンド数。読めなければNone。"""
+    try:
+        return client.info("stats")["total_commands_processed"]
+    except (redis.RedisError, KeyError):
+        return None
+
+
+def run_load(
+    users: int,
+    turns: int,
+    model: Optional[str] = None,
+    think_time: float = 1.0,
+    ramp_up: float = 0.0,
+    message_words: int = 20,
+    timeout: float = 120.0,
+    redis_host: str = "redis",
+    redis_port: int = 6379,
+) -> Dict[str, Any]:
+    """
+    users人のユーザーを同時に動かし、やり取りのメトリクスを集計する。
+
+    引数:
+        users (int): 同時に使うユーザー数。
+        turns (int): ユーザー毎のやり取りの回数。
+        model (str, optional): ユーザーが選ぶモデル。省略すると各ユーザーの設定のまま。
+        think_time (float): やり取りの間に待つ秒数。
+        ramp_up (float): 全ユーザーが使い始めるまでの秒数。ユーザーの開始を均等にずらす。
+        message_words (int): 送るメッセージの単語数。
+        timeout (float): 1回の再実行のタイムアウト(秒)。
+        redis_host (str): コマンド数を読むRedisのホスト名。
+        redis_port (int): コマンド数を読むRedisのポート番号。
+
+    戻り値:
+        Dict[str, Any]: 設定、集計、やり取り毎のメトリクス。
+    """
+    websocket_headers._get_websocket_headers = loadtest_headers
+    share_runtime()
+    redis_client = redis.Redis(host=redis_host, port=redis_port)
+    commands_before = redis_commands_processed(redis_client)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users, thread_name_prefix="loadtest") as executor:
+        futures = [
+            executor.submit(
+                run_user,
+                user,
+                turns,
+                model,
+                think_time,
+                message_words,
+                timeout,
+                ramp_up * user / users,
+            )
+            for user in range(users)
+        ]
+        turn_metrics = [metrics for future in futures for metrics in future.result()]
+    elapsed = time.perf_counter() - started_at
+    commands_after = redis_commands_processed(redis_client)
+
+    succeeded = [m for m in turn_metrics if not m.get("error")]
+    return {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "users": users,
+            "turns": turns,
+            "model": model,
+            "think_time": think_time,
+            "ramp_up": ramp_up,
+            "openai_api_base": os.environ.get("OPENAI_API_BASE"),
+            "anthropic_api_base": os.environ.get("ANTHROPIC_API_BASE"),
+        },
+        "summary": {
+            "elapsed": elapsed,
+            "turns": len(turn_metrics),
+            "errors": len(turn_metrics) - len(succeeded),
+            "turns_per_sec": len(succeeded) / elapsed if elapsed else None,
+            "ttft": summarize([m["ttft"] for m in succeeded if m.get("ttft") is not None]),
+            "latency": summarize([m["latency"] for m in succeeded]),
+            "redis_round_trips": summarize(
+                [m["redis_round_trips"] for m in succeeded]
+            ),
+            "redis_commands_per_turn": (
+                (commands_after - commands_before) / len(turn_metrics)
+                if turn_metrics and None not in (commands_before, commands_after)
+                else None
+            ),
+            "http_pool": http_pool_stats(),
+        },
+        "turns": turn_metrics,
+    }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="AppTestで複数のユーザーのやり取りを同時に実行し、応答時間とRedisの往復回数を計る。"
+    )
+    parser.add_argument("--users", type=int, default=10, help="同時に使うユーザー数。")
+    parser.add_argument("--turns", type=int, default=5, help="ユーザー毎のやり取りの回数。")
+    parser.add_argument("--model", help="ユーザーが選ぶモデル。省略すると各ユーザーの設定のまま。")
+    parser.add_argument("--think-time", type=float, default=1.0, help="やり取りの間に待つ秒数。")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="全ユーザーが使い始めるまでの秒数。")
+    parser.add_argument("--message-words", type=int, default=20, help="送るメッセージの単語数。")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1回の再実行のタイムアウト(秒)。")
+    parser.add_argument("--redis-host", default="redis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--output", default="load.json", help="結果を書き出すJSONファイル。")
+    args = parser.parse_args()
+
+    report = run_load(
+        args.users,
+        args.turns,
+        model=args.model,
+        think_time=args.think_time,
+        ramp_up=args.ramp_up,
+        message_words=args.message_words,
+        timeout=args.timeout,
+        redis_host=args.redis_host,
+        redis_port=args.redis_port,
+    )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    summary = report["summary"]
+    print(
+        f"users {args.users}, turns {summary['turns']}, errors {summary['errors']},"
+        f" {summary['turns_per_sec'] or 0:.2f} turns/s"
+    )
+    for name in ("ttft", "latency"):
+        stats = summary[name]
+        print(
+            f"{name:<8} p50 {format_seconds(stats['p50'])}  p95 {format_seconds(stats['p95'])}"
+            f"  p99 {format_seconds(stats['p99'])}  max {format_seconds(stats['max'])}"
+        )
+    round_trips = summary["redis_round_trips"]
+    print(
+        f"redis round trips/turn p50 {round_trips['p50']}  p95 {round_trips['p95']}"
+        f"  p99 {round_trips['p99']}"
+    )
+    if summary["redis_commands_per_turn"] is not None:
+        print(f"redis commands/turn {summary['redis_commands_per_turn']:.1f}")
+    for provider, stats in summary["http_pool"].items():
+        print(
+            f"http {provider}: requests {stats['requests']}, new connections {stats['new_connections']},"
+            f" reused {stats['reused_connections']}, connect {format_seconds(stats['connect_seconds'])}"
+        )
+    if summary["errors"]:
+        sys.exit(1)
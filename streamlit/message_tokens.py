@@ -0,0 +1,198 @@
+"""
+メッセージのトークン数の見積もりとトリム。
+
+str(messages)のトークン数を、メッセージ毎のトークン数の和で見積もる。
+メッセージ毎のトークン数はセッション毎の索引にキャッシュするため、
+トリムの度に数えるのは索引に無い新しいメッセージだけで済む。
+見積もりはメッセージの境界をまたぐBPEの結合や引用符のエスケープの分だけ実際より少なくなり得るので、
+trim_tokensはトリム後のプロンプトを最後に一度だけそのまま数え直し、超えていればさらに削除する。
+トークン数を数える関数は引数で受け取るので、streamlitを起動せずに
+ベンチマーク(benchmark.py)からも同じ処理を呼べる。
+"""
+
+from typing import Callable, Dict, List, Tuple
+
+# str(messages)で付加される"[]"と、メッセージ間の区切り", "のトークン数の見積もり
+LIST_OVERHEAD_TOKENS = 2
+SEPARATOR_TOKENS = 1
+
+
+class MessageTokenCounter:
+    """
+    メッセージのトークン数を索引を使って数える。
+
+    引数:
+        count_func (Callable[[str, str], int]): (テキスト, モデル名)からトークン数を返す関数。
+        index_max_size (int): 索引の最大件数。超えたら古いものから削除する。
+        list_overhead_tokens (int): str(messages)で付加される"[]"のトークン数。
+        separator_tokens (int): メッセージ間の区切り", "のトークン数。
+    """
+
+    def __init__(
+        self,
+        count_func: Callable[[str, str], int],
+        index_max_size: int = 1000,
+        list_overhead_tokens: int = LIST_OVERHEAD_TOKENS,
+        separator_tokens: int = SEPARATOR_TOKENS,
+    ):
+        self.count_func = count_func
+        self.index_max_size = index_max_size
+        self.list_overhead_tokens = list_overhead_tokens
+        self.separator_tokens = separator_tokens
+
+    def calc_message_tokens(
+        self,
+        message: dict,
+        model: str,
+        token_index: Dict[Tuple[str, str], int],
+    ) -> int:
+        """
+        メッセージ1件のトークン数を返す。索引に登録済みであればそれを使い、
+        未登録であればトークン数を計算して索引に登録する。
+
+        引数:
+            message (dict): {"role": role, "content": content}の形式のメッセージ。
+            model (str): モデル名。
+            token_index (Dict[Tuple[str, str], int]): (モデル名, str(message))をキーとしたトークン数の索引。
+
+        戻り値:
+            int: メッセージのトークン数。
+        """
+        key = (model, str(message))
+        if key not in token_index:
+            # 索引が大きくなりすぎたら古いものから削除する
+            if len(token_index) >= self.index_max_size:
+                token_index.pop(next(iter(token_index)))
+            token_index[key] = self.count_func(key[1], model)
+        return token_index[key]
+
+    def sum_message_tokens(
+        self,
+        messages: List[dict],
+        model: str,
+        token_index: Dict[Tuple[str, str], int],
+    ) -> int:
+        """
+        str(messages)のトークン数を、メッセージ毎のトークン数の和として見積もる。
+
+        引数:
+            messages (List[dict]): メッセージのリスト。
+            model (str): モデル名。
+            token_index (Dict[Tuple[str, str], int]): メッセージ毎のトークン数の索引。
+
+        戻り値:
+            int: メッセージのリスト全体のトークン数の見積もり。
+        """
+        if not messages:
+            return 0
+        return (
+            self.list_overhead_tokens
+            + sum(
+                self.calc_message_tokens(message, model, token_index)
+                for message in messages
+            )
+            + self.separator_tokens * (len(messages) - 1)
+        )
+
+    def trim_tokens(
+        self,
+        messages: List[dict],
+        max_tokens: int,
+        model: str = "gpt-3.5-turbo-0301",
+        token_index: Dict[Tuple[str, str], int] = None,
+    ) -> List[dict]:
+        """
+        メッセージのトークン数が指定した最大トークン数を超える場合、
+        メッセージの先頭から順に削除し、トークン数を最大トークン数以下に保つ。
+        メッセージ毎のトークン数は索引にキャッシュされるため、
+        トークン数を計算するのは索引に無い新しいメッセージと、トリム後のプロンプト全体だけである。
+
+        引数:
+            messages (List[dict]): メッセージのリスト。
+            max_tokens (int): 最大トークン数。
+            model (str): モデル名（デフォルトは'gpt-3.5-turbo-0301'）。
+            token_index (Dict[Tuple[str, str], int]): メッセージ毎のトークン数の索引。
+                省略した場合はこの呼び出しの中だけで使う索引を作る。
+
+        戻り値:
+            List[dict]: トークン数が最大トークン数以下になったメッセージのリスト。
+        """
+        if token_index is None:
+            token_index = {}
+
+        # 末尾から累積和を取り、max_tokens以下に収まる最も古いメッセージの位置を求める
+        total_tokens = self.list_overhead_tokens - self.separator_tokens
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            total_tokens += (
+                self.calc_message_tokens(messages[i], model, token_index)
+                + self.separator_tokens
+            )
+            # トークン数が最大トークン数を超えた場合、それより前のメッセージは削除対象
+            if total_tokens > max_tokens:
+                break
+            start = i
+
+        # 最後のメッセージだけでもmax_tokensを超える場合はエラー
+        if start == len(messages):
+            raise ValueError("与えられたmessageはmax_tokens以下になりません。")
+
+        # メッセージの先頭を削除
+        del messages[:start]
+
+        # 見積もりは実際より少なくなり得るため、トリム後のプロンプトを数え直す。
+        # 数えるのはmax_tokens程度のプロンプトなので、会話履歴の長さには依らない。
+        while self.count_func(str(messages), model) > max_tokens:
+            if len(messages) == 1:
+                raise ValueError("与えられたmessageはmax_tokens以下になりません。")
+            del messages[0]
+
+        # 修正されたメッセージのリストを返す
+        return messages
+
+
+def truncate_middle_to_tokens(
+    prefix: str,
+    text: str,
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+    max_chars: int = None,
+) -> Tuple[str, int]:
+    """
+    prefix + textのトークン数がmax_tokens以下になるよう、textの中央を"..."で省略する。
+    残す先頭と末尾の文字数を二分探索で決めるため、トークン数の計算はO(log n)回で済む。
+
+    引数:
+        prefix (str): 省略しない前置き。
+        text (str): 中央を省略する本文。
+        max_tokens (int): 最大トークン数。
+        count_tokens (Callable[[str], int]): 省略後の文字列のトークン数を返す関数。
+        max_chars (int, optional): 最大文字数。超える場合はトークン数を数える前に文字数で省略する。
+
+    戻り値:
+        Tuple[str, int]: 省略後の文字列とそのトークン数。
+    """
+    if max_chars is None or len(prefix) + len(text) <= max_chars:
+        content = prefix + text
+        num_tokens = count_tokens(content)
+        if num_tokens <= max_tokens:
+            return content, num_tokens
+        high = max((len(text) - 4) // 2, 0)
+    else:
+        high = max((max_chars - len(prefix) - 3) // 2, 0)
+
+    # 先頭と末尾に残す文字数kの最大値を二分探索する
+    low = 0
+    best = None
+    while low <= high:
+        k = (low + high) // 2
+        content = prefix + text[:k] + "..." + text[len(text) - k :]
+        num_tokens = count_tokens(content)
+        if num_tokens <= max_tokens:
+            best = (content, num_tokens)
+            low = k + 1
+        else:
+            high = k - 1
+    if best is None:
+        raise ValueError("与えられたtextはmax_tokens以下になりません。")
+    return best
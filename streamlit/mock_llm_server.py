@@ -0,0 +1,292 @@
+"""
+負荷試験用の、OpenAIとAnthropicのAPI互換のモックサーバー。
+
+有料のAPIを使わずに、決まった応答をストリーミングで返す。
+最初のトークンまでの時間(--ttft)、1秒あたりのトークン数(--tokens-per-sec)、
+エラーを返す割合(--error-rate)を指定できる。
+    POST .../chat/completions   : OpenAIのChat Completions(stream=Trueならserver-sent events)
+    POST .../messages           : AnthropicのMessages(stream=Trueならserver-sent events)
+    POST .../messages/count_tokens : AnthropicのトークンカウントAPI
+    GET  /health                : 死活確認
+パスの前半は問わないので、litellmは
+    OPENAI_API_BASE=http://localhost:8000/v1
+    ANTHROPIC_API_BASE=http://localhost:8000
+のように環境変数を設定すればこのサーバーに送る。
+
+    python mock_llm_server.py --port 8000 --ttft 0.5 --tokens-per-sec 50 --error-rate 0.01
+"""
+
+import argparse, json, random, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List
+
+_WORDS = "これは 負荷 試験 用の 応答 です 。 ".split()
+
+
+class MockConfig:
+    """
+    モックサーバーの応答の設定。
+
+    引数:
+        ttft (float): 最初のトークンを返すまでの秒数。
+        tokens_per_sec (float): 2つ目以降のトークンを返す速さ。0以下なら待たない。
+        response_tokens (int): 応答のトークン数。max_tokensの方が小さければそちらに従う。
+        error_rate (float): エラーを返す割合(0から1)。
+        error_status (int): エラーのHTTPステータス。
+        seed (int): エラーを返すかどうかを決める乱数のシード。
+    """
+
+    def __init__(
+        self,
+        ttft: float = 0.5,
+        tokens_per_sec: float = 50.0,
+        response_tokens: int = 100,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        seed: int = 0,
+    ):
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def num_tokens(self, max_tokens: Any) -> int:
+        if isinstance(max_tokens, int) and max_tokens > 0:
+            return min(self.response_tokens, max_tokens)
+        return self.response_tokens
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """入力のトークン数の見積もり。3文字を1トークンとして数える。"""
+    return sum(len(str(message.get("content", ""))) for message in messages) // 3 + 1
+
+
+def iter_tokens(config: MockConfig, num_tokens: int) -> Iterator[str]:
+    """設定の速さで応答のトークンを返す。最初のトークンの前にttft秒待つ。"""
+    interval = 1 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+    time.sleep(config.ttft)
+    for i in range(num_tokens):
+        if i and interval:
+            time.sleep(interval)
+        yield _WORDS[i % len(_WORDS)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    config: MockConfig = MockConfig()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # 負荷試験中はアクセスログを出さない
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/messages/count_tokens"):
+            self._send_json(
+                200, {"input_tokens": estimate_tokens(body.get("messages", []))}
+            )
+            return
+        if not path.endswith(("/chat/completions", "/messages")):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        if self.config.should_fail():
+            self._send_json(
+                self.config.error_status,
+                {"error": {"type": "mock_error", "message": "mock server error"}},
+            )
+            return
+        num_tokens = self.config.num_tokens(body.get("max_tokens"))
+        if path.endswith("/chat/completions"):
+            self._openai(body, num_tokens)
+        else:
+            self._anthropic(body, num_tokens)
+
+    def _openai(self, body: Dict[str, Any], num_tokens: int) -> None:
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        usage = {
+            "prompt_tokens": estimate_tokens(body.get("messages", [])),
+            "completion_tokens": num_tokens,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + num_tokens
+
+        def chunk(delta: dict, finish_reason=None, **extra) -> dict:
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+
+        if not body.get("stream"):
+            content = "".join(iter_tokens(self.config, num_tokens))
+            self._send_json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+        self._start_events()
+        for i, token in enumerate(iter_tokens(self.config, num_tokens)):
+            delta = {"content": token}
+            if not i:
+                delta["role"] = "assistant"
+            self._send_event(None, chunk(delta))
+        self._send_event(None, chunk({}, "stop"))
+        # OpenAIと同じく、stream_optionsのinclude_usageを指定された場合だけ、choicesが空のチャンクでトークン数を返す
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._send_event(None, {**chunk({}), "choices": [], "usage": usage})
+        self._send_raw(b"data: [DONE]\n\n")
+        self._end_events()
+
+    def _anthropic(self, body: Dict[str, Any], num_tokens: int) -> None:
+        message = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "mock"),
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": estimate_tokens(body.get("messages", [])),
+                "output_tokens": 0,
+            },
+        }
+        if not body.get("stream"):
+            content = "".join(iter_tokens(self.config, num_tokens))
+            message["content"] = [{"type": "text", "text": content}]
+            message["stop_reason"] = "end_turn"
+            message["usage"]["output_tokens"] = num_tokens
+            self._send_json(200, message)
+            return
+        self._start_events()
+        self._send_event(
+            "message_start",
+            {"type": "message_start", "message": {**message, "content": []}},
+        )
+        self._send_event(
+            "content_block_start",
+            {
+                "type": "content_block_start",
+                "index": 0,
+                "content_block": {"type": "text", "text": ""},
+            },
+        )
+        for token in iter_tokens(self.config, num_tokens):
+            self._send_event(
+                "content_block_delta",
+                {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": token},
+                },
+            )
+        self._send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self._send_event(
+            "message_delta",
+            {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": num_tokens},
+            },
+        )
+        self._send_event("message_stop", {"type": "message_stop"})
+        self._end_events()
+
+    def _send_json(self, status: int, data: Dict[str, Any]) -> None:
+        payload = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _start_events(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _send_event(self, event: str, data: Dict[str, Any]) -> None:
+        lines = f"event: {event}\n" if event else ""
+        lines += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self._send_raw(lines.encode())
+
+    def _send_raw(self, payload: bytes) -> None:
+        self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _end_events(self) -> None:
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def make_server(host: str, port: int, config: MockConfig) -> ThreadingHTTPServer:
+    """configで応答するモックサーバーを作る。serve_forever()で起動する。"""
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OpenAIとAnthropicのAPI互換の、負荷試験用のモックサーバー。"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--ttft", type=float, default=0.5, help="最初のトークンまでの秒数。")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="1秒あたりのトークン数。")
+    parser.add_argument("--response-tokens", type=int, default=100, help="応答のトークン数。")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合(0から1)。")
+    parser.add_argument("--error-status", type=int, default=500, help="エラーのHTTPステータス。")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = make_server(
+        args.host,
+        args.port,
+        MockConfig(
+            ttft=args.ttft,
+            tokens_per_sec=args.tokens_per_sec,
+            response_tokens=args.response_tokens,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            seed=args.seed,
+        ),
+    )
+    print(f"mock LLM server listening on {args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,336 @@
+"""
+モデルのAPIクライアント。
+
+litellmやanthropicはimportに時間がかかるが、サイドバーを描き直すだけの再実行では使わない。
+このモジュールはimportされたままプロセスに残るので、初めてモデルを呼ぶときにimportし、
+クライアントもプロセスで一つだけ作る。
+
+HTTPの接続はプロバイダー毎にプロセスで一つのhttpx.Client(HttpClientPool)で張り、
+keep-aliveで再実行やユーザーをまたいで使い回す。応答・トークン数の計算・タイトル生成のどれも
+同じ接続プールを通るため、2回目以降の呼び出しではTCPとTLSのハンドシェイクを待たない。
+    OpenAI、Azure : litellm.client_session
+    Anthropic     : litellm.completionのclient(HTTPHandler)と、Anthropic(http_client=...)
+接続を新しく張った回数と使い回した回数はhttpcoreのtraceで数え、stats()で読める。
+
+OpenAIのSDKはストリームの"data: [DONE]"を読んだところで応答を閉じるため、HTTP/1.1では
+chunkedの終端を読み残した接続が捨てられ、次の呼び出しで張り直しになる。KeepAliveTransportは
+最後のイベントまで読んだ応答に限って、閉じる前に読み残しを読み切り、接続をプールに戻す。
+途中で打ち切られた応答は次のチャンクを待たずにそのまま閉じる。
+HTTP/2ではストリームだけを閉じるので、読み残しがあっても接続は使い回せる。
+litellmのAnthropicのストリームは"message_stop"で止まり、応答を閉じないまま残すため、
+completionは最後まで受け取ったストリームの読み残しを読み切って接続をプールに戻す。
+
+接続プールはlitellmの公開されていない属性(client_session、HTTPHandler、get_llm_provider、
+ストリームのcompletion_stream.streaming_response)を使うため、streamlit.dockerfileでは
+確認したバージョンのlitellmとhttpxを固定している。属性が無いバージョンでは、その部分だけ
+接続プールを使わず、素のlitellm.completionを呼ぶ。
+"""
+
+import logging, threading, time
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401  HTTP/2はh2が入っている場合だけ使う
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_anthropic_client = None
+# Noneはまだ作っていない、FalseはlitellmにHTTPHandlerが無く作れない
+_anthropic_handler = None
+_http_pool: Optional["HttpClientPool"] = None
+
+# ストリームの最後のイベントの行。これを読んだ応答には、サーバーが送り終えた読み残ししか無い。
+_TERMINAL_EVENT_LINES = (b"data: [DONE]", b"event: message_stop")
+
+
+class _DrainOnCloseStream(httpx.SyncByteStream):
+    """最後のイベントまで読んでいれば、閉じる時に読み残しを読み切ってから閉じる応答の本文。"""
+
+    def __init__(self, stream: httpx.SyncByteStream):
+        self._stream = stream
+        self._iterator: Optional[Iterator[bytes]] = None
+        self._at_terminal = False
+        self._finished = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        self._iterator = iter(self._stream)
+        for chunk in self._iterator:
+            if not self._at_terminal:
+                self._at_terminal = any(
+                    line.strip().startswith(_TERMINAL_EVENT_LINES)
+                    for line in chunk.splitlines()
+                )
+            yield chunk
+        self._finished = True
+
+    def close(self) -> None:
+        # 最後のイベントの後はchunkedの終端などサーバーが送り終えた分しか残っていないので、
+        # 待たずに読み終わり、接続はプールに戻る。
+        # 途中で打ち切られたストリームは次のチャンクを待たずにそのまま閉じる(接続は捨てられる)。
+        if self._iterator is not None and self._at_terminal and not self._finished:
+            try:
+                for _ in self._iterator:
+                    pass
+                self._finished = True
+            except httpx.HTTPError:
+                pass
+        self._stream.close()
+
+
+class KeepAliveTransport(httpx.HTTPTransport):
+    """応答の本文を_DrainOnCloseStreamで包み、読み残しの終端で接続が捨てられないようにする。"""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = super().handle_request(request)
+        response.stream = _DrainOnCloseStream(response.stream)
+        return response
+
+
+class ConnectionStats:
+    """
+    1つのhttpx.Clientでのリクエスト数、新しく張った接続の数、TLSのハンドシェイクの数と、
+    接続(TCPとTLS)にかかった秒数の合計を数える。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.connect_seconds = 0.0
+
+    def on_request(self, request: httpx.Request) -> None:
+        """httpxのrequestのevent hook。このリクエストの接続の様子をtraceで受け取る。"""
+        started: Dict[str, float] = {}
+
+        def trace(event_name: str, info: Dict[str, Any]) -> None:
+            if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                started[event_name] = time.perf_counter()
+            elif event_name == "connection.connect_tcp.complete":
+                self._add_connect("connection.connect_tcp.started", started, new_connection=True)
+            elif event_name == "connection.start_tls.complete":
+                self._add_connect("connection.start_tls.started", started, tls=True)
+
+        request.extensions["trace"] = trace
+        with self._lock:
+            self.requests += 1
+
+    def _add_connect(
+        self,
+        started_event: str,
+        started: Dict[str, float],
+        new_connection: bool = False,
+        tls: bool = False,
+    ) -> None:
+        seconds = time.perf_counter() - started.pop(started_event, time.perf_counter())
+        with self._lock:
+            self.new_connections += int(new_connection)
+            self.tls_handshakes += int(tls)
+            self.connect_seconds += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(self.requests - self.new_connections, 0),
+                "tls_handshakes": self.tls_handshakes,
+                "connect_seconds": self.connect_seconds,
+            }
+
+
+class HttpClientPool:
+    """
+    プロバイダー毎に1つの、keep-aliveで接続を使い回すhttpx.Clientをプロセスで持つ。
+
+    引数:
+        max_connections (int): 1つのクライアントの最大接続数。
+        max_keepalive_connections (int): 使い終わっても張ったままにしておく接続数。
+        keepalive_expiry (float): 使われていない接続を閉じるまでの秒数。
+        connect_timeout (float): 接続のタイムアウト(秒)。
+        read_timeout (float): 読み出しのタイムアウト(秒)。ストリーミングではチャンクの間隔に掛かる。
+        http2 (bool): HTTP/2を使うか。h2が入っていなければHTTP/1.1になる。
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        http2: bool = True,
+    ):
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.http2 = http2 and h2 is not None
+        self._transport_options = {"limits": limits, "http2": self.http2}
+        self._lock = threading.Lock()
+        self._clients: Dict[str, httpx.Client] = {}
+        self._stats: Dict[str, ConnectionStats] = {}
+
+    def client(self, name: str) -> httpx.Client:
+        """nameのプロバイダーのhttpx.Clientを返す。初めて呼ばれたときに作る。"""
+        with self._lock:
+            if name not in self._clients:
+                stats = ConnectionStats()
+                self._stats[name] = stats
+                self._clients[name] = httpx.Client(
+                    transport=KeepAliveTransport(**self._transport_options),
+                    timeout=self.timeout,
+                    event_hooks={"request": [stats.on_request]},
+                )
+            return self._clients[name]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """プロバイダー毎の接続の統計を返す。"""
+        with self._lock:
+            return {name: stats.snapshot() for name, stats in self._stats.items()}
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+def configure_http_pool(pool: HttpClientPool) -> None:
+    """
+    モデルの呼び出しに使う接続プールを設定する。既にクライアントを作った後に呼んでも、
+    作ったクライアントは置き換えない(プロセスで一度だけ呼ぶ)。
+    """
+    global _http_pool
+    with _lock:
+        if _http_pool is None:
+            _http_pool = pool
+
+
+def http_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """接続プールのプロバイダー毎の統計を返す。設定されていなければ空。"""
+    return _http_pool.stats() if _http_pool is not None else {}
+
+
+def get_anthropic_client():
+    """プロセスで一つのAnthropicクライアントを返す。初めて呼ばれたときにanthropicをimportする。"""
+    global _anthropic_client
+    if _anthropic_client is None:
+        with _lock:
+            if _anthropic_client is None:
+                from anthropic import Anthropic
+
+                if _http_pool is None:
+                    _anthropic_client = Anthropic()
+                else:
+                    _anthropic_client = Anthropic(
+                        http_client=_http_pool.client("anthropic")
+                    )
+    return _anthropic_client
+
+
+def _get_anthropic_handler():
+    """
+    litellm.completionにclientとして渡す、接続プールのAnthropic用のHTTPHandlerを返す。
+    litellmにHTTPHandlerが無ければNone。
+    """
+    global _anthropic_handler
+    if _anthropic_handler is None:
+        with _lock:
+            if _anthropic_handler is None:
+                try:
+                    from litellm.llms.custom_httpx.http_handler import HTTPHandler
+                except ImportError:
+                    logger.warning("litellm has no HTTPHandler; anthropic calls will not use the pool")
+                    _anthropic_handler = False
+                else:
+                    _anthropic_handler = HTTPHandler(client=_http_pool.client("anthropic"))
+    return _anthropic_handler or None
+
+
+def _get_provider(litellm, model: str) -> Optional[str]:
+    """litellmでのモデルのプロバイダー名。判定できなければNone。"""
+    get_llm_provider = getattr(litellm, "get_llm_provider", None)
+    if get_llm_provider is None:
+        return None
+    try:
+        return get_llm_provider(model)[1]
+    except Exception:
+        return None
+
+
+def _supports_stream_usage(litellm, model: str) -> bool:
+    """
+    ストリームの最後にトークン数を返させるstream_optionsを、モデルのプロバイダーが受け付けるか。
+    判定できなければFalse(送らない)。
+    """
+    get_supported_openai_params = getattr(litellm, "get_supported_openai_params", None)
+    provider = _get_provider(litellm, model)
+    if get_supported_openai_params is None or provider is None:
+        return False
+    try:
+        params = get_supported_openai_params(model=model, custom_llm_provider=provider)
+    except Exception:
+        return False
+    return "stream_options" in (params or ())
+
+
+def _release_when_finished(stream: Iterable) -> Iterator:
+    """
+    litellmのストリームを返し、最後まで受け取ったら読み残した本文を読み切る。
+    途中で打ち切られた場合は、残りの応答を待たないよう何もしない。
+    """
+    yield from stream
+    completion_stream = getattr(stream, "completion_stream", None)
+    streaming_response = getattr(completion_stream, "streaming_response", None)
+    if streaming_response is not None:
+        try:
+            for _ in streaming_response:
+                pass
+        except (httpx.HTTPError, ValueError):
+            pass
+
+
+def completion(**kwargs: Any):
+    """
+    litellm.completionを呼ぶ。初めて呼ばれたときにlitellmをimportする。
+    接続プールが設定されていれば、OpenAIとAzureはlitellm.client_sessionで、
+    Anthropicはclientで、プロセスで共有するhttpx.Clientを使わせる。
+    litellmにそれらの属性が無ければ、接続プールを使わずにそのまま呼ぶ。
+    ストリームでは、受け付けるプロバイダーにstream_optionsで最後のチャンクにトークン数を付けさせる。
+    """
+    import litellm
+
+    if (
+        kwargs.get("stream")
+        and "stream_options" not in kwargs
+        and _supports_stream_usage(litellm, kwargs["model"])
+    ):
+        kwargs["stream_options"] = {"include_usage": True}
+
+    if _http_pool is not None and "client" not in kwargs:
+        if hasattr(litellm, "client_session") and litellm.client_session is None:
+            litellm.client_session = _http_pool.client("openai")
+        if _get_provider(litellm, kwargs["model"]) == "anthropic":
+            handler = _get_anthropic_handler()
+            if handler is not None:
+                kwargs["client"] = handler
+
+    response = litellm.completion(**kwargs)
+    if _http_pool is not None and kwargs.get("stream"):
+        return _release_when_finished(response)
+    return response
+
+
+def token_counter(**kwargs: Any) -> int:
+    """litellm.token_counterを呼ぶ。初めて呼ばれたときにlitellmをimportする。"""
+    from litellm import token_counter as litellm_token_counter
+
+    return litellm_token_counter(**kwargs)
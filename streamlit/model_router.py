@@ -0,0 +1,233 @@
+"""
+モデルの呼び出しの、最初のチャンクまでの時間に基づくヘッジとフォールバック。
+
+モデル毎に、直近の呼び出しの最初のチャンクまでの時間(TTFT)と失敗したかをLatencyTrackerに残す。
+ModelRouter.startはモデルを呼び、そのモデルのTTFTのパーセンタイルを過ぎても最初のチャンクが
+来なければ、設定されたフォールバックのモデルにも同じリクエストを送り(ヘッジ)、先に最初のチャンクが
+届いた方を使う。もう一方は最初のチャンクが届いた時点で閉じ、残りの応答を読まない。
+閉じた方にも送ったプロンプトの分のコストはかかるため、on_cancelledで呼び出し元に知らせる。
+最初のモデルが最初のチャンクの前に失敗した場合や、直近の失敗の割合が高い場合は、待たずにフォールバックする。
+
+呼び出し(common_message_functionのストリーム)は最初のチャンクを受け取るまで戻らないため、
+待ち時間を区切れるようにスレッドで呼ぶ。計測はプロセス毎で、st.cache_resourceで共有する。
+"""
+
+import logging, queue, threading, time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """
+    モデル毎の直近window_size回の呼び出しのTTFTと失敗を残す。
+
+    引数:
+        window_size (int): モデル毎に残す呼び出しの数。
+        min_samples (int): パーセンタイルと失敗の割合を返すのに必要な呼び出しの数。
+    """
+
+    def __init__(self, window_size: int = 100, min_samples: int = 20):
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        # {モデル名 : deque([TTFT(失敗ならNone), ...])}
+        self._samples: Dict[str, Deque[Optional[float]]] = {}
+
+    def record(self, model: str, ttft: Optional[float]) -> None:
+        """呼び出しのTTFTを残す。失敗した呼び出しはNoneを渡す。"""
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=self.window_size))
+            samples.append(ttft)
+
+    def ttft_percentile(self, model: str, percentile: float) -> Optional[float]:
+        """成功した呼び出しのTTFTのパーセンタイル(nearest-rank)。呼び出しが少なければNone。"""
+        with self._lock:
+            ttfts = sorted(t for t in self._samples.get(model, ()) if t is not None)
+        if len(ttfts) < self.min_samples:
+            return None
+        rank = max(int(len(ttfts) * percentile / 100 + 0.5), 1)
+        return ttfts[min(rank, len(ttfts)) - 1]
+
+    def error_rate(self, model: str) -> Optional[float]:
+        """失敗した呼び出しの割合。呼び出しが少なければNone。"""
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return sum(t is None for t in samples) / len(samples)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """モデル毎の呼び出しの数、失敗の割合、TTFTのp50/p95。"""
+        with self._lock:
+            models = list(self._samples)
+        return {
+            model: {
+                "samples": len(self._samples[model]),
+                "error_rate": self.error_rate(model),
+                "ttft_p50": self.ttft_percentile(model, 50),
+                "ttft_p95": self.ttft_percentile(model, 95),
+            }
+            for model in models
+        }
+
+
+class ModelRouter:
+    """
+    LatencyTrackerの計測に基づいて、ヘッジとフォールバックを行う。
+
+    引数:
+        tracker (LatencyTracker): モデル毎の計測。
+        percentile (float): ヘッジするまで待つTTFTのパーセンタイル。
+        default_delay (float): 計測が少ないモデルで、ヘッジするまで待つ秒数。
+        min_delay (float): ヘッジするまで待つ最短の秒数。
+        error_rate_threshold (float): 直近の失敗の割合がこれ以上のモデルは、待たずにフォールバックも呼ぶ。
+    """
+
+    def __init__(
+        self,
+        tracker: LatencyTracker,
+        percentile: float = 95.0,
+        default_delay: float = 10.0,
+        min_delay: float = 0.5,
+        error_rate_threshold: float = 0.5,
+    ):
+        self.tracker = tracker
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.error_rate_threshold = error_rate_threshold
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "hedged": 0, "fallback_answered": 0}
+
+    def hedge_delay(self, model: str) -> float:
+        """modelを呼んでからヘッジするまで待つ秒数。"""
+        error_rate = self.tracker.error_rate(model)
+        if error_rate is not None and error_rate >= self.error_rate_threshold:
+            return 0.0
+        ttft = self.tracker.ttft_percentile(model, self.percentile)
+        if ttft is None:
+            return self.default_delay
+        return max(ttft, self.min_delay)
+
+    def call(self, model: str, start: Callable[[str], Iterator[str]]) -> Iterator[str]:
+        """start(model)を呼び、TTFTか失敗を計測に残す。"""
+        started_at = time.perf_counter()
+        try:
+            stream = start(model)
+        except Exception:
+            self.tracker.record(model, None)
+            raise
+        self.tracker.record(model, time.perf_counter() - started_at)
+        return stream
+
+    def start(
+        self,
+        model: str,
+        fallback: Optional[str],
+        start: Callable[[str], Iterator[str]],
+        allow_fallback: Callable[[str], bool] = None,
+        on_cancelled: Callable[[str], None] = None,
+    ) -> Tuple[str, Iterator[str]]:
+        """
+        modelを呼び、hedge_delay秒待っても最初のチャンクが来ないか失敗したらfallbackも呼び、
+        先に最初のチャンクが届いた方のストリームを返す。
+
+        引数:
+            model (str): 呼ぶモデル名。
+            fallback (str, optional): ヘッジとフォールバックに使うモデル名。Noneなら待たずにmodelだけを呼ぶ。
+            start (Callable[[str], Iterator[str]]): モデル名を受け取って呼び、最初のチャンクを
+                受け取った状態のストリームを返す関数。別のスレッドで呼ばれる。
+            allow_fallback (Callable[[str], bool], optional): fallbackを呼ぶと決めた後、呼ぶ直前にだけ呼び、
+                Falseなら呼ばない。レート制限の枠の確保に使う。
+            on_cancelled (Callable[[str], None], optional): 先に他方が応答したため閉じたストリームのモデル名を
+                受け取る関数。閉じたスレッドで呼ばれる。コストの集計に使う。
+
+        戻り値:
+            Tuple[str, Iterator[str]]: (応答したモデル名, ストリーム)。
+
+        例外:
+            両方とも(fallbackを呼ばなければmodelが)失敗した場合は、modelの例外を送出する。
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+        if fallback is None:
+            return model, self.call(model, start)
+
+        results: "queue.Queue[Tuple[str, Optional[Iterator[str]], Optional[Exception]]]" = queue.Queue()
+        decided = threading.Event()
+        decided_lock = threading.Lock()
+
+        def attempt(attempt_model: str) -> None:
+            try:
+                stream = self.call(attempt_model, start)
+            except Exception as e:
+                results.put((attempt_model, None, e))
+                return
+            with decided_lock:
+                lost = decided.is_set()
+                if not lost:
+                    decided.set()
+            if lost:
+                # 既に他方が応答しているので、最初のチャンクだけで閉じる
+                close = getattr(stream, "close", None)
+                if close is not None:
+                    close()
+                logger.debug(f"cancelled the slower request to {attempt_model}")
+                if on_cancelled is not None:
+                    try:
+                        on_cancelled(attempt_model)
+                    except Exception as e:
+                        logger.error(f"on_cancelled failed for {attempt_model}: {e}")
+                return
+            results.put((attempt_model, stream, None))
+
+        def launch(attempt_model: str) -> None:
+            threading.Thread(
+                target=attempt, args=(attempt_model,), name=f"hedge-{attempt_model}", daemon=True
+            ).start()
+
+        launch(model)
+        pending = 1
+        errors: Dict[str, Exception] = {}
+        try:
+            answered, stream, error = results.get(timeout=self.hedge_delay(model))
+            pending -= 1
+        except queue.Empty:
+            if decided.is_set():
+                # 待ち終わった直後にmodelが応答していれば、fallbackの枠を確保せずにそれを使う
+                answered, stream, error = results.get()
+                pending -= 1
+            else:
+                answered, stream, error = model, None, None
+        if stream is not None:
+            return answered, stream
+        if error is not None:
+            errors[answered] = error
+
+        if allow_fallback is None or allow_fallback(fallback):
+            logger.info(
+                f"hedging {model} with {fallback}"
+                + (f" after error: {error}" if error is not None else "")
+            )
+            with self._lock:
+                self._stats["hedged"] += 1
+            launch(fallback)
+            pending += 1
+        while pending:
+            answered, stream, error = results.get()
+            pending -= 1
+            if stream is not None:
+                if answered != model:
+                    with self._lock:
+                        self._stats["fallback_answered"] += 1
+                return answered, stream
+            errors[answered] = error
+        raise errors.get(model) or next(iter(errors.values()))
+
+    def stats(self) -> Dict[str, Any]:
+        """呼び出し、ヘッジ、フォールバックが応答した回数と、モデル毎の計測。"""
+        with self._lock:
+            stats = dict(self._stats)
+        return {**stats, "models": self.tracker.stats()}
@@ -0,0 +1,235 @@
+"""
+Redis上のLuaスクリプトによるレート制限。
+
+複数のスライディングウィンドウ(回数制限)とトークンバケット(トークン数制限)を、
+1回の往復でアトミックに確認し、全て通った場合だけ記録する。
+同時に来たリクエストが両方とも確認を通ってしまうことが無い。
+
+ウィンドウはsorted set({member : unixtime(as score)})、バケットはハッシュ
+({"tokens" : 残りトークン数, "ts" : 最後に更新したunixtime})で管理する。
+
+順番待ちの列(admission_queue.AdmissionQueue)を渡すと、列に待っているリクエストがある間は、
+全体で共有する制限には列の前の待ちの分の空きを残して確認する。リクエスト自身のユーザーやモデルの
+制限(own_limits)は前の待ちの分を残さずに確認するため、列の先頭が自分のユーザーの制限で
+止まっていても、後ろの他のユーザーのリクエストは全体の制限に空きがあれば通る。
+列に並んだリクエストが通った場合は、同じ往復で列から取り除く。
+"""
+
+import time
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+import redis
+
+if TYPE_CHECKING:
+    from admission_queue import AdmissionQueue
+
+# KEYS : ウィンドウのキー(n_windows個)、バケットのキー(n_buckets個)、
+#        順番待ちの列を使う場合は続けて(列, 最後に確認した時刻, 状態)のキー
+# ARGV : now, member, n_windows, n_buckets,
+#        ウィンドウ毎に(limit, period, shared)、バケット毎に(capacity, period, cost, shared)、
+#        順番待ちの列を使う場合は続けてstale_after
+#        sharedは全体で共有する制限なら1、リクエスト自身のユーザーやモデルの制限なら0
+# 戻り値 : 通った場合は{1}、超えた場合は{0, 超えた制限の番号(1始まり。共有する制限を前の待ちに残すためなら0),
+#          再試行までのミリ秒(前の待ちに残すためなら、前の待ちが全て通って順番が来ると見込まれるまでのミリ秒),
+#          列でのmemberの順位(0始まり。列に無ければ-1), 列の長さ}
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local member = ARGV[2]
+local n_windows = tonumber(ARGV[3])
+local n_buckets = tonumber(ARGV[4])
+local idx = 5
+
+local queue_key, seen_key, state_key
+local rank = false
+local queue_length = 0
+-- 先に通る待ちの数。共有する制限には、この数の待ちの分の空きを残す
+local ahead = 0
+if #KEYS > n_windows + n_buckets then
+    queue_key = KEYS[n_windows + n_buckets + 1]
+    seen_key = KEYS[n_windows + n_buckets + 2]
+    state_key = KEYS[n_windows + n_buckets + 3]
+    local stale_after = tonumber(ARGV[#ARGV])
+    -- しばらく確認に来ていない(画面を閉じたなどの)待ちを列から除く
+    for _, stale in ipairs(redis.call('ZRANGEBYSCORE', seen_key, '-inf', now - stale_after)) do
+        redis.call('ZREM', queue_key, stale)
+        redis.call('ZREM', seen_key, stale)
+    end
+    rank = redis.call('ZRANK', queue_key, member)
+    if rank then
+        redis.call('ZADD', seen_key, now, member)
+    end
+    queue_length = redis.call('ZCARD', queue_key)
+    local head = redis.call('ZRANGE', queue_key, 0, 0)
+    if head[1] and head[1] ~= member then
+        ahead = rank or queue_length
+    end
+end
+
+-- 先に通る待ちがあれば、その分も空くまでの時間を共有する制限で見積もる。
+-- 自身のユーザーやモデルの制限は前の待ちと関係なく確認する
+local held = false
+local expected = 0
+local windows = {}
+for i = 1, n_windows do
+    local key = KEYS[i]
+    local limit = tonumber(ARGV[idx])
+    local period = tonumber(ARGV[idx + 1])
+    local before = ahead * tonumber(ARGV[idx + 2])
+    idx = idx + 3
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - period)
+    local count = redis.call('ZCARD', key)
+    if count + before >= limit then
+        -- 列のm番目(0始まり)は、記録と先に通った待ちを古い順に並べたm + count - limit番目が期限切れになる時刻に通る
+        local first = math.max(0, count - limit)
+        local scores = redis.call('ZRANGE', key, first, -1, 'WITHSCORES')
+        local slots = {}
+        for m = 0, before do
+            local index = m + count - limit
+            if index < 0 then
+                slots[m] = now
+            elseif index < count then
+                slots[m] = tonumber(scores[(index - first) * 2 + 2]) + period
+            else
+                slots[m] = slots[index - count] + period
+            end
+        end
+        local retry_after = math.max(0, slots[before] - now)
+        if before == 0 then
+            return {0, i, math.ceil(retry_after * 1000), rank or -1, queue_length}
+        end
+        held = true
+        expected = math.max(expected, retry_after)
+    end
+    windows[i] = {key, period}
+end
+
+local buckets = {}
+for j = 1, n_buckets do
+    local key = KEYS[n_windows + j]
+    local capacity = tonumber(ARGV[idx])
+    local period = tonumber(ARGV[idx + 1])
+    local cost = tonumber(ARGV[idx + 2])
+    local before = ahead * tonumber(ARGV[idx + 3])
+    idx = idx + 4
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * capacity / period)
+    -- 先に通る待ちも同じトークン数を消費するとみなす
+    local needed = cost * (before + 1)
+    if tokens < needed then
+        local retry_after = (needed - tokens) * period / capacity
+        if before == 0 then
+            return {0, n_windows + j, math.ceil(retry_after * 1000), rank or -1, queue_length}
+        end
+        held = true
+        expected = math.max(expected, retry_after)
+    end
+    buckets[j] = {key, tokens - cost, period}
+end
+if held then
+    return {0, 0, math.ceil(expected * 1000), rank or -1, queue_length}
+end
+
+for i = 1, n_windows do
+    redis.call('ZADD', windows[i][1], now, member)
+    redis.call('EXPIRE', windows[i][1], math.ceil(windows[i][2]) + 1)
+end
+for j = 1, n_buckets do
+    redis.call('HSET', buckets[j][1], 'tokens', tostring(buckets[j][2]), 'ts', tostring(now))
+    redis.call('EXPIRE', buckets[j][1], math.ceil(buckets[j][3]) + 1)
+end
+-- 列の待ちが通ったら列から取り除き、公平な順番の基準の時刻をその順番まで進める
+-- (先頭より後ろが先に通っても、基準の時刻は戻さない)
+if rank then
+    local clock = tonumber(redis.call('HGET', state_key, 'clock')) or 0
+    local finish = tonumber(redis.call('ZSCORE', queue_key, member))
+    redis.call('HSET', state_key, 'clock', tostring(math.max(clock, finish)))
+    redis.call('ZREM', queue_key, member)
+    redis.call('ZREM', seen_key, member)
+end
+return {1}
+"""
+
+
+class RateLimiter:
+    """
+    複数の制限をまとめて確認し記録するレート制限。
+
+    引数:
+        redis_client (redis.Redis): 制限のキーを保存するRedisクライアント。
+        key_prefix (str): 制限のキーの接頭辞。
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str = "ratelimit"):
+        self.key_prefix = key_prefix
+        self._script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+
+    def acquire(
+        self,
+        member: str,
+        windows: List[Tuple[str, int, float]] = (),
+        buckets: List[Tuple[str, int, float, int]] = (),
+        now: Optional[float] = None,
+        admission: Optional["AdmissionQueue"] = None,
+        own_limits: Sequence[str] = (),
+    ) -> Tuple[bool, Optional[str], float]:
+        """
+        全ての制限を確認し、全て通った場合だけ記録する。
+
+        引数:
+            member (str): ウィンドウに記録する一意な名前。
+            windows (List[Tuple[str, int, float]]): (名前, period秒あたりの回数の上限, period)のリスト。
+            buckets (List[Tuple[str, int, float, int]]): (名前, period秒あたりのトークン数の上限, period, 今回消費するトークン数)のリスト。
+            now (float, optional): 現在時刻(unixtime)。省略すると時計から取る。
+            admission (AdmissionQueue, optional): 順番待ちの列。列に待ちがあれば、共有する制限には
+                列でmemberより前の待ち(列に無ければ列の全ての待ち)の分の空きを残す。
+            own_limits (Sequence[str], optional): リクエスト自身のユーザーやモデルの制限の名前。
+                これらの制限は前の待ちの分を残さずに確認する。それ以外は全体で共有する制限とみなす。
+
+        戻り値:
+            Tuple[bool, Optional[str], float]: (通ったか, 超えた制限の名前, 再試行までの秒数)
+                前の待ちの分の空きが無いため通らなかった場合、超えた制限の名前は"admission"。
+        """
+        return self.acquire_queued(member, windows, buckets, now, admission, own_limits)[:3]
+
+    def acquire_queued(
+        self,
+        member: str,
+        windows: List[Tuple[str, int, float]] = (),
+        buckets: List[Tuple[str, int, float, int]] = (),
+        now: Optional[float] = None,
+        admission: Optional["AdmissionQueue"] = None,
+        own_limits: Sequence[str] = (),
+    ) -> Tuple[bool, Optional[str], float, int, int]:
+        """
+        acquireと同じく確認し、列でのmemberの順位と列の長さも返す。
+
+        戻り値:
+            Tuple[bool, Optional[str], float, int, int]: (通ったか, 超えた制限の名前, 再試行までの秒数,
+                列でのmemberの順位(0始まり。列に無ければ-1), 列の長さ)。通った場合の順位は-1。
+                前の待ちの分の空きが無い場合の再試行までの秒数は、前の待ちが全て通って順番が来ると見込まれるまでの秒数。
+        """
+        now = time.time() if now is None else now
+        names = [window[0] for window in windows] + [bucket[0] for bucket in buckets]
+        keys = [f"{self.key_prefix}:{name}" for name in names]
+        args = [repr(now), member, len(windows), len(buckets)]
+        for name, limit, period in windows:
+            args += [limit, period, int(name not in own_limits)]
+        for name, capacity, period, cost in buckets:
+            # 上限より大きい消費は永久に通らないため、上限までに丸める
+            args += [capacity, period, min(cost, capacity), int(name not in own_limits)]
+        if admission is not None:
+            keys += admission.keys()
+            args.append(admission.stale_after)
+        result = self._script(keys=keys, args=args)
+        if int(result[0]):
+            return True, None, 0.0, -1, 0
+        exceeded = int(result[1])
+        return (
+            False,
+            names[exceeded - 1] if exceeded else "admission",
+            int(result[2]) / 1000,
+            int(result[3]),
+            int(result[4]),
+        )
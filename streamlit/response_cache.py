@@ -0,0 +1,175 @@
+"""
+モデルの応答の完全一致キャッシュ。
+
+タイトル生成のように同じ入力がよく来る呼び出しで、(モデル名, max_tokens, トリム後のメッセージ)
+のハッシュをキーに応答をRedisに保存し、同じ入力では応答を再利用する。
+応答はstorage_codecで圧縮・暗号化して保存し、寿命(expire_time)と件数の上限(max_entries)を持つ。
+件数は索引のsorted set({キー : 最後に使ったunixtime(as score)})で管理し、上限を超えたら
+最後に使ったのが古いものから削除する。
+
+ヒット数、ミス数、節約したコストは日毎のハッシュ
+f"{key_prefix}:stats:{YYYY-MM-DD}" : {"hits" : int, "misses" : int, "saved" : float}
+に記録する。Redisが使えない場合はキャッシュ無しとして動く。
+"""
+
+import datetime, hashlib, time
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from storage_codec import StorageCodec, compact_json
+
+# KEYS : 応答のキー, 索引, 統計のハッシュ  ARGV : now, 節約するコスト, 統計の寿命
+# 戻り値 : 応答(無ければnil)
+LOOKUP_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('ZADD', KEYS[2], 'XX', ARGV[1], KEYS[1])
+    redis.call('HINCRBY', KEYS[3], 'hits', 1)
+    redis.call('HINCRBYFLOAT', KEYS[3], 'saved', ARGV[2])
+else
+    redis.call('HINCRBY', KEYS[3], 'misses', 1)
+end
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+return value
+"""
+
+
+class ResponseCache:
+    """
+    モデルの応答をRedisに暗号化して保存するキャッシュ。
+
+    引数:
+        redis_client (redis.Redis): キャッシュを保存するRedisクライアント。
+        codec (StorageCodec): 応答を圧縮・暗号化するコーデック。
+        expire_time (int): 応答の寿命(秒)。
+        max_entries (int): 保存する応答の件数の上限。
+        stats_expire_time (int): 日毎の統計の寿命(秒)。
+        key_prefix (str): キーの接頭辞。
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        codec: StorageCodec,
+        expire_time: int = 24 * 3600,
+        max_entries: int = 1000,
+        stats_expire_time: int = 24 * 3600 * 366,
+        key_prefix: str = "response_cache",
+    ):
+        self.redis_client = redis_client
+        self.codec = codec
+        self.expire_time = expire_time
+        self.max_entries = max_entries
+        self.stats_expire_time = stats_expire_time
+        self.key_prefix = key_prefix
+        self.index_key = f"{key_prefix}:index"
+        self._lookup = redis_client.register_script(LOOKUP_SCRIPT)
+
+    def key(self, model: str, max_tokens: Optional[int], messages: List[dict]) -> str:
+        """(モデル名, max_tokens, メッセージ)のハッシュから応答のキーを作る。"""
+        digest = hashlib.sha256(
+            compact_json([model, max_tokens, messages]).encode()
+        ).hexdigest()
+        return f"{self.key_prefix}:{digest}"
+
+    def stats_key(self, timestamp: float) -> str:
+        """timestampのローカル日付の統計のハッシュのキーを返す。"""
+        day = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+        return f"{self.key_prefix}:stats:{day}"
+
+    def get(
+        self,
+        model: str,
+        max_tokens: Optional[int],
+        messages: List[dict],
+        saved_cost: float = 0.0,
+    ) -> Optional[str]:
+        """
+        保存された応答を1往復で返し、ヒットかミスかを統計に記録する。
+
+        引数:
+            model (str): モデル名。
+            max_tokens (int): 生成するトークンの最大数。
+            messages (List[dict]): トリム後のメッセージ。
+            saved_cost (float): ヒットした場合に節約できたコスト。
+
+        戻り値:
+            Optional[str]: 保存された応答。無ければNone。
+        """
+        now = time.time()
+        try:
+            value = self._lookup(
+                keys=[
+                    self.key(model, max_tokens, messages),
+                    self.index_key,
+                    self.stats_key(now),
+                ],
+                args=[repr(now), repr(saved_cost), self.stats_expire_time],
+            )
+        except redis.RedisError:
+            return None
+        if value is None:
+            return None
+        return self.codec.decode_message(value)["content"]
+
+    def put(
+        self, model: str, max_tokens: Optional[int], messages: List[dict], content: str
+    ) -> None:
+        """応答を保存する。件数が上限を超えたら、最後に使ったのが古いものから削除する。"""
+        try:
+            self._put(model, max_tokens, messages, content)
+        except redis.RedisError:
+            pass
+
+    def _put(
+        self, model: str, max_tokens: Optional[int], messages: List[dict], content: str
+    ) -> None:
+        now = time.time()
+        key = self.key(model, max_tokens, messages)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.set(
+            key,
+            self.codec.encode_message({"role": "assistant", "content": content}),
+            ex=self.expire_time,
+        )
+        pipe.zadd(self.index_key, {key: now})
+        # 寿命で消えた応答を索引からも消す
+        pipe.zremrangebyscore(self.index_key, "-inf", now - self.expire_time)
+        pipe.expire(self.index_key, self.expire_time)
+        pipe.zcard(self.index_key)
+        num_entries = pipe.execute()[-1]
+        if num_entries <= self.max_entries:
+            return
+        evicted = [
+            member
+            for member, _ in self.redis_client.zpopmin(
+                self.index_key, num_entries - self.max_entries
+            )
+        ]
+        if evicted:
+            self.redis_client.delete(*evicted)
+
+    def get_stats(self, timestamp: float) -> Tuple[int, int, float]:
+        """timestampの日の(ヒット数, ミス数, 節約したコスト)を返す。"""
+        return parse_stats(
+            self.redis_client.hmget(self.stats_key(timestamp), "hits", "misses", "saved")
+        )
+
+
+def parse_stats(values: List[Optional[bytes]]) -> Tuple[int, int, float]:
+    """統計のハッシュのHMGET("hits", "misses", "saved")の結果を数値にする。"""
+    hits, misses, saved = values
+    return int(hits or 0), int(misses or 0), float(saved or 0)
+
+
+def stats_summary(stats: Tuple[int, int, float]) -> Dict[str, float]:
+    """(ヒット数, ミス数, 節約したコスト)からヒット率を含む辞書を作る。"""
+    hits, misses, saved = stats
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+        "saved": saved,
+    }
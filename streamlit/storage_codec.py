@@ -0,0 +1,377 @@
+"""
+redisCliMessagesとredisCliChatDataに保存する値の形式(コーデック)。
+
+旧形式(バージョン0)は、メッセージをJSONにしてFernetで暗号化したbase64の文字列で、
+redisCliChatDataではさらにそれをメタデータと一緒にJSONで包んでいた。
+新形式(バージョン1)は以下のバイナリで、base64と二重のJSONの分だけ小さくなる。
+    メッセージ : MAGIC(2) + バージョン(1) + 圧縮方式(1) + Fernetのトークン(base64を戻した生のbytes)
+    チャットデータ : MAGIC(2) + バージョン(1) + 圧縮方式(1) + メタデータの長さ(4, big endian)
+                   + メタデータ(USER_ID, model, timestamp, num_tokensのJSON) + Fernetのトークン
+プロンプトの記録は、毎回トリムされた会話全体を保存すると会話の長さの2乗で増えるため、
+新しいターン(実際に送ったユーザーのメッセージ)だけを保存し、それより前の部分は
+メタデータのhistory_range([start, stop])でセッションのメッセージのリストの範囲を指す
+差分形式にできる。送ったプロンプトは
+    redisCliMessagesのsession_idのリスト[start:stop] + 保存したターン
+で復元できる(rebuild_prompt)。
+暗号化する前の平文は、compress_min_bytes以上で圧縮して小さくなる場合だけzlib(zstandardが
+入っていればzstdも選べる)で圧縮する。メタデータは鍵が無くても読めるよう暗号化しない。
+
+読み出しは先頭のMAGICで形式を判別するため、旧形式の値もそのまま読める。
+既存の値を新形式に変換するには、streamlitのコンテナで
+    python storage_codec.py --migrate [--dry-run]
+を実行する。
+"""
+
+import argparse, base64, json, os, struct, zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+from cryptography.fernet import Fernet
+
+from turn_metrics import measure
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"\x00\xc1"
+LEGACY_VERSION = 0
+CURRENT_VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSIONS = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "zstd": COMPRESSION_ZSTD,
+}
+
+_HEADER = struct.Struct(">2sBB")
+_METADATA_LENGTH = struct.Struct(">I")
+
+
+def compact_json(obj: Any) -> str:
+    """空白を入れず、日本語をエスケープしないJSONにする。"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def is_legacy(value: bytes) -> bool:
+    """旧形式の値かどうかを返す。"""
+    return not value.startswith(MAGIC)
+
+
+def read_record_metadata(value: bytes) -> Dict[str, Any]:
+    """
+    チャットデータの値から、復号せずにUSER_ID, model, timestamp, num_tokens
+    (差分形式のプロンプトではhistory_range、応答キャッシュで返した記録ではcachedも)を読む。
+    旧形式の値ではmessages(暗号化された文字列)も含めた辞書全体を返す。
+    """
+    if is_legacy(value):
+        return json.loads(value)
+    (metadata_length,) = _METADATA_LENGTH.unpack_from(value, _HEADER.size)
+    start = _HEADER.size + _METADATA_LENGTH.size
+    return json.loads(value[start : start + metadata_length])
+
+
+class StorageCodec:
+    """
+    メッセージとチャットデータの値を圧縮・暗号化して保存する形式にし、また元に戻す。
+
+    引数:
+        cipher (Fernet): 暗号化インスタンス。
+        compression (str): "none", "zlib", "zstd"のいずれか。zstandardが無ければzstdはzlibになる。
+        compress_min_bytes (int): 平文がこのバイト数以上の場合だけ圧縮する。
+        write_version (int): 書き込む形式のバージョン。0にすると旧形式で書き込む(切り戻し用)。
+    """
+
+    def __init__(
+        self,
+        cipher: Fernet,
+        compression: str = "zlib",
+        compress_min_bytes: int = 256,
+        write_version: int = CURRENT_VERSION,
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression : {compression}")
+        if compression == "zstd" and zstandard is None:
+            compression = "zlib"
+        if write_version not in (LEGACY_VERSION, CURRENT_VERSION):
+            raise ValueError(f"Unknown storage format version : {write_version}")
+        self.cipher = cipher
+        self.compression = COMPRESSIONS[compression]
+        self.compress_min_bytes = compress_min_bytes
+        self.write_version = write_version
+
+    def _compress(self, plain: bytes) -> tuple:
+        if self.compression == COMPRESSION_NONE or len(plain) < self.compress_min_bytes:
+            return COMPRESSION_NONE, plain
+        if self.compression == COMPRESSION_ZSTD:
+            compressed = zstandard.ZstdCompressor().compress(plain)
+        else:
+            compressed = zlib.compress(plain)
+        if len(compressed) >= len(plain):
+            return COMPRESSION_NONE, plain
+        return self.compression, compressed
+
+    @staticmethod
+    def _decompress(compression: int, data: bytes) -> bytes:
+        if compression == COMPRESSION_NONE:
+            return data
+        if compression == COMPRESSION_ZLIB:
+            return zlib.decompress(data)
+        if compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("zstdで圧縮された値を読むにはzstandardが必要です。")
+            return zstandard.ZstdDecompressor().decompress(data)
+        raise ValueError(f"Unknown compression : {compression}")
+
+    def _seal(self, plain: bytes) -> tuple:
+        """平文を圧縮して暗号化し、(圧縮方式, 生のFernetのトークン)を返す。"""
+        compression, data = self._compress(plain)
+        token = self.cipher.encrypt(data)
+        return compression, base64.urlsafe_b64decode(token)
+
+    def _open(self, compression: int, raw_token: bytes) -> bytes:
+        token = base64.urlsafe_b64encode(raw_token)
+        return self._decompress(compression, self.cipher.decrypt(token))
+
+    @staticmethod
+    def _read_header(value: bytes) -> tuple:
+        _, version, compression = _HEADER.unpack_from(value)
+        if version != CURRENT_VERSION:
+            raise ValueError(f"Unknown storage format version : {version}")
+        return compression
+
+    def encode_message(self, message: Dict[str, str]) -> bytes:
+        """redisCliMessagesに保存するメッセージ({"role":..., "content":...})を符号化する。"""
+        with measure("encrypt_seconds"):
+            if self.write_version == LEGACY_VERSION:
+                return self.cipher.encrypt(json.dumps(message).encode())
+            compression, raw_token = self._seal(compact_json(message).encode())
+            return _HEADER.pack(MAGIC, CURRENT_VERSION, compression) + raw_token
+
+    def decode_message(self, value: bytes) -> Dict[str, str]:
+        """redisCliMessagesの値をメッセージに戻す。旧形式も読める。"""
+        with measure("decrypt_seconds"):
+            if is_legacy(value):
+                return json.loads(self.cipher.decrypt(value))
+            compression = self._read_header(value)
+            return json.loads(self._open(compression, value[_HEADER.size :]))
+
+    def encode_record(
+        self,
+        *,
+        user_id: str,
+        model: str,
+        timestamp: float,
+        num_tokens: int,
+        messages: str,
+        history_range: Optional[Tuple[int, int]] = None,
+        cached: bool = False,
+    ) -> bytes:
+        """
+        redisCliChatDataの'prompt'や'response'に保存する記録を符号化する。
+
+        引数:
+            user_id (str): USER_ID。
+            model (str): モデル名。
+            timestamp (float): タイムスタンプ。
+            num_tokens (int): トークン数。
+            messages (str): 暗号化して保存する内容。プロンプトはメッセージのリストのJSON、レスポンスは応答の文字列。
+            history_range (Tuple[int, int], optional): 差分形式のプロンプトで、messagesの前に付く
+                セッションのメッセージのリストの範囲[start, stop)。
+            cached (bool): 応答キャッシュで返したか。Trueならコストの集計を作り直すときに0として数える。
+        """
+        metadata = {
+            "USER_ID": user_id,
+            "model": model,
+            "timestamp": timestamp,
+            "num_tokens": num_tokens,
+        }
+        if history_range is not None:
+            metadata["history_range"] = list(history_range)
+        if cached:
+            metadata["cached"] = True
+        if self.write_version == LEGACY_VERSION:
+            with measure("encrypt_seconds"):
+                metadata["messages"] = self.cipher.encrypt(messages.encode()).decode()
+            return json.dumps(metadata).encode()
+        metadata_bytes = compact_json(metadata).encode()
+        with measure("encrypt_seconds"):
+            compression, raw_token = self._seal(messages.encode())
+        return (
+            _HEADER.pack(MAGIC, CURRENT_VERSION, compression)
+            + _METADATA_LENGTH.pack(len(metadata_bytes))
+            + metadata_bytes
+            + raw_token
+        )
+
+    def decode_record_messages(self, value: bytes) -> str:
+        """redisCliChatDataの値から、復号したmessagesを返す。旧形式も読める。"""
+        with measure("decrypt_seconds"):
+            if is_legacy(value):
+                return self.cipher.decrypt(json.loads(value)["messages"].encode()).decode()
+            compression = self._read_header(value)
+            (metadata_length,) = _METADATA_LENGTH.unpack_from(value, _HEADER.size)
+            start = _HEADER.size + _METADATA_LENGTH.size + metadata_length
+            return self._open(compression, value[start:]).decode()
+
+    def rebuild_prompt(
+        self, value: bytes, history: Optional[List[bytes]] = None
+    ) -> List[Dict[str, str]]:
+        """
+        プロンプトの記録から送ったメッセージのリストを復元する。
+
+        引数:
+            value (bytes): redisCliChatDataの'prompt'の値。
+            history (List[bytes], optional): 差分形式の場合、history_rangeの範囲の
+                redisCliMessagesの値。
+
+        戻り値:
+            List[Dict[str, str]]: 送ったメッセージのリスト。
+        """
+        messages = json.loads(self.decode_record_messages(value))
+        history_range = read_record_metadata(value).get("history_range")
+        if history_range is None:
+            return messages
+        start, stop = history_range
+        if history is None or len(history) != stop - start:
+            raise ValueError("差分形式のプロンプトを復元するセッションのメッセージがありません。")
+        return [self.decode_message(message) for message in history] + messages
+
+    def decode_record(
+        self, value: bytes, history: Optional[List[bytes]] = None
+    ) -> Dict[str, Any]:
+        """
+        redisCliChatDataの値を旧形式と同じ辞書にする。messagesは旧形式と同じく
+        Fernetで暗号化された文字列にするため、新形式の値は復号して暗号化し直す。
+        差分形式のプロンプトはhistory(rebuild_promptと同じ)から全体を復元する。
+        """
+        if is_legacy(value) and "history_range" not in read_record_metadata(value):
+            return json.loads(value)
+        record = read_record_metadata(value)
+        if "history_range" in record:
+            plain = json.dumps(self.rebuild_prompt(value, history))
+            del record["history_range"]
+        else:
+            plain = self.decode_record_messages(value)
+        record["messages"] = self.cipher.encrypt(plain.encode()).decode()
+        return record
+
+    def migrate_message(self, value: bytes) -> Optional[bytes]:
+        """旧形式のメッセージを新形式にした値を返す。変換不要ならNone。"""
+        if not is_legacy(value) or self.write_version == LEGACY_VERSION:
+            return None
+        return self.encode_message(self.decode_message(value))
+
+    def migrate_record(self, value: bytes) -> Optional[bytes]:
+        """旧形式のチャットデータを新形式にした値を返す。変換不要ならNone。"""
+        if not is_legacy(value) or self.write_version == LEGACY_VERSION:
+            return None
+        record = json.loads(value)
+        return self.encode_record(
+            user_id=record.get("USER_ID", ""),
+            model=record["model"],
+            timestamp=record["timestamp"],
+            num_tokens=record["num_tokens"],
+            messages=self.decode_record_messages(value),
+            history_range=record.get("history_range"),
+        )
+
+
+def migrate(
+    client: redis.Redis,
+    codec: StorageCodec,
+    kind: str,
+    dry_run: bool = False,
+    batch_size: int = 500,
+) -> Dict[str, int]:
+    """
+    DB内の旧形式の値を新形式に変換する。
+    変換中に書き込まれたキーはWATCHで検出して飛ばすため、もう一度実行すれば変換される。
+    キーの寿命はLSETとHSETでは変わらない。
+
+    引数:
+        client (redis.Redis): redisCliMessages(kind="messages")かredisCliChatData(kind="chat_data")のクライアント。
+        codec (StorageCodec): 変換に使うコーデック。
+        kind (str): "messages"か"chat_data"。
+        dry_run (bool): Trueなら書き込まずに集計だけ行う。
+        batch_size (int): SCANの1回あたりの件数。
+
+    戻り値:
+        Dict[str, int]: キー数、変換した値の数、飛ばしたキー数、変換前後のバイト数。
+    """
+    stats = {"keys": 0, "values": 0, "skipped_keys": 0, "bytes_before": 0, "bytes_after": 0}
+    key_type = b"list" if kind == "messages" else b"hash"
+    for key in client.scan_iter(count=batch_size):
+        with client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.type(key) != key_type:
+                    continue
+                stats["keys"] += 1
+                if kind == "messages":
+                    items = list(enumerate(pipe.lrange(key, 0, -1)))
+                    convert = codec.migrate_message
+                else:
+                    items = list(pipe.hgetall(key).items())
+                    convert = codec.migrate_record
+                updates = {}
+                for field, value in items:
+                    new_value = convert(value)
+                    if new_value is None:
+                        continue
+                    updates[field] = new_value
+                    stats["bytes_before"] += len(value)
+                    stats["bytes_after"] += len(new_value)
+                if not updates or dry_run:
+                    stats["values"] += len(updates)
+                    continue
+                pipe.multi()
+                if kind == "messages":
+                    for index, new_value in updates.items():
+                        pipe.lset(key, index, new_value)
+                else:
+                    pipe.hset(key, mapping=updates)
+                pipe.execute()
+                stats["values"] += len(updates)
+            except redis.WatchError:
+                stats["skipped_keys"] += 1
+    return stats
+
+
+def codec_from_env() -> StorageCodec:
+    """環境変数から暗号化の鍵と圧縮の設定を読み、コーデックを作る。"""
+    return StorageCodec(
+        Fernet(os.environ["ENCRYPT_KEY"].encode()),
+        compression=os.environ.get("STORAGE_COMPRESSION", "zlib"),
+        compress_min_bytes=int(os.environ.get("STORAGE_COMPRESS_MIN_BYTES", 256)),
+        write_version=int(os.environ.get("STORAGE_FORMAT_VERSION", CURRENT_VERSION)),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="redisCliMessagesとredisCliChatDataの旧形式の値を新形式に変換する。"
+    )
+    parser.add_argument("--migrate", action="store_true", help="変換する。")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="書き込まずに変換前後のバイト数だけ集計する。"
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    if not args.migrate:
+        parser.print_help()
+    else:
+        codec = codec_from_env()
+        for kind, db in (("messages", 0), ("chat_data", 5)):
+            stats = migrate(
+                redis.Redis(host="redis", port=6379, db=db),
+                codec,
+                kind,
+                dry_run=args.dry_run,
+                batch_size=args.batch_size,
+            )
+            print(f"{kind} : {stats}")
@@ -0,0 +1,146 @@
+"""
+ストリーミング中の応答の書き込みをまとめるバッファ。
+
+チャンク毎にRedisへ書き込むのではなく、一定時間または一定チャンク数毎に
+その時点までの応答をまとめて書き込み、終了時(エラー時も含む)に最後の書き込みを行う。
+応答のトークン数も、書き込みの度に前回からの差分だけを数えて足していく。
+プロバイダーがストリームの最後にトークン数を返した場合は、最後の書き込みでその値に置き換える。
+"""
+
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+def read_chunk(chunk: Any, usage: Optional[Dict[str, int]] = None) -> Optional[str]:
+    """
+    litellmのストリームのチャンクから本文を取り出し、トークン数が付いていればusageに書き込む。
+
+    引数:
+        chunk: litellmのストリームのチャンク。
+        usage (Dict[str, int], optional): prompt_tokensとcompletion_tokensを書き込む辞書。
+
+    戻り値:
+        Optional[str]: 本文。stream_optionsのinclude_usageで最後に来る、
+            トークン数だけのチャンク(choicesが空)ではNone。
+    """
+    chunk_usage = getattr(chunk, "usage", None)
+    if chunk_usage is None and isinstance(chunk, dict):
+        chunk_usage = chunk.get("usage")
+    if usage is not None and chunk_usage:
+        for key in ("prompt_tokens", "completion_tokens"):
+            value = (
+                chunk_usage.get(key)
+                if isinstance(chunk_usage, dict)
+                else getattr(chunk_usage, key, None)
+            )
+            if value:
+                usage[key] = value
+    if not chunk["choices"]:
+        return None
+    return chunk["choices"][0]["delta"].get("content", "") or ""
+
+
+class StreamingResponseWriter:
+    """
+    ストリーミング中の応答を溜め、flush_interval秒またはflush_chunks個毎にflush_funcを呼ぶ。
+
+    引数:
+        flush_func (Callable[[str, bool], None]): その時点までの応答全体と、
+            最後の書き込みかどうかを受け取り保存する関数。最後の書き込みはちょうど1回行われる。
+        flush_interval (float): 前回の書き込みからこの秒数が経過したら書き込む。
+        flush_chunks (int): 前回の書き込みからこの個数のチャンクが溜まったら書き込む。
+        clock (Callable[[], float]): 経過時間の計測に使う時計。
+
+    使い方:
+        with StreamingResponseWriter(save) as writer:
+            for chunk in response:
+                writer.append(chunk)
+    """
+
+    def __init__(
+        self,
+        flush_func: Callable[[str, bool], None],
+        flush_interval: float = 0.5,
+        flush_chunks: int = 20,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.flush_func = flush_func
+        self.flush_interval = flush_interval
+        self.flush_chunks = flush_chunks
+        self.clock = clock
+        self.text = ""
+        self.num_chunks = 0
+        self.num_flushes = 0
+        self._pending_chunks = 0
+        self._last_flush = clock()
+
+    def append(self, chunk: str) -> None:
+        """チャンクを追加し、書き込む時期であれば書き込む。"""
+        self.text += chunk
+        self.num_chunks += 1
+        self._pending_chunks += 1
+        if (
+            self._pending_chunks >= self.flush_chunks
+            or self.clock() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """未書き込みのチャンクがあれば、その時点までの応答全体を書き込む。"""
+        if not self._pending_chunks:
+            return
+        self._write(final=False)
+
+    def close(self) -> None:
+        """応答全体を最後の書き込みとして書き込む。チャンクが一つも無ければ何もしない。"""
+        if not self.num_chunks:
+            return
+        self._write(final=True)
+
+    def _write(self, final: bool) -> None:
+        self.flush_func(self.text, final)
+        self.num_flushes += 1
+        self._pending_chunks = 0
+        self._last_flush = self.clock()
+
+    def __enter__(self) -> "StreamingResponseWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> bool:
+        # ストリームが正常に終わってもエラーで止まっても、最後の書き込みを行う
+        self.close()
+        return False
+
+
+class IncrementalTokenCounter:
+    """
+    伸びていくテキストのトークン数を、前回数えた位置からの差分だけ数えて足していく。
+    差分の境界でトークンが分かれるため、全体を一度に数えた場合と多少ずれることがある。
+
+    引数:
+        count_func (Callable[[str], int]): テキストのトークン数を返す関数。
+    """
+
+    def __init__(self, count_func: Callable[[str], int]):
+        self.count_func = count_func
+        self.num_tokens = 0
+        self._counted_length = 0
+
+    def update(self, text: str) -> int:
+        """textのうち、まだ数えていない末尾の差分を数えて、合計のトークン数を返す。"""
+        delta = text[self._counted_length :]
+        if delta:
+            self.num_tokens += self.count_func(delta)
+            self._counted_length = len(text)
+        return self.num_tokens
+
+    def finalize(self, text: str, reported_tokens: Optional[int] = None) -> int:
+        """
+        最終的なトークン数を返す。プロバイダーが報告したトークン数があればそれを使い、
+        無ければ差分を数え切った合計を使う。
+        """
+        if reported_tokens is not None:
+            self.num_tokens = reported_tokens
+            self._counted_length = len(text)
+            return self.num_tokens
+        return self.update(text)
@@ -0,0 +1,51 @@
+"""
+テストで共有するfixture。Redisの代わりにfakeredis(Luaスクリプトにはlupa)を使う。
+    pip install pytest "fakeredis[lua]"
+"""
+
+import pytest
+import redis
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from chat_store import (
+    ACCESS_TIME_DB,
+    CACHE_DB,
+    CHAT_DATA_DB,
+    MESSAGES_DB,
+    TITLE_AT_USER_DB,
+    USER_ACCESS_DB,
+    USER_SETTING_DB,
+    ChatStore,
+)
+
+
+@pytest.fixture
+def connection_pools():
+    """DB毎の、同じ偽のRedisサーバーへの接続プール。"""
+    server = fakeredis.FakeServer()
+    connection_class = getattr(fakeredis, "FakeRedisConnection", None) or fakeredis.FakeConnection
+    return {
+        db: redis.ConnectionPool(server=server, connection_class=connection_class, db=db)
+        for db in (
+            MESSAGES_DB,
+            USER_SETTING_DB,
+            TITLE_AT_USER_DB,
+            ACCESS_TIME_DB,
+            USER_ACCESS_DB,
+            CHAT_DATA_DB,
+            CACHE_DB,
+        )
+    }
+
+
+@pytest.fixture
+def redis_client(connection_pools):
+    """レート制限と順番待ちの列を置くredisCliAccessTimeと同じDBのクライアント。"""
+    return redis.Redis(connection_pool=connection_pools[ACCESS_TIME_DB])
+
+
+@pytest.fixture
+def store(connection_pools):
+    return ChatStore(connection_pools=connection_pools)
@@ -0,0 +1,128 @@
+from admission_queue import AdmissionQueue
+from rate_limiter import RateLimiter
+
+NOW = 1_700_000_000.0
+# 1秒に1回だけ通る全体の制限。1秒毎に列の先頭だけに空きができる
+ONE_PER_SECOND = [("global", 1, 1)]
+
+
+def admitted_order(redis_client, limiter, queue, tickets):
+    """1秒毎に列の先頭だけが通ることを確かめながら、通った順を返す。"""
+    order = []
+    while len(order) < len(tickets):
+        now = NOW + len(order)
+        head = redis_client.zrange("admission:queue", 0, 0)[0].decode()
+        for ticket in tickets:
+            if ticket not in order and ticket != head:
+                assert not limiter.acquire(ticket, ONE_PER_SECOND, now=now, admission=queue)[0]
+        assert limiter.acquire(head, ONE_PER_SECOND, now=now, admission=queue)[0]
+        order.append(head)
+    return order
+
+
+def test_only_the_head_of_the_queue_is_admitted(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+    assert queue.enqueue("t1", "alice", now=NOW) == (0, 1)
+    assert queue.enqueue("t2", "bob", now=NOW) == (1, 2)
+    # 並んでいないリクエストと2番目は、空きが前の待ちの分しか無いので通らない
+    assert limiter.acquire("other", ONE_PER_SECOND, now=NOW, admission=queue)[:2] == (False, "admission")
+    assert limiter.acquire("t2", ONE_PER_SECOND, now=NOW, admission=queue)[:2] == (False, "admission")
+    assert limiter.acquire("t1", ONE_PER_SECOND, now=NOW, admission=queue)[0]
+    # 通ったチケットは同じ往復で列から除かれ、次が先頭になる
+    assert limiter.acquire("t2", ONE_PER_SECOND, now=NOW + 1, admission=queue)[0]
+    assert redis_client.zcard("admission:queue") == 0
+
+
+def test_waiters_behind_pass_when_the_limits_have_room_for_those_ahead(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+    windows = [("global", 3, 10)]
+    queue.enqueue("t1", "alice", now=NOW)
+    queue.enqueue("t2", "bob", now=NOW)
+    # 全体の制限に先頭の分を残しても空きがある
+    assert limiter.acquire("t2", windows, now=NOW, admission=queue)[0]
+    assert limiter.acquire("t1", windows, now=NOW, admission=queue)[0]
+
+
+def test_head_held_by_its_own_user_limit_does_not_block_others(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+
+    def limits(user_id, global_count=10):
+        windows = [("global", global_count, 60), (f"user:{user_id}", 1, 60)]
+        return {"windows": windows, "now": NOW, "admission": queue, "own_limits": [f"user:{user_id}"]}
+
+    # aliceはUSER_COUNTを使い切ったまま列の先頭で待つ
+    assert limiter.acquire("a0", **limits("alice"))[0]
+    queue.enqueue("a1", "alice", now=NOW)
+    queue.enqueue("b1", "bob", now=NOW)
+    assert limiter.acquire_queued("a1", **limits("alice")) == (False, "user:alice", 60.0, 0, 2)
+    # 全体の制限に空きが無ければ、bobは先頭のaliceの分を残すために待つ
+    assert limiter.acquire("b1", **limits("bob", global_count=2)) == (False, "admission", 60.0)
+    # 空きがあれば、自分のユーザーの制限だけ確認して先に通る
+    assert limiter.acquire("b1", **limits("bob"))[0]
+    assert [ticket.decode() for ticket in redis_client.zrange("admission:queue", 0, -1)] == ["a1"]
+
+
+def test_users_are_interleaved_fairly(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+    for ticket in ("a1", "a2", "a3"):
+        queue.enqueue(ticket, "alice", now=NOW)
+    queue.enqueue("b1", "bob", now=NOW)
+    assert admitted_order(redis_client, limiter, queue, ["a1", "a2", "a3", "b1"]) == ["a1", "b1", "a2", "a3"]
+
+
+def test_weight_gives_more_turns(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+    for i in range(4):
+        queue.enqueue(f"a{i}", "alice", weight=2.0, now=NOW)
+        queue.enqueue(f"b{i}", "bob", now=NOW)
+    order = admitted_order(
+        redis_client, limiter, queue, [f"{u}{i}" for i in range(4) for u in "ab"]
+    )
+    # 終了時刻はaliceが0.5刻み、bobが1刻み(同じ時刻ならチケットの順)
+    assert order == ["a0", "a1", "b0", "a2", "a3", "b1", "b2", "b3"]
+
+
+def test_waiters_get_their_expected_slot_time(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+    windows = [("global", 2, 10)]
+    assert limiter.acquire("x", windows, now=NOW)[0]
+    assert limiter.acquire("y", windows, now=NOW + 1)[0]
+    for i in range(4):
+        queue.enqueue(f"t{i}", f"user{i}", now=NOW + 2)
+    retry_afters = [
+        limiter.acquire_queued(f"t{i}", windows, now=NOW + 2, admission=queue)[2] for i in range(4)
+    ]
+    # 先頭は最も古い記録の期限切れ、2番目はその次の記録の期限切れ、
+    # 3番目以降は先に通った待ちの記録が期限切れになる時刻
+    assert retry_afters == [8.0, 9.0, 18.0, 19.0]
+
+
+def test_bucket_waiters_expect_the_tokens_of_those_ahead(redis_client):
+    limiter, queue = RateLimiter(redis_client), AdmissionQueue(redis_client)
+    buckets = [("tokens", 100, 10, 40)]
+    assert limiter.acquire("x", buckets=buckets, now=NOW)[0]
+    assert limiter.acquire("y", buckets=buckets, now=NOW)[0]
+    queue.enqueue("t0", "alice", now=NOW)
+    queue.enqueue("t1", "bob", now=NOW)
+    # 残り20トークン。先頭は40、2番目は80トークンまで貯まるのを待つ
+    assert limiter.acquire_queued("t0", buckets=buckets, now=NOW, admission=queue)[2] == 2.0
+    assert limiter.acquire_queued("t1", buckets=buckets, now=NOW, admission=queue)[2] == 6.0
+
+
+def test_stale_waiters_are_dropped(redis_client):
+    limiter = RateLimiter(redis_client)
+    queue = AdmissionQueue(redis_client, stale_after=10)
+    queue.enqueue("gone", "alice", now=NOW)
+    queue.enqueue("here", "bob", now=NOW)
+    # "here"だけ確認に来続ける
+    assert not limiter.acquire("here", ONE_PER_SECOND, now=NOW + 8, admission=queue)[0]
+    assert limiter.acquire("here", ONE_PER_SECOND, now=NOW + 12, admission=queue)[0]
+    assert redis_client.zcard("admission:queue") == 0
+
+
+def test_full_queue_refuses_and_cancel_removes(redis_client):
+    queue = AdmissionQueue(redis_client, max_queue_size=1)
+    assert queue.enqueue("t1", "alice", now=NOW) == (0, 1)
+    assert queue.enqueue("t2", "bob", now=NOW) is None
+    queue.cancel("t1")
+    assert queue.enqueue("t2", "bob", now=NOW) == (0, 1)
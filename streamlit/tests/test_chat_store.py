@@ -0,0 +1,60 @@
+from chat_store import user_sessions_key
+
+NOW = 1_700_000_000
+
+
+def add_sessions(store, user_id, count):
+    """1秒ずつ新しくなるセッションs0..を索引に入れ、偶数番目だけタイトルを付ける。"""
+    store.title_at_user.zadd(
+        user_sessions_key(user_id), {f"s{i}": NOW + i for i in range(count)}
+    )
+    store.title_at_user.hset(
+        user_id, mapping={f"s{i}": f"title{i}" for i in range(0, count, 2)}
+    )
+
+
+def session_ids(result):
+    return [session_id.decode() for session_id, _ in result["sessions"]]
+
+
+def test_user_sessions_without_index(store):
+    result = store.get_user_sessions("alice", since=0)
+    assert result == {"sessions": [], "index_exists": False, "floor": None, "has_more": False}
+
+
+def test_user_sessions_newest_first_with_titles(store):
+    add_sessions(store, "alice", 3)
+    result = store.get_user_sessions("alice", since=0, extra=10)
+    assert result["sessions"] == [(b"s2", b"title2"), (b"s1", None), (b"s0", b"title0")]
+    assert result["index_exists"] and not result["has_more"]
+    assert result["floor"] == str(NOW)
+
+
+def test_user_sessions_pages_with_floor(store):
+    add_sessions(store, "alice", 5)
+    first = store.get_user_sessions("alice", since=0, extra=2)
+    assert session_ids(first) == ["s4", "s3"]
+    assert first["has_more"]
+    # 次のページはfloor以降の全てと、それより古い2件
+    second = store.get_user_sessions("alice", since=0, floor=first["floor"], extra=2)
+    assert session_ids(second) == ["s4", "s3", "s2", "s1"]
+    assert second["has_more"]
+    last = store.get_user_sessions("alice", since=0, floor=second["floor"], extra=2)
+    assert session_ids(last) == ["s4", "s3", "s2", "s1", "s0"]
+    assert not last["has_more"]
+
+
+def test_user_sessions_since_excludes_older(store):
+    add_sessions(store, "alice", 5)
+    result = store.get_user_sessions("alice", since=NOW + 3, extra=10)
+    assert session_ids(result) == ["s4", "s3"]
+    assert not result["has_more"]
+    # 索引はあるがsince以降のセッションが無い
+    empty = store.get_user_sessions("alice", since=NOW + 10)
+    assert empty["sessions"] == [] and empty["index_exists"]
+
+
+def test_user_sessions_session_used_again_moves_to_top(store):
+    add_sessions(store, "alice", 3)
+    store.title_at_user.zadd(user_sessions_key("alice"), {"s0": NOW + 10})
+    assert session_ids(store.get_user_sessions("alice", since=0)) == ["s0", "s2", "s1"]
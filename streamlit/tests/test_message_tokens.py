@@ -0,0 +1,46 @@
+import pytest
+
+from message_tokens import truncate_middle_to_tokens
+
+
+class CountChars:
+    """1文字を1トークンとして数え、呼ばれた回数を残す。"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        return len(text)
+
+
+def test_text_at_the_budget_is_kept_whole():
+    assert truncate_middle_to_tokens("p:", "abcdefghij", 12, CountChars()) == ("p:abcdefghij", 12)
+
+
+def test_one_token_over_the_budget_is_cut_to_fit():
+    # 先頭と末尾をk文字ずつ残すと2 + 2k + 3トークンになるので、11トークンではk = 3
+    assert truncate_middle_to_tokens("p:", "abcdefghij", 11, CountChars()) == ("p:abc...hij", 11)
+    # 1つ減らすと2k + 5が収まる最大のkは2になり、残りの1トークン分は使わない
+    assert truncate_middle_to_tokens("p:", "abcdefghij", 10, CountChars()) == ("p:ab...ij", 9)
+
+
+def test_only_the_prefix_and_ellipsis_fit():
+    assert truncate_middle_to_tokens("p:", "abcdefghij", 5, CountChars()) == ("p:...", 5)
+    with pytest.raises(ValueError):
+        truncate_middle_to_tokens("p:", "abcdefghij", 4, CountChars())
+
+
+def test_long_text_is_counted_a_logarithmic_number_of_times():
+    count = CountChars()
+    content, num_tokens = truncate_middle_to_tokens("", "x" * 100_000, 1_000, count)
+    assert num_tokens == len(content) == 999
+    assert count.calls <= 20
+
+
+def test_max_chars_cuts_before_counting_the_whole_text():
+    count = CountChars()
+    content, num_tokens = truncate_middle_to_tokens("p:", "x" * 1_000, 1_000, count, max_chars=105)
+    assert len(content) <= 105 and num_tokens == len(content)
+    # 文字数で省略するので、全体を数えることは無い
+    assert count.calls <= 8
@@ -0,0 +1,108 @@
+import threading, time
+
+import pytest
+
+from model_router import LatencyTracker, ModelRouter
+
+
+class FakeStream:
+    """最初のチャンクを受け取った状態のストリームの代わり。閉じたかを残す。"""
+
+    def __init__(self, model):
+        self.model = model
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        yield f"answer from {self.model}"
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeModels:
+    """モデル毎に、最初のチャンクを返すまでの待ちと失敗を指定できるstart関数。"""
+
+    def __init__(self, fail=(), block=()):
+        self.fail = set(fail)
+        self.release = {model: threading.Event() for model in block}
+        self.started = []
+        self.streams = {}
+
+    def start(self, model):
+        self.started.append(model)
+        if model in self.release:
+            assert self.release[model].wait(5)
+        if model in self.fail:
+            raise RuntimeError(f"{model} failed")
+        self.streams[model] = FakeStream(model)
+        return self.streams[model]
+
+
+def make_router(default_delay=0.05):
+    return ModelRouter(LatencyTracker(min_samples=3), default_delay=default_delay, min_delay=0.01)
+
+
+def test_without_fallback_only_the_model_is_called():
+    router, models = make_router(), FakeModels()
+    assert router.start("primary", None, models.start)[0] == "primary"
+    assert models.started == ["primary"]
+
+
+def test_fast_model_is_not_hedged():
+    router, models = make_router(default_delay=5), FakeModels()
+    allow_fallback_calls = []
+    answered, stream = router.start(
+        "primary", "fallback", models.start, allow_fallback=allow_fallback_calls.append
+    )
+    assert answered == "primary" and list(stream) == ["answer from primary"]
+    assert models.started == ["primary"] and allow_fallback_calls == []
+
+
+def test_slow_model_is_hedged_and_the_loser_is_closed_and_reported():
+    router, models = make_router(), FakeModels(block=["primary"])
+    cancelled = []
+    answered, _ = router.start(
+        "primary", "fallback", models.start, allow_fallback=lambda m: True, on_cancelled=cancelled.append
+    )
+    assert answered == "fallback"
+    # 遅れて応答した方は閉じられ、on_cancelledでコストの集計に知らされる
+    models.release["primary"].set()
+    deadline = time.monotonic() + 5
+    while not cancelled and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cancelled == ["primary"]
+    assert models.streams["primary"].closed.is_set()
+    assert not models.streams["fallback"].closed.is_set()
+    assert router.stats()["hedged"] == 1 and router.stats()["fallback_answered"] == 1
+
+
+def test_failed_model_falls_back_without_waiting_for_the_delay():
+    router, models = make_router(default_delay=10), FakeModels(fail=["primary"])
+    started_at = time.monotonic()
+    assert router.start("primary", "fallback", models.start)[0] == "fallback"
+    assert time.monotonic() - started_at < 5
+
+
+def test_fallback_is_not_called_when_not_allowed():
+    router, models = make_router(), FakeModels(fail=["primary"])
+    with pytest.raises(RuntimeError, match="primary failed"):
+        router.start("primary", "fallback", models.start, allow_fallback=lambda m: False)
+    assert models.started == ["primary"]
+
+
+def test_error_of_the_model_is_raised_when_both_fail():
+    router, models = make_router(), FakeModels(fail=["primary", "fallback"])
+    with pytest.raises(RuntimeError, match="primary failed"):
+        router.start("primary", "fallback", models.start)
+
+
+def test_hedge_delay_follows_the_tracked_ttft_and_error_rate():
+    router = make_router(default_delay=10)
+    assert router.hedge_delay("m") == 10
+    for ttft in (0.2, 0.3, 0.4):
+        router.tracker.record("m", ttft)
+    assert router.hedge_delay("m") == 0.4
+    for _ in range(3):
+        router.tracker.record("m", None)
+    # 直近の失敗が半分以上なら待たずにフォールバックする
+    assert router.hedge_delay("m") == 0.0
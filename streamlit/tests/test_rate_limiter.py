@@ -0,0 +1,44 @@
+from rate_limiter import RateLimiter
+
+NOW = 1_700_000_000.0
+
+
+def test_window_allows_up_to_limit_and_returns_retry_after(redis_client):
+    limiter = RateLimiter(redis_client)
+    windows = [("global", 2, 10)]
+    assert limiter.acquire("a", windows, now=NOW) == (True, None, 0.0)
+    assert limiter.acquire("b", windows, now=NOW + 1) == (True, None, 0.0)
+    # 最も古い記録が期限切れになるまで通らない
+    assert limiter.acquire("c", windows, now=NOW + 2) == (False, "global", 8.0)
+    assert limiter.acquire("c", windows, now=NOW + 10.5)[0]
+
+
+def test_rejected_request_is_not_recorded_in_any_limit(redis_client):
+    limiter = RateLimiter(redis_client)
+    windows = [("global", 10, 60), ("user", 1, 60)]
+    assert limiter.acquire("a", windows, now=NOW)[0]
+    assert limiter.acquire("b", windows, now=NOW + 1) == (False, "user", 59.0)
+    # 2番目の制限で断られたので、1番目のウィンドウにも記録されていない
+    assert redis_client.zcard("ratelimit:global") == 1
+
+
+def test_token_bucket_refills_over_its_period(redis_client):
+    limiter = RateLimiter(redis_client)
+    buckets = [("tokens", 100, 10, 60)]
+    assert limiter.acquire("a", buckets=buckets, now=NOW)[0]
+    # 残り40トークンに60トークンは入らず、20トークン分(2秒)待つ
+    assert limiter.acquire("b", buckets=buckets, now=NOW) == (False, "tokens", 2.0)
+    assert limiter.acquire("b", buckets=buckets, now=NOW + 2)[0]
+
+
+def test_cost_above_capacity_is_capped(redis_client):
+    limiter = RateLimiter(redis_client)
+    # 上限より大きい消費も、バケットが満タンなら通る
+    assert limiter.acquire("a", buckets=[("tokens", 100, 10, 500)], now=NOW)[0]
+
+
+def test_keys_are_prefixed_and_expire(redis_client):
+    limiter = RateLimiter(redis_client, key_prefix="test")
+    assert limiter.acquire("a", [("w", 1, 5)], [("b", 10, 30, 1)], now=NOW)[0]
+    assert 0 < redis_client.ttl("test:w") <= 6
+    assert 0 < redis_client.ttl("test:b") <= 31
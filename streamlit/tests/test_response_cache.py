@@ -0,0 +1,55 @@
+import pytest
+import redis
+from cryptography.fernet import Fernet
+
+import response_cache
+from chat_store import CACHE_DB
+from response_cache import ResponseCache, stats_summary
+from storage_codec import StorageCodec
+
+NOW = 1_700_000_000.0
+
+
+def question(text):
+    return [{"role": "user", "content": text}]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """キャッシュが見る時刻。最後に使った時刻の順で削除されるのを確かめるため、手で進める。"""
+    now = [NOW]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(connection_pools):
+    client = redis.Redis(connection_pool=connection_pools[CACHE_DB])
+    return ResponseCache(client, StorageCodec(Fernet(Fernet.generate_key())), max_entries=2)
+
+
+def test_put_then_get_counts_hits_misses_and_saved_cost(cache, clock):
+    assert cache.get("gpt-4", 100, question("q"), saved_cost=0.5) is None
+    cache.put("gpt-4", 100, question("q"), "answer")
+    assert cache.get("gpt-4", 100, question("q"), saved_cost=0.5) == "answer"
+    assert cache.get("gpt-4", 100, question("q"), saved_cost=0.25) == "answer"
+    # モデル名やmax_tokensが違えば別の入力
+    assert cache.get("gpt-3.5-turbo", 100, question("q")) is None
+    assert cache.get("gpt-4", 50, question("q")) is None
+    assert cache.get_stats(NOW) == (2, 3, 0.75)
+    assert stats_summary(cache.get_stats(NOW))["hit_rate"] == pytest.approx(0.4)
+
+
+def test_least_recently_used_entry_is_evicted_past_max_entries(cache, clock):
+    cache.put("gpt-4", 100, question("a"), "A")
+    clock[0] += 1
+    cache.put("gpt-4", 100, question("b"), "B")
+    clock[0] += 1
+    # aを使うと、最後に使ったのが一番古いのはbになる
+    assert cache.get("gpt-4", 100, question("a")) == "A"
+    clock[0] += 1
+    cache.put("gpt-4", 100, question("c"), "C")
+    assert cache.redis_client.zcard(cache.index_key) == 2
+    assert cache.get("gpt-4", 100, question("b")) is None
+    assert cache.get("gpt-4", 100, question("a")) == "A"
+    assert cache.get("gpt-4", 100, question("c")) == "C"
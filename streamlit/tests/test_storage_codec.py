@@ -0,0 +1,100 @@
+import json
+
+import pytest
+import redis
+from cryptography.fernet import Fernet
+
+from chat_store import CHAT_DATA_DB, MESSAGES_DB
+from storage_codec import LEGACY_VERSION, MAGIC, StorageCodec, is_legacy, migrate, read_record_metadata
+
+LONG_TEXT = "こんにちは。" * 200
+
+
+@pytest.fixture
+def cipher():
+    return Fernet(Fernet.generate_key())
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd"])
+@pytest.mark.parametrize("content", ["hi", LONG_TEXT])
+def test_message_round_trip(cipher, compression, content):
+    codec = StorageCodec(cipher, compression=compression)
+    message = {"role": "user", "content": content}
+    value = codec.encode_message(message)
+    assert value.startswith(MAGIC) and not is_legacy(value)
+    assert codec.decode_message(value) == message
+
+
+def test_long_messages_are_compressed(cipher):
+    plain = StorageCodec(cipher, compression="none").encode_message({"role": "user", "content": LONG_TEXT})
+    compressed = StorageCodec(cipher).encode_message({"role": "user", "content": LONG_TEXT})
+    assert len(compressed) < len(plain) / 4
+
+
+def test_legacy_values_are_still_read(cipher):
+    legacy = StorageCodec(cipher, write_version=LEGACY_VERSION)
+    codec = StorageCodec(cipher)
+    message = {"role": "assistant", "content": "hello"}
+    value = legacy.encode_message(message)
+    assert is_legacy(value)
+    assert codec.decode_message(value) == message
+    record = legacy.encode_record(user_id="u", model="m", timestamp=1.5, num_tokens=3, messages="[]")
+    assert codec.decode_record_messages(record) == "[]"
+    assert codec.decode_record(record) == json.loads(record)
+
+
+def test_record_round_trip_keeps_metadata_readable_without_the_key(cipher):
+    codec = StorageCodec(cipher)
+    value = codec.encode_record(user_id="u", model="gpt-4", timestamp=1.5, num_tokens=42, messages=LONG_TEXT)
+    assert read_record_metadata(value) == {"USER_ID": "u", "model": "gpt-4", "timestamp": 1.5, "num_tokens": 42}
+    assert codec.decode_record_messages(value) == LONG_TEXT
+    record = codec.decode_record(value)
+    assert cipher.decrypt(record["messages"].encode()).decode() == LONG_TEXT
+
+
+def test_delta_prompt_is_rebuilt_from_the_session(cipher):
+    codec = StorageCodec(cipher)
+    history = [{"role": "user", "content": "q1"}, {"role": "assistant", "content": "a1"}]
+    turn = [{"role": "user", "content": "q2"}]
+    value = codec.encode_record(
+        user_id="u", model="m", timestamp=1.0, num_tokens=5, messages=json.dumps(turn), history_range=(0, 2)
+    )
+    encoded_history = [codec.encode_message(message) for message in history]
+    assert codec.rebuild_prompt(value, encoded_history) == history + turn
+    with pytest.raises(ValueError):
+        codec.rebuild_prompt(value, encoded_history[:1])
+
+
+def test_migrate_converts_legacy_values_once(cipher, connection_pools):
+    legacy = StorageCodec(cipher, write_version=LEGACY_VERSION)
+    codec = StorageCodec(cipher)
+    messages = redis.Redis(connection_pool=connection_pools[MESSAGES_DB])
+    chat_data = redis.Redis(connection_pool=connection_pools[CHAT_DATA_DB])
+    old_messages = [{"role": "user", "content": "q"}, {"role": "assistant", "content": LONG_TEXT}]
+    messages.rpush("session", *[legacy.encode_message(message) for message in old_messages])
+    messages.rpush("session", codec.encode_message({"role": "user", "content": "new"}))
+    chat_data.hset(
+        "session_000001",
+        "prompt",
+        legacy.encode_record(user_id="u", model="m", timestamp=1.0, num_tokens=2, messages=json.dumps(old_messages)),
+    )
+
+    dry_run = migrate(messages, codec, "messages", dry_run=True)
+    assert dry_run["values"] == 2
+    assert is_legacy(messages.lindex("session", 0))
+
+    stats = migrate(messages, codec, "messages")
+    assert stats["keys"] == 1 and stats["values"] == 2
+    assert stats["bytes_after"] < stats["bytes_before"]
+    assert [codec.decode_message(value) for value in messages.lrange("session", 0, 1)] == old_messages
+    assert not any(is_legacy(value) for value in messages.lrange("session", 0, -1))
+
+    assert migrate(chat_data, codec, "chat_data")["values"] == 1
+    prompt = chat_data.hget("session_000001", "prompt")
+    assert not is_legacy(prompt)
+    assert json.loads(codec.decode_record_messages(prompt)) == old_messages
+    assert read_record_metadata(prompt)["model"] == "m"
+
+    # 変換済みの値はもう変換しない
+    assert migrate(messages, codec, "messages")["values"] == 0
+    assert migrate(chat_data, codec, "chat_data")["values"] == 0
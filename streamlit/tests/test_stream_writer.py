@@ -0,0 +1,89 @@
+import pytest
+
+from stream_writer import IncrementalTokenCounter, StreamingResponseWriter, read_chunk
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def content_chunk(text):
+    return {"choices": [{"index": 0, "delta": {"content": text}}]}
+
+
+def usage_chunk(prompt_tokens, completion_tokens):
+    """stream_optionsのinclude_usageで最後に来る、choicesが空のチャンク。"""
+    return {
+        "choices": [],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+    }
+
+
+def stream_and_store(chunks, flush_chunks=2):
+    """make_response_writerと同じく、書き込みの度に数え、最後の書き込みで報告されたトークン数で確定する。"""
+    usage, stored = {}, []
+    counter = IncrementalTokenCounter(count_words)
+
+    def flush(text, final):
+        if final:
+            stored.append(counter.finalize(text, usage.get("completion_tokens")))
+        else:
+            stored.append(counter.update(text))
+
+    with StreamingResponseWriter(flush, flush_interval=60, flush_chunks=flush_chunks) as writer:
+        for chunk in chunks:
+            piece = read_chunk(chunk, usage)
+            if piece is not None:
+                writer.append(piece)
+    return writer.text, stored, usage
+
+
+def test_read_chunk_returns_content_and_skips_the_usage_chunk():
+    usage = {}
+    assert read_chunk(content_chunk("hello"), usage) == "hello"
+    assert read_chunk({"choices": [{"index": 0, "delta": {}}]}, usage) == ""
+    assert read_chunk(usage_chunk(8, 3), usage) is None
+    assert usage == {"prompt_tokens": 8, "completion_tokens": 3}
+
+
+def test_stored_tokens_are_the_reported_usage():
+    chunks = [content_chunk("one "), content_chunk("two "), content_chunk("three"), usage_chunk(12, 7)]
+    text, stored, usage = stream_and_store(chunks)
+    assert text == "one two three"
+    # 途中の書き込みは差分を数えた見積もり、最後はプロバイダーが報告した値
+    assert stored[:-1] == [2]
+    assert stored[-1] == 7 == usage["completion_tokens"]
+
+
+def test_stored_tokens_fall_back_to_counted_deltas_without_usage():
+    chunks = [content_chunk("one "), content_chunk("two "), content_chunk("three")]
+    assert stream_and_store(chunks)[1] == [2, 3]
+
+
+def test_incremental_counter_counts_only_new_text():
+    counted = []
+    counter = IncrementalTokenCounter(lambda text: counted.append(text) or count_words(text))
+    assert counter.update("a b") == 2
+    assert counter.update("a b") == 2
+    assert counter.update("a b c d") == 4
+    assert counted == ["a b", " c d"]
+    assert counter.finalize("a b c d e") == 5
+    assert counter.finalize("a b c d e", reported_tokens=9) == 9
+
+
+def test_completion_asks_litellm_for_stream_usage():
+    pytest.importorskip("litellm")
+    import model_clients
+
+    usage, pieces = {}, []
+    for chunk in model_clients.completion(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": "hi"}],
+        stream=True,
+        mock_response="hello world",
+    ):
+        piece = read_chunk(chunk, usage)
+        if piece is not None:
+            pieces.append(piece)
+    assert "".join(pieces) == "hello world"
+    assert usage.get("completion_tokens")
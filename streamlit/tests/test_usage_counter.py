@@ -0,0 +1,65 @@
+import pytest
+import redis
+from cryptography.fernet import Fernet
+
+from chat_store import CHAT_DATA_DB
+from storage_codec import StorageCodec
+from usage_counter import CANCELLED_PROMPT_FIELD, calc_cost, rebuild_usage, record_usage, usage_key
+
+NOW = 1_700_000_000.0
+EXPIRE_TIME = 3600
+API_COST = {"gpt-4": {"prompt": 30.0, "response": 60.0}, "claude": {"prompt": 3.0, "response": 15.0}}
+
+
+def make_usage(kind, model, num_tokens, cached=False):
+    """make_usage_recordと同じく、応答キャッシュで返した記録のコストは0にする。"""
+    return {
+        "user_id": "alice",
+        "model": model,
+        "kind": kind,
+        "num_tokens": num_tokens,
+        "cost": 0 if cached else calc_cost(API_COST, model, kind),
+        "timestamp": NOW,
+    }
+
+
+def record(chat_data, redis_client, codec, messages_id, field, kind, model, num_tokens, cached=False):
+    """記録をredisCliChatDataに保存し、その場の集計にも加算する。"""
+    chat_data.hset(
+        messages_id,
+        field,
+        codec.encode_record(
+            user_id="alice", model=model, timestamp=NOW, num_tokens=num_tokens, messages="[]", cached=cached
+        ),
+    )
+    record_usage(redis_client, **make_usage(kind, model, num_tokens, cached), expire_time=EXPIRE_TIME)
+
+
+def record_turn(chat_data, redis_client, codec, messages_id, model, prompt_tokens, response_tokens, cached=False):
+    record(chat_data, redis_client, codec, messages_id, "prompt", "prompt", model, prompt_tokens, cached)
+    record(chat_data, redis_client, codec, messages_id, "response", "response", model, response_tokens, cached)
+
+
+def read_usage(redis_client):
+    return {field.decode(): float(value) for field, value in redis_client.hgetall(usage_key(NOW)).items()}
+
+
+def test_rebuild_matches_the_live_totals(connection_pools, redis_client):
+    codec = StorageCodec(Fernet(Fernet.generate_key()))
+    chat_data = redis.Redis(connection_pool=connection_pools[CHAT_DATA_DB])
+    record_turn(chat_data, redis_client, codec, "session_000001", "gpt-4", 100, 20)
+    # 応答キャッシュで返したやり取りはコストを0として数える
+    record_turn(chat_data, redis_client, codec, "session_000003", "gpt-4", 100, 20, cached=True)
+    # ヘッジで閉じたモデルのプロンプトもコストに数える
+    record_turn(chat_data, redis_client, codec, "session_000005", "gpt-4", 50, 10)
+    record(chat_data, redis_client, codec, "session_000005", CANCELLED_PROMPT_FIELD, "prompt", "claude", 40)
+    live = read_usage(redis_client)
+    assert live["team"] == pytest.approx(2 * 0.03 + 2 * 0.06 + 0.003)
+    assert live["alice:claude:prompt:count"] == 1 and live["alice:claude:prompt:tokens"] == 40
+
+    redis_client.delete(usage_key(NOW))
+    assert rebuild_usage(chat_data, redis_client, API_COST, EXPIRE_TIME) == {usage_key(NOW): 7}
+    rebuilt = read_usage(redis_client)
+    assert rebuilt.keys() == live.keys()
+    for field, value in live.items():
+        assert rebuilt[field] == pytest.approx(value), field
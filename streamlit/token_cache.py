@@ -0,0 +1,121 @@
+"""
+トークン数計算のメモ化。
+
+(モデル名, テキストのハッシュ)をキーとして、プロセス内のLRUと、
+任意でRedisに共有する二段のキャッシュでトークン数を保持する。
+Streamlitはスクリプトを再実行してもimportしたモジュールは保持するため、
+このモジュールのインスタンスは再実行やユーザーをまたいで使われる。
+"""
+
+import hashlib, threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+import redis
+
+
+class TokenCountCache:
+    """
+    トークン数のキャッシュ。
+
+    引数:
+        maxsize (int): プロセス内のLRUに保持する最大件数。
+        redis_client (redis.Redis, optional): 共有キャッシュに使うRedisクライアント。Noneなら使わない。
+        expire_time (int): Redisに保存したキャッシュの寿命(秒)。
+        key_prefix (str): Redisのキーの接頭辞。
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 4096,
+        redis_client: Optional[redis.Redis] = None,
+        expire_time: int = 7 * 24 * 3600,
+        key_prefix: str = "token_count",
+    ):
+        self.maxsize = maxsize
+        self.redis_client = redis_client
+        self.expire_time = expire_time
+        self.key_prefix = key_prefix
+        self._lru: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {
+            "hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "redis_errors": 0,
+        }
+
+    @staticmethod
+    def make_key(text: str, model: str) -> Tuple[str, str]:
+        """(モデル名, テキストのsha256)のキーを作る。"""
+        return model, hashlib.sha256(text.encode()).hexdigest()
+
+    def count(self, text: str, model: str, count_func: Callable[[str, str], int]) -> int:
+        """
+        キャッシュからトークン数を返す。無ければcount_funcで計算して保存する。
+
+        引数:
+            text (str): トークン数を計算するテキスト。
+            model (str): モデル名。
+            count_func (Callable[[str, str], int]): (text, model)を受け取りトークン数を返す関数。
+
+        戻り値:
+            int: トークン数。
+        """
+        key = self.make_key(text, model)
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self._stats["hits"] += 1
+                return self._lru[key]
+
+        num_tokens = self._get_redis(key)
+        if num_tokens is not None:
+            self._put(key, num_tokens)
+            with self._lock:
+                self._stats["redis_hits"] += 1
+            return num_tokens
+
+        num_tokens = count_func(text, model)
+        self._put(key, num_tokens)
+        self._set_redis(key, num_tokens)
+        with self._lock:
+            self._stats["misses"] += 1
+        return num_tokens
+
+    def stats(self) -> Dict[str, int]:
+        """ヒット数、Redisでのヒット数、ミス数、Redisのエラー数と現在の件数を返す。"""
+        with self._lock:
+            return {**self._stats, "size": len(self._lru)}
+
+    def _put(self, key: Tuple[str, str], num_tokens: int) -> None:
+        with self._lock:
+            self._lru[key] = num_tokens
+            self._lru.move_to_end(key)
+            # 最大件数を超えたら最も古く使われたものを捨てる
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def _redis_key(self, key: Tuple[str, str]) -> str:
+        return f"{self.key_prefix}:{key[0]}:{key[1]}"
+
+    def _get_redis(self, key: Tuple[str, str]) -> Optional[int]:
+        if self.redis_client is None:
+            return None
+        try:
+            value = self.redis_client.get(self._redis_key(key))
+        except redis.RedisError:
+            # Redisが使えなくてもトークン数の計算は続ける
+            with self._lock:
+                self._stats["redis_errors"] += 1
+            return None
+        return None if value is None else int(value)
+
+    def _set_redis(self, key: Tuple[str, str], num_tokens: int) -> None:
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(self._redis_key(key), num_tokens, ex=self.expire_time)
+        except redis.RedisError:
+            with self._lock:
+                self._stats["redis_errors"] += 1
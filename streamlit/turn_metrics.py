@@ -0,0 +1,141 @@
+"""
+やり取り毎の処理時間のメトリクス。
+
+1回のやり取り(再実行)の中で、Redisの往復、トークン数の計算、トリム、暗号化・復号、
+モデルを呼んでから最初のチャンクと最後のチャンクまでの時間などを計り、
+モデル名をラベルにしたヒストグラムとしてRedisに加算する。
+flask/app.pyの/metricsがこれを読み、Prometheusのテキスト形式で返す。
+
+計測は、再実行のスレッドでactivateしたTurnMetricsに対してだけ行う。
+タイトル生成などの別のスレッドや、activateしていないスレッドのmeasureは何もしない。
+
+Redis(redisCliAccessTime)の構造 :
+    "metrics:index"                          : {JSON([メトリクス名, モデル名]) : JSON({"help" : 説明, "buckets" : [上限, ...]})}
+    f"metrics:hist:{メトリクス名}:{モデル名}" : {バケットの上限(str)か"+Inf" : その範囲の件数, "sum" : 合計, "count" : 件数}
+    "metrics:turns"                          : {モデル名 : やり取りの数}
+    "metrics:errors"                         : {モデル名 : エラーになったやり取りの数}
+バケットの件数は累積ではない。/metricsで累積にする。
+"""
+
+import bisect, json, threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+METRICS_KEY_PREFIX = "metrics"
+
+# 秒数のバケットの上限
+SECONDS_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+# 1秒あたりのチャンク数のバケットの上限
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# メトリクス名 : (説明, バケットの上限)
+METRICS: Dict[str, Tuple[str, Tuple[float, ...]]] = {
+    "turn_seconds": ("再実行の開始から応答の完了までの時間", SECONDS_BUCKETS),
+    "admission_wait_seconds": ("レート制限を超えて順番待ちの列で待った時間", SECONDS_BUCKETS),
+    "redis_seconds": ("やり取りでのRedisの往復にかかった時間の合計", SECONDS_BUCKETS),
+    "tokenize_seconds": ("トークン数の計算にかかった時間の合計", SECONDS_BUCKETS),
+    "trim_seconds": ("trim_tokensにかかった時間(トークン数の計算を含む)", SECONDS_BUCKETS),
+    "encrypt_seconds": ("暗号化にかかった時間の合計", SECONDS_BUCKETS),
+    "decrypt_seconds": ("復号にかかった時間の合計", SECONDS_BUCKETS),
+    "first_chunk_seconds": ("モデルを呼んでから最初のチャンクまでの時間", SECONDS_BUCKETS),
+    "stream_seconds": ("モデルを呼んでから最後のチャンクまでの時間", SECONDS_BUCKETS),
+    "chunks_per_second": ("最初のチャンクから最後のチャンクまでの1秒あたりのチャンク数", RATE_BUCKETS),
+}
+
+_local = threading.local()
+
+
+class TurnMetrics:
+    """
+    1回のやり取りの計測値。同じ名前の計測は足し合わせ、やり取り毎に1件として記録する。
+
+    引数:
+        model (str): ラベルにするモデル名。
+    """
+
+    def __init__(self, model: str = ""):
+        self.model = model
+        self.values: Dict[str, float] = defaultdict(float)
+
+    def add(self, name: str, value: float) -> None:
+        """nameの計測値にvalueを足す。"""
+        self.values[name] += value
+
+    def set(self, name: str, value: float) -> None:
+        """nameの計測値をvalueにする。"""
+        self.values[name] = value
+
+
+def activate(metrics: Optional[TurnMetrics]) -> None:
+    """このスレッドで計測するTurnMetricsを設定する。Noneで計測をやめる。"""
+    _local.metrics = metrics
+
+
+def current() -> Optional[TurnMetrics]:
+    """このスレッドで計測しているTurnMetricsを返す。無ければNone。"""
+    return getattr(_local, "metrics", None)
+
+
+@contextmanager
+def measure(name: str) -> Iterator[None]:
+    """withの中の経過秒数を、このスレッドのTurnMetricsのnameに足す。計測していなければ何もしない。"""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - started_at)
+
+
+def _json(obj: Any) -> str:
+    # storage_codecが計測のためにこのモジュールをimportするので、compact_jsonは使わない
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def histogram_key(name: str, model: str, key_prefix: str = METRICS_KEY_PREFIX) -> str:
+    """メトリクスのヒストグラムのハッシュのキーを返す。"""
+    return f"{key_prefix}:hist:{name}:{model}"
+
+
+def bucket_label(buckets: Tuple[float, ...], value: float) -> str:
+    """valueが入るバケットの上限を文字列で返す。全ての上限を超えれば"+Inf"。"""
+    i = bisect.bisect_left(buckets, value)
+    return repr(buckets[i]) if i < len(buckets) else "+Inf"
+
+
+def queue_turn_metrics(
+    pipe, metrics: TurnMetrics, error: bool = False, key_prefix: str = METRICS_KEY_PREFIX
+) -> None:
+    """
+    やり取りの数と、計測値のヒストグラムへの加算をパイプラインに積む。
+    エラーになったやり取りは数えるだけで、計測値は記録しない。
+
+    引数:
+        pipe: redisCliAccessTimeのパイプライン。
+        metrics (TurnMetrics): やり取りの計測値。
+        error (bool): エラーになったやり取りか。
+        key_prefix (str): キーの接頭辞。
+    """
+    pipe.hincrby(f"{key_prefix}:turns", metrics.model, 1)
+    if error:
+        pipe.hincrby(f"{key_prefix}:errors", metrics.model, 1)
+        return
+    for name, value in metrics.values.items():
+        if name not in METRICS:
+            continue
+        description, buckets = METRICS[name]
+        key = histogram_key(name, metrics.model, key_prefix)
+        pipe.hset(
+            f"{key_prefix}:index",
+            _json([name, metrics.model]),
+            _json({"help": description, "buckets": buckets}),
+        )
+        pipe.hincrby(key, bucket_label(buckets, value), 1)
+        pipe.hincrbyfloat(key, "sum", value)
+        pipe.hincrby(key, "count", 1)
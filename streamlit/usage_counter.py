@@ -0,0 +1,208 @@
+"""
+日毎の利用量とコストの集計カウンター。
+
+プロンプトやレスポンスをredisCliChatDataに記録する度に、その日のハッシュ
+f"usage:{YYYY-MM-DD}"をMULTIでまとめて加算する。構造は以下のとおり。
+    "team"                              : その日のチーム全体のコスト(float)
+    f"user:{USER_ID}"                   : その日のユーザーのコスト(float)
+    f"{USER_ID}:{model}:{kind}:count"   : 記録数(int)
+    f"{USER_ID}:{model}:{kind}:tokens"  : トークン数(int)
+サイドバーはHMGETの1往復で"team"と"user:{USER_ID}"を読むだけで済む。
+
+既存のredisCliChatDataからカウンターを作り直すには、streamlitのコンテナで
+    python usage_counter.py --rebuild [--days 日数]
+を実行する。作り直しは記録の'prompt'と'response'に加え、ヘッジで閉じたモデルのプロンプト
+(CANCELLED_PROMPT_FIELD)もプロンプトとして数え、応答キャッシュで返した記録(cached)のコストは
+その場の集計と同じく0にする。記録が期限切れや削除で無くなった分は数えられない。
+"""
+
+import argparse, datetime, json, os
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import redis
+
+from storage_codec import read_record_metadata
+
+USAGE_KEY_PREFIX = "usage"
+# ヘッジで先に他方が応答したため閉じたモデルのプロンプトを記録する、redisCliChatDataのフィールド
+CANCELLED_PROMPT_FIELD = "prompt:cancelled"
+
+
+def usage_key(timestamp: float) -> str:
+    """timestampのローカル日付の集計ハッシュのキーを返す。"""
+    day = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+    return f"{USAGE_KEY_PREFIX}:{day}"
+
+
+def calc_cost(api_cost: dict, model: str, kind: str) -> float:
+    """
+    記録1件あたりのコストを返す。api_costにモデルが無ければKeyErrorを送出する。
+
+    引数:
+        api_cost (dict): {<モデル名>:{"prompt":1.234,"response":2.345},....}の形式のコスト表。
+        model (str): モデル名。
+        kind (str): "prompt"か"response"。
+    """
+    return api_cost[model][kind] / 1000
+
+
+def queue_usage(
+    pipe,
+    *,
+    user_id: str,
+    model: str,
+    kind: str,
+    num_tokens: int,
+    cost: float,
+    timestamp: float,
+    expire_time: int,
+) -> None:
+    """
+    その日の集計ハッシュにコスト、記録数、トークン数を加算するコマンドをパイプラインに積む。
+    他の書き込みと同じMULTIにまとめたい場合に使う。引数はrecord_usageと同じ。
+    """
+    key = usage_key(timestamp)
+    pipe.hincrbyfloat(key, "team", cost)
+    pipe.hincrbyfloat(key, f"user:{user_id}", cost)
+    pipe.hincrby(key, f"{user_id}:{model}:{kind}:count", 1)
+    pipe.hincrby(key, f"{user_id}:{model}:{kind}:tokens", int(num_tokens))
+    pipe.expire(key, expire_time)
+
+
+def record_usage(
+    redis_client: redis.Redis,
+    *,
+    user_id: str,
+    model: str,
+    kind: str,
+    num_tokens: int,
+    cost: float,
+    timestamp: float,
+    expire_time: int,
+) -> None:
+    """
+    その日の集計ハッシュにコスト、記録数、トークン数を1往復でアトミックに加算する。
+
+    引数:
+        redis_client (redis.Redis): 集計ハッシュを保存するRedisクライアント。
+        user_id (str): USER_ID。
+        model (str): モデル名。
+        kind (str): "prompt"か"response"。
+        num_tokens (int): トークン数。
+        cost (float): コスト。
+        timestamp (float): 記録のタイムスタンプ。集計する日付を決める。
+        expire_time (int): 集計ハッシュの寿命(秒)。
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    queue_usage(
+        pipe,
+        user_id=user_id,
+        model=model,
+        kind=kind,
+        num_tokens=num_tokens,
+        cost=cost,
+        timestamp=timestamp,
+        expire_time=expire_time,
+    )
+    pipe.execute()
+
+
+def get_daily_cost(
+    redis_client: redis.Redis, user_id: str, timestamp: float
+) -> Tuple[float, float]:
+    """
+    timestampの日のチーム全体のコストとユーザーのコストを1往復で取得する。
+
+    戻り値:
+        Tuple[float, float]: (チームのコスト, ユーザーのコスト)
+    """
+    cost_team, cost_mine = redis_client.hmget(
+        usage_key(timestamp), "team", f"user:{user_id}"
+    )
+    return float(cost_team or 0), float(cost_mine or 0)
+
+
+def rebuild_usage(
+    chat_data_client: redis.Redis,
+    usage_client: redis.Redis,
+    api_cost: dict,
+    expire_time: int,
+    since: Optional[float] = None,
+) -> Dict[str, int]:
+    """
+    redisCliChatDataの全記録から日毎の集計ハッシュを作り直す。
+    ヘッジで閉じたモデルのプロンプトもプロンプトとして数え、応答キャッシュで返した記録のコストは0にする。
+    集計中に記録された分は失われることがあるため、利用の少ない時間に実行する。
+
+    引数:
+        chat_data_client (redis.Redis): redisCliChatDataのクライアント。
+        usage_client (redis.Redis): 集計ハッシュを保存するRedisクライアント。
+        api_cost (dict): コスト表。
+        expire_time (int): 集計ハッシュの寿命(秒)。
+        since (float, optional): これより前のタイムスタンプの記録は対象外にする。
+
+    戻り値:
+        Dict[str, int]: 作り直した集計ハッシュのキー毎の記録数。
+    """
+    usages: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    num_records: Dict[str, int] = defaultdict(int)
+    for messages_id in chat_data_client.scan_iter(count=1000):
+        for field, value in chat_data_client.hgetall(messages_id).items():
+            data = read_record_metadata(value)
+            kind = "prompt" if field.decode() == CANCELLED_PROMPT_FIELD else field.decode()
+            if since is not None and data["timestamp"] < since:
+                continue
+            try:
+                cost = 0 if data.get("cached") else calc_cost(api_cost, data["model"], kind)
+            except KeyError:
+                cost = 0
+            key = usage_key(data["timestamp"])
+            user_id = data.get("USER_ID", "")
+            usages[key]["team"] += cost
+            usages[key][f"user:{user_id}"] += cost
+            usages[key][f"{user_id}:{data['model']}:{kind}:count"] += 1
+            usages[key][f"{user_id}:{data['model']}:{kind}:tokens"] += data["num_tokens"]
+            num_records[key] += 1
+
+    for key, usage in usages.items():
+        pipe = usage_client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(
+            key,
+            mapping={
+                field: int(value) if field.endswith((":count", ":tokens")) else value
+                for field, value in usage.items()
+            },
+        )
+        pipe.expire(key, expire_time)
+        pipe.execute()
+    return dict(num_records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="redisCliChatDataから日毎の利用量とコストの集計を作り直す。"
+    )
+    parser.add_argument("--rebuild", action="store_true", help="集計を作り直す。")
+    parser.add_argument(
+        "--days", type=int, default=None, help="何日前からの記録を対象にするか。省略すると全て。"
+    )
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.print_help()
+    else:
+        since = None
+        if args.days is not None:
+            since = (
+                datetime.datetime.now() - datetime.timedelta(days=args.days)
+            ).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        rebuilt = rebuild_usage(
+            redis.Redis(host="redis", port=6379, db=5),
+            redis.Redis(host="redis", port=6379, db=3),
+            json.loads(os.environ["API_COST"]),
+            int(os.environ.get("EXPIRE_TIME", 24 * 3600 * 366)),
+            since=since,
+        )
+        for key, num in sorted(rebuilt.items()):
+            print(f"{key} : {num} records")